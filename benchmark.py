@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+
+import requests
+
+import gitverify
+import fake_github
+
+
+# Throughput benchmark for full verification runs against a local fake GitHub
+# API running in its own process. Each scenario verifies the whole synthetic
+# fleet and reports repos/second, requests/second, client-observed p50/p99
+# request latency and the peak Python heap (tracemalloc) during the run.
+class TimingClient(gitverify.GitHubClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.durations = []
+
+    def request(self, method, url, headers=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().request(method, url, headers=headers, **kwargs)
+        finally:
+            self.durations.append(time.perf_counter() - start)
+
+
+class AsyncTimingClient(gitverify.AsyncGitHubClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.durations = []
+
+    async def get_json(self, url, headers=None):
+        start = time.perf_counter()
+        try:
+            return await super().get_json(url, headers)
+        finally:
+            self.durations.append(time.perf_counter() - start)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_serial(fake, plan, headers, args):
+    with TimingClient(pool_maxsize=1) as client:
+        for owner, repo in fake.repositories:
+            try:
+                gitverify.verify_branch_protection(plan.for_repository(owner, repo), headers, client=client)
+            except ConnectionError:
+                pass
+        return client.durations
+
+
+def run_threaded(fake, plan, headers, args):
+    with TimingClient(pool_maxsize=args.workers) as client:
+        gitverify.verify_fleet(plan, fake.repositories, headers, args.workers, client)
+        return client.durations
+
+
+def run_cached(fake, plan, headers, args):
+    with tempfile.TemporaryDirectory() as directory:
+        with TimingClient(pool_maxsize=args.workers, cache=gitverify.ResponseCache(directory)) as client:
+            gitverify.verify_fleet(plan, fake.repositories, headers, args.workers, client)
+        requests.get(f"{gitverify.GITHUB_API_URL}/_fake/reset")
+        with TimingClient(pool_maxsize=args.workers, cache=gitverify.ResponseCache(directory)) as client:
+            gitverify.verify_fleet(plan, fake.repositories, headers, args.workers, client)
+            return client.durations
+
+
+def run_async(fake, plan, headers, args):
+    async def verify():
+        async with AsyncTimingClient(limit=args.async_limit) as client:
+            await gitverify.verify_fleet_async(plan, fake.repositories, headers, client=client)
+            return client.durations
+
+    return asyncio.run(verify())
+
+
+SCENARIOS = {
+    "serial": run_serial,
+    "threaded": run_threaded,
+    "cached": run_cached,
+    "async": run_async,
+}
+
+
+@contextlib.contextmanager
+def fake_server(args):
+    command = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_github.py"),
+        "--repos",
+        str(args.repos),
+        "--rules",
+        str(args.rules),
+        "--environments",
+        str(args.environments),
+        "--latency",
+        str(args.latency),
+        "--jitter",
+        str(args.jitter),
+        "--error-rate",
+        str(args.error_rate),
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    try:
+        yield process.stdout.readline().strip()
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run_scenario(name, args):
+    fake = fake_github.FakeGitHub(repositories=args.repos, branches=args.rules, environments=args.environments)
+    plan = gitverify.compile_protocol(fake.protocol())
+    headers = {"Authorization": "token benchmark", "Accept": "application/vnd.github.v3+json"}
+    with fake_server(args) as url:
+        gitverify.GITHUB_API_URL = url
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        durations = SCENARIOS[name](fake, plan, headers, args)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        stats = requests.get(f"{url}/_fake/stats").json()
+        return {
+            "scenario": name,
+            "repos": args.repos,
+            "requests": stats["requests"],
+            "not_modified": stats["not_modified"],
+            "seconds": elapsed,
+            "repos_per_second": args.repos / elapsed,
+            "requests_per_second": len(durations) / elapsed,
+            "p50_ms": percentile(durations, 0.50) * 1000,
+            "p99_ms": percentile(durations, 0.99) * 1000,
+            "peak_memory_mb": peak / (1024 * 1024),
+        }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark gitverify against a local fake GitHub API.")
+    parser.add_argument("--repos", type=int, default=200, help="repositories in the synthetic fleet")
+    parser.add_argument("--rules", type=int, default=5, help="protected branches per repository")
+    parser.add_argument("--environments", type=int, default=3, help="environments per repository")
+    parser.add_argument("--latency", type=float, default=20, help="server latency per request in ms")
+    parser.add_argument("--jitter", type=float, default=5, help="random extra latency per request in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 502")
+    parser.add_argument("--workers", type=int, default=32, help="workers for the threaded scenarios")
+    parser.add_argument("--async-limit", type=int, default=200, help="in-flight requests for the async scenario")
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=sorted(SCENARIOS),
+        default=["threaded", "cached", "async"],
+        help="scenarios to run",
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = []
+    print(
+        f"{'scenario':<10} {'repos/s':>9} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'requests':>9} {'304s':>6} {'peak MB':>8}"
+    )
+    for name in args.scenarios:
+        if name == "async" and gitverify.aiohttp is None:
+            print(f"{name:<10} skipped: aiohttp is not installed")
+            continue
+        result = run_scenario(name, args)
+        results.append(result)
+        print(
+            f"{name:<10} {result['repos_per_second']:>9.1f} {result['requests_per_second']:>9.1f} "
+            f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['requests']:>9} "
+            f"{result['not_modified']:>6} {result['peak_memory_mb']:>8.2f}"
+        )
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=4)
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
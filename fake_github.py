@@ -0,0 +1,360 @@
+import sys
+import json
+import base64
+import time
+import argparse
+import random
+import hashlib
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Local stand-in for the parts of the GitHub REST API that gitverify.py uses:
+# branch and environment protection, organization repository listing and
+# branch listing (both paginated with Link headers, at most `page_size` items
+# per page). It serves a synthetic fleet of `repositories` repos with
+# `branches` protected branches and `environments` environments each, and can
+# inject latency, 5xx errors and per-token primary rate limits. Responses
+# carry ETags and answer matching If-None-Match requests with 304, which is
+# not counted against the limit. Every repository also has the tracked
+# `files` (listed by git/trees/HEAD) and, when `codeowners` is given, that
+# text as .github/CODEOWNERS (served by the contents API).
+class FakeGitHub:
+    def __init__(
+        self,
+        repositories=100,
+        branches=5,
+        environments=3,
+        organization="bench-org",
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        rate_limit=None,
+        rate_limit_window=3600,
+        page_size=100,
+        extra_branches=0,
+        seed=0,
+        files=(),
+        codeowners=None,
+        tree_limit=None,
+    ):
+        self.organization = organization
+        self.repository_names = [f"repo-{index:05d}" for index in range(repositories)]
+        self.branch_names = ["main"] + [f"branch-{index}" for index in range(1, branches)]
+        self.environment_names = [f"env-{index}" for index in range(environments)]
+        self.extra_branches = extra_branches
+        self.files = list(files)
+        self.codeowners = codeowners
+        self.tree_limit = tree_limit
+        if codeowners is not None:
+            self.files.append(".github/CODEOWNERS")
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.paths = []
+        self.record_paths = False
+        self._budgets = {}
+        self._server = None
+        self._thread = None
+
+    @property
+    def repositories(self):
+        return [(self.organization, name) for name in self.repository_names]
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    # A protocol every repository of the fleet is verified against; roughly
+    # one repository in three needs more reviewers than it has configured.
+    def protocol(self):
+        return {
+            "protocol": {
+                "project_name": "Synthetic fleet",
+                "Github": {"organization": self.organization, "project": self.repository_names[0]},
+                "branch_protection_rules": [
+                    {"branch": branch, "required_reviewers": 2, "allow_force_push": False, "allow_bypass": False}
+                    for branch in self.branch_names
+                ],
+                "environments": [
+                    {"name": environment, "required_reviewers": 2, "required_approvers": ["Reviewer 1"]}
+                    for environment in self.environment_names
+                ],
+            }
+        }
+
+    def _reviewers(self, repo, name):
+        digest = hashlib.sha256(f"{repo}/{name}".encode()).digest()
+        return 1 + digest[0] % 3
+
+    def branch_protection(self, repo, branch):
+        return {
+            "url": f"/repos/{self.organization}/{repo}/branches/{branch}/protection",
+            "required_status_checks": {"strict": True, "contexts": ["build", "test"], "checks": []},
+            "required_pull_request_reviews": {
+                "dismiss_stale_reviews": True,
+                "require_code_owner_reviews": True,
+                "required_approving_review_count": self._reviewers(repo, branch),
+            },
+            "enforce_admins": {"enabled": False},
+            "allow_force_pushes": {"enabled": False},
+            "allow_deletions": {"enabled": False},
+        }
+
+    def environment_protection(self, repo, environment):
+        return {
+            "required_reviewers": self._reviewers(repo, environment),
+            "approvers": ["Reviewer 1", "Reviewer 2"],
+        }
+
+    def all_branches(self, repo):
+        names = self.branch_names + [f"feature/{index}" for index in range(self.extra_branches)]
+        return [{"name": name, "protected": name in self.branch_names} for name in names]
+
+    @staticmethod
+    def tree_sha(directory):
+        return hashlib.sha1(directory.encode()).hexdigest()
+
+    # The tree of `sha` (HEAD or a directory's tree_sha), with paths relative
+    # to it. Recursive listings longer than `tree_limit` entries are cut off
+    # and marked truncated, as GitHub does for very large trees.
+    def tree(self, sha="HEAD", recursive=True):
+        directories = {path.rsplit("/", 1)[0] for path in self.files if "/" in path}
+        for directory in list(directories):
+            while "/" in directory:
+                directory = directory.rsplit("/", 1)[0]
+                directories.add(directory)
+        if sha == "HEAD":
+            root = ""
+        else:
+            root = next((directory for directory in directories if self.tree_sha(directory) == sha), None)
+            if root is None:
+                return None
+        prefix = root + "/" if root else ""
+        entries = [
+            {"path": path[len(prefix) :], "type": "tree", "sha": self.tree_sha(path)}
+            for path in sorted(directories)
+            if path.startswith(prefix)
+        ]
+        entries += [{"path": path[len(prefix) :], "type": "blob"} for path in self.files if path.startswith(prefix)]
+        if not recursive:
+            entries = [entry for entry in entries if "/" not in entry["path"]]
+        truncated = recursive and self.tree_limit is not None and len(entries) > self.tree_limit
+        if truncated:
+            entries = entries[: self.tree_limit]
+        return {"tree": entries, "truncated": truncated}
+
+    def start(self):
+        fake = self
+
+        class Handler(_FakeGitHubHandler):
+            github = fake
+
+        self._server = _FakeGitHubServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _spend(self, token):
+        with self.lock:
+            now = time.time()
+            budget = self._budgets.get(token)
+            if budget is None or now >= budget[1]:
+                budget = [self.rate_limit, now + self.rate_limit_window]
+                self._budgets[token] = budget
+            if budget[0] > 0:
+                budget[0] -= 1
+                return True, budget[0], budget[1]
+            return False, 0, budget[1]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "not_modified": self.not_modified,
+                "errors": self.errors,
+                "rate_limited": self.rate_limited,
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = self.not_modified = self.errors = self.rate_limited = 0
+            self.paths = []
+
+    def _route(self, path, query=None):
+        parts = path.strip("/").split("/")
+        query = query or {}
+        if len(parts) == 3 and parts[0] == "orgs" and parts[2] == "repos" and parts[1] == self.organization:
+            return "list", [{"name": name, "full_name": f"{self.organization}/{name}"} for name in self.repository_names]
+        if len(parts) < 4 or parts[0] != "repos" or parts[1] != self.organization:
+            return None, None
+        repo = parts[2]
+        if repo not in self.repository_names:
+            return None, None
+        if parts[3] == "branches" and len(parts) == 4:
+            return "list", self.all_branches(repo)
+        if parts[3:5] == ["git", "trees"] and len(parts) == 6:
+            tree = self.tree(parts[5], query.get("recursive") == ["1"])
+            if tree is not None:
+                return "document", tree
+        if parts[3] == "contents" and "/".join(parts[4:]) == ".github/CODEOWNERS" and self.codeowners is not None:
+            return "document", {"encoding": "base64", "content": base64.b64encode(self.codeowners.encode()).decode()}
+        if parts[3] == "branches" and parts[-1] == "protection":
+            branch = "/".join(parts[4:-1])
+            if branch in self.branch_names:
+                return "document", self.branch_protection(repo, branch)
+        if parts[3] == "environments" and len(parts) == 6 and parts[5] == "protection":
+            if parts[4] in self.environment_names:
+                return "document", self.environment_protection(repo, parts[4])
+        return None, None
+
+
+class _FakeGitHubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class _FakeGitHubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    github = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        github = self.github
+        if self.path.startswith("/_fake/"):
+            if self.path == "/_fake/reset":
+                github.reset_stats()
+            self._send(200, json.dumps(github.stats()).encode(), [("Content-Type", "application/json")])
+            return
+        with github.lock:
+            github.requests += 1
+            if github.record_paths:
+                github.paths.append(self.path)
+        delay = github.latency + (github.random.uniform(0, github.jitter) if github.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        if github.error_rate and github.random.random() < github.error_rate:
+            with github.lock:
+                github.errors += 1
+            self._send(502, b'{"message": "Bad Gateway"}', [("Content-Type", "application/json")])
+            return
+
+        split = urlsplit(self.path)
+        kind, payload = github._route(split.path, parse_qs(split.query))
+        if kind is None:
+            self._send(404, b'{"message": "Not Found"}', [("Content-Type", "application/json")])
+            return
+
+        headers = [("Content-Type", "application/json")]
+        if kind == "list":
+            page = int(parse_qs(split.query).get("page", ["1"])[0])
+            per_page = min(int(parse_qs(split.query).get("per_page", ["30"])[0]), github.page_size)
+            last = max(1, -(-len(payload) // per_page))
+            payload = payload[(page - 1) * per_page : page * per_page]
+            links = []
+            base = f"{github.url}{split.path}?per_page={per_page}"
+            if page < last:
+                links.append(f'<{base}&page={page + 1}>; rel="next"')
+                links.append(f'<{base}&page={last}>; rel="last"')
+            if page > 1:
+                links.append(f'<{base}&page=1>; rel="first"')
+                links.append(f'<{base}&page={page - 1}>; rel="prev"')
+            if links:
+                headers.append(("Link", ", ".join(links)))
+
+        body = json.dumps(payload).encode()
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        headers.append(("ETag", etag))
+        if self.headers.get("If-None-Match") == etag:
+            with github.lock:
+                github.not_modified += 1
+            self._send(304, headers=[("ETag", etag)])
+            return
+
+        if github.rate_limit is not None:
+            allowed, remaining, reset = github._spend(self.headers.get("Authorization", ""))
+            headers.append(("X-RateLimit-Limit", str(github.rate_limit)))
+            headers.append(("X-RateLimit-Remaining", str(remaining)))
+            headers.append(("X-RateLimit-Reset", str(int(reset) + 1)))
+            if not allowed:
+                with github.lock:
+                    github.rate_limited += 1
+                self._send(403, b'{"message": "API rate limit exceeded"}', headers)
+                return
+
+        self._send(200, body, headers)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a synthetic fleet through a fake GitHub REST API.")
+    parser.add_argument("--repos", type=int, default=100, help="repositories in the synthetic fleet")
+    parser.add_argument("--rules", type=int, default=5, help="protected branches per repository")
+    parser.add_argument("--environments", type=int, default=3, help="environments per repository")
+    parser.add_argument("--extra-branches", type=int, default=0, help="unprotected branches per repository")
+    parser.add_argument("--latency", type=float, default=0, help="latency per request in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="random extra latency per request in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 502")
+    parser.add_argument("--rate-limit", type=int, help="requests per token per window before 403s")
+    parser.add_argument("--rate-limit-window", type=float, default=3600, help="rate-limit window in seconds")
+    return parser.parse_args(argv)
+
+
+def from_args(args):
+    return FakeGitHub(
+        repositories=args.repos,
+        branches=args.rules,
+        environments=args.environments,
+        extra_branches=args.extra_branches,
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        rate_limit_window=args.rate_limit_window,
+    )
+
+
+# Run standalone (e.g. in its own process, so the server does not compete
+# with the client for the GIL); prints the base URL on the first line.
+if __name__ == "__main__":
+    fake = from_args(parse_args(sys.argv[1:])).start()
+    print(fake.url, flush=True)
+    try:
+        fake._thread.join()
+    except KeyboardInterrupt:
+        fake.stop()
@@ -1,27 +1,1237 @@
 import os
+import re
+import sys
+import time
+import asyncio
+import contextlib
+import functools
+import itertools
+import collections
+import random
+import math
+import pickle
+import sqlite3
+import stat
+import base64
+import hashlib
+import heapq
+import multiprocessing
+import mmap
+import struct
+import zlib
+import urllib.parse
+import tempfile
+import threading
+import argparse
+import socketserver
+import http.server
+import atexit
 import yaml
 import requests
+import requests.adapters
 import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 
+try:
+    import aiohttp
+except ImportError:  # optional, only needed by the async API
+    aiohttp = None
 
+try:
+    import numpy
+except ImportError:  # optional, speeds up evaluate_table
+    numpy = None
+
+GITHUB_API_URL = "https://api.github.com"
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_CACHE_MAX_AGE = 7 * 24 * 3600
+GRAPHQL_BATCH_SIZE = 20
+BRANCH_PAGE_SIZE = 100
+# Branch list pages fetched ahead of the one being consumed.
+BRANCH_PAGE_WINDOW = 8
+# GitHub asks integrations to stay below roughly 900 REST points per minute
+# per token to avoid secondary rate limits.
+DEFAULT_TOKEN_RATE = 15.0
+DEFAULT_TOKEN_BURST = 30
+SECONDARY_RATE_LIMIT_WAIT = 60
+PLAN_FORMAT_VERSION = 1
+DEFAULT_REFRESH_INTERVAL = 15 * 60
+DEFAULT_HOT_INTERVAL = 60
+DEFAULT_WATCH_ADDRESS = "127.0.0.1:8787"
+
+# The libyaml-backed loader is several times faster when PyYAML was built with it.
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Instrumentation. While METRICS is None (the default) the hooks below cost a
+# global lookup per call. enable_metrics() installs a Metrics object that
+# collects counters, per-endpoint request latency and per-stage duration
+# histograms, and (with trace=True) one span per traced call and HTTP
+# attempt. write_prometheus() writes the node_exporter textfile format;
+# write_trace() writes Chrome trace-event JSON (chrome://tracing, Perfetto).
+METRICS = None
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_HELP = {
+    "gitverify_requests_total": ("counter", "HTTP requests sent to GitHub, by endpoint and status."),
+    "gitverify_response_bytes_total": ("counter", "Response body bytes received from GitHub, by endpoint."),
+    "gitverify_cache_hits_total": ("counter", "GETs answered from the ETag cache with 304 Not Modified."),
+    "gitverify_cache_misses_total": ("counter", "Cacheable GETs that returned a new body."),
+    "gitverify_retries_total": ("counter", "Requests sent again, by reason."),
+    "gitverify_rate_limit_waits_total": ("counter", "Times the scheduler slept because every token was parked."),
+    "gitverify_rate_limit_wait_seconds_total": ("counter", "Seconds slept waiting for a token budget."),
+    "gitverify_request_duration_seconds": ("histogram", "GitHub request latency, by endpoint."),
+    "gitverify_stage_duration_seconds": ("histogram", "Duration of each traced stage."),
+}
+
+
+class Metrics:
+    def __init__(self, trace=False, clock=time.perf_counter):
+        self.clock = clock
+        self.started_at = clock()
+        self.counters = collections.Counter()
+        self.histograms = {}
+        self.spans = [] if trace else None
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] += value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def record_span(self, name, started, seconds, **attributes):
+        if self.spans is None:
+            return
+        span = {
+            "name": name,
+            "ph": "X",
+            "ts": round((started - self.started_at) * 1e6),
+            "dur": round(seconds * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        if attributes:
+            span["args"] = attributes
+        with self._lock:
+            self.spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        started = self.clock()
+        try:
+            yield
+        finally:
+            seconds = self.clock() - started
+            self.observe("gitverify_stage_duration_seconds", seconds, stage=name)
+            self.record_span(name, started, seconds)
+
+    def prometheus(self):
+        families = collections.defaultdict(list)
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                families[name].append(f"{name}{_prometheus_labels(labels)} {value:g}")
+            for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                    families[name].append(f"{name}_bucket{_prometheus_labels(labels + (('le', f'{bound:g}'),))} {bucket}")
+                families[name].append(f"{name}_bucket{_prometheus_labels(labels + (('le', '+Inf'),))} {count}")
+                families[name].append(f"{name}_sum{_prometheus_labels(labels)} {total:.6f}")
+                families[name].append(f"{name}_count{_prometheus_labels(labels)} {count}")
+        lines = []
+        for name, samples in families.items():
+            kind, text = METRIC_HELP.get(name, ("untyped", name))
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"] + samples
+        return "".join(line + "\n" for line in lines)
+
+    # Written to a temporary file and renamed, so the node_exporter textfile
+    # collector never reads a partial file.
+    def write_prometheus(self, path):
+        _write_atomically(path, self.prometheus())
+
+    def write_trace(self, path):
+        with self._lock:
+            spans = list(self.spans or ())
+        _write_atomically(path, json.dumps({"traceEvents": spans, "displayTimeUnit": "ms"}))
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _write_atomically(path, text):
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", dir=directory, delete=False, suffix=".tmp") as file:
+        file.write(text)
+    os.replace(file.name, path)
+
+
+def enable_metrics(trace=False):
+    global METRICS
+    METRICS = Metrics(trace=trace)
+    return METRICS
+
+
+def disable_metrics():
+    global METRICS
+    METRICS = None
+
+
+# Records a stage span around every call of the decorated function (awaited
+# calls for coroutine functions) while metrics are enabled.
+def traced(name):
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def traced_async(*args, **kwargs):
+                if METRICS is None:
+                    return await fn(*args, **kwargs)
+                with METRICS.span(name):
+                    return await fn(*args, **kwargs)
+
+            return traced_async
+
+        @functools.wraps(fn)
+        def traced_call(*args, **kwargs):
+            if METRICS is None:
+                return fn(*args, **kwargs)
+            with METRICS.span(name):
+                return fn(*args, **kwargs)
+
+        return traced_call
+
+    return decorate
+
+
+# Endpoint label for request metrics: the API path with owner, repository,
+# branch, environment and file names replaced by "*", so the label set stays
+# small however many repositories a run touches.
+ENDPOINT_SEGMENTS = frozenset(
+    ("repos", "orgs", "branches", "environments", "protection", "git", "trees", "contents", "graphql")
+)
+
+
+def endpoint_label(url):
+    path = urllib.parse.urlsplit(url).path
+    prefix = urllib.parse.urlsplit(GITHUB_API_URL).path.rstrip("/")
+    if prefix and path.startswith(prefix):
+        path = path[len(prefix) :]
+    segments = []
+    for segment in path.strip("/").split("/"):
+        segment = segment if segment in ENDPOINT_SEGMENTS else "*"
+        if segment != "*" or segments[-1:] != ["*"]:
+            segments.append(segment)
+    return "/" + "/".join(segments)
+
+
+# Counts and times one HTTP attempt; returns nothing and costs nothing while
+# metrics are disabled.
+def _observe_request(method, url, started, response=None, error=None):
+    if response is None:
+        _observe_attempt(method, url, started, type(error).__name__)
+    else:
+        _observe_attempt(method, url, started, str(response.status_code), len(response.content))
+
+
+# The attempt's status is the HTTP status code, or the exception's name when
+# no response arrived (and `size` is None).
+def _observe_attempt(method, url, started, status, size=None):
+    metrics = METRICS
+    if metrics is None:
+        return
+    seconds = metrics.clock() - started
+    endpoint = endpoint_label(url)
+    metrics.count("gitverify_requests_total", endpoint=endpoint, status=status)
+    metrics.observe("gitverify_request_duration_seconds", seconds, endpoint=endpoint)
+    if size is not None:
+        metrics.count("gitverify_response_bytes_total", size, endpoint=endpoint)
+    metrics.record_span(f"{method} {endpoint}", started, seconds, url=url, status=status)
+
+
+def _count(name, value=1, **labels):
+    metrics = METRICS
+    if metrics is not None:
+        metrics.count(name, value, **labels)
+
+
+@traced("load_protocol")
 def load_protocol(file_path):
     try:
         with open(file_path, "r") as file:
-            return yaml.safe_load(file)
+            protocol = yaml.load(file, Loader=YAML_LOADER)
     except FileNotFoundError:
         raise FileNotFoundError(f"Protocol file not found: {file_path}")
     except yaml.YAMLError:
         raise ValueError(f"Error parsing the protocol file: {file_path}")
+    if not isinstance(protocol, dict) or not isinstance(protocol.get("protocol"), dict):
+        raise ValueError(f"Error parsing the protocol file: {file_path} has no protocol section")
+    return protocol
 
 
-# Verification of branch protection rules
-def get_branch_protection_rules(owner, repo, branch, headers):
-    url = f"https://api.github.com/repos/{owner}/{repo}/branches/{branch}/protection"
+# Compiled protocol: validated, slotted rule records grouped by branch and
+# environment. Records also support rule["field"] access, so they can be used
+# wherever the verifiers used the raw protocol dicts.
+class _Rule:
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._values() == other._values()
+
+    def __hash__(self):
+        return hash((type(self).__name__,) + self._values())
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+    def __reduce__(self):
+        return (type(self), self._values())
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+class BranchRule(_Rule):
+    __slots__ = ("branch", "required_reviewers", "allow_force_push", "allow_bypass")
+
+
+class EnvironmentRule(_Rule):
+    __slots__ = ("name", "branch", "required_reviewers", "required_approvers")
+
+
+class StatusCheckRule(_Rule):
+    __slots__ = ("branch", "checks")
+
+
+class CodeOwnerRule(_Rule):
+    __slots__ = ("path", "owners")
+
+
+class ProtocolPlan:
+    __slots__ = (
+        "project_name",
+        "owner",
+        "repo",
+        "approvers",
+        "branch_rules",
+        "environment_rules",
+        "status_checks",
+        "code_owners",
+        "branches",
+        "environments",
+    )
+
+    def __init__(
+        self, project_name, owner, repo, approvers, branch_rules, environment_rules, status_checks, code_owners
+    ):
+        self.project_name = project_name
+        self.owner = owner
+        self.repo = repo
+        self.approvers = approvers
+        self.branch_rules = branch_rules
+        self.environment_rules = environment_rules
+        self.status_checks = status_checks
+        self.code_owners = code_owners
+        self.branches = {}
+        for rule in branch_rules:
+            self.branches[rule.branch] = self.branches.get(rule.branch, ()) + (rule,)
+        self.environments = {rule.name: rule for rule in environment_rules}
+
+    def __reduce__(self):
+        return (
+            ProtocolPlan,
+            (
+                self.project_name,
+                self.owner,
+                self.repo,
+                self.approvers,
+                self.branch_rules,
+                self.environment_rules,
+                self.status_checks,
+                self.code_owners,
+            ),
+        )
+
+    # Same rules, different repository; the rule tuples are shared.
+    def for_repository(self, owner, repo):
+        plan = object.__new__(ProtocolPlan)
+        for name in ProtocolPlan.__slots__:
+            setattr(plan, name, getattr(self, name))
+        plan.owner = owner
+        plan.repo = repo
+        return plan
+
+    # Only the rules of the given branches and environments.
+    def restrict(self, branches, environments):
+        branches = set(branches)
+        environments = set(environments)
+        return ProtocolPlan(
+            self.project_name,
+            self.owner,
+            self.repo,
+            self.approvers,
+            tuple(rule for rule in self.branch_rules if rule.branch in branches),
+            tuple(rule for rule in self.environment_rules if rule.name in environments),
+            tuple(rule for rule in self.status_checks if rule.branch in branches),
+            (),
+        )
+
+
+def _invalid(path, message):
+    return ValueError(f"Invalid protocol: {path} {message}")
+
+
+def _section(mapping, key, path, kind, default):
+    value = mapping.get(key)
+    if value is None:
+        return default
+    if not isinstance(value, kind):
+        raise _invalid(f"{path}.{key}", f"must be a {'list' if kind is list else 'mapping'}")
+    return value
+
+
+def _entry(entries, index, path):
+    entry = entries[index]
+    if not isinstance(entry, dict):
+        raise _invalid(f"{path}[{index}]", "must be a mapping")
+    return entry
+
+
+def _string(entry, key, path):
+    value = entry.get(key)
+    if not isinstance(value, str) or not value:
+        raise _invalid(f"{path}.{key}", "must be a non-empty string")
+    return value
+
+
+def _integer(entry, key, path):
+    value = entry.get(key)
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise _invalid(f"{path}.{key}", "must be a non-negative integer")
+    return value
+
+
+def _boolean(entry, key, path):
+    value = entry.get(key)
+    if not isinstance(value, bool):
+        raise _invalid(f"{path}.{key}", "must be true or false")
+    return value
+
+
+def _strings(entry, key, path):
+    values = entry.get(key)
+    if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+        raise _invalid(f"{path}.{key}", "must be a list of strings")
+    return tuple(values)
+
+
+def _check_names(entry, path):
+    checks = entry.get("checks")
+    if not isinstance(checks, list):
+        raise _invalid(f"{path}.checks", "must be a list")
+    names = []
+    for index, check in enumerate(checks):
+        name = check.get("name") if isinstance(check, dict) else check
+        if not isinstance(name, str) or not name:
+            raise _invalid(f"{path}.checks[{index}]", "must be a check name")
+        names.append(name)
+    return names
+
+
+def compile_protocol(protocol):
+    if isinstance(protocol, ProtocolPlan):
+        return protocol
+    if not isinstance(protocol, dict) or not isinstance(protocol.get("protocol"), dict):
+        raise _invalid("protocol", "section is missing")
+    root = protocol["protocol"]
+
+    github = _section(root, "Github", "protocol", dict, {})
+    owner = github.get("organization")
+    repo = github.get("project")
+
+    approvers = []
+    entries = _section(root, "approvers", "protocol", list, [])
+    for index in range(len(entries)):
+        entry = _entry(entries, index, "protocol.approvers")
+        approvers.append((_string(entry, "name", f"protocol.approvers[{index}]"), entry.get("email")))
+
+    branch_rules = []
+    entries = _section(root, "branch_protection_rules", "protocol", list, [])
+    for index in range(len(entries)):
+        path = f"protocol.branch_protection_rules[{index}]"
+        entry = _entry(entries, index, "protocol.branch_protection_rules")
+        branch_rules.append(
+            BranchRule(
+                _string(entry, "branch", path),
+                _integer(entry, "required_reviewers", path),
+                _boolean(entry, "allow_force_push", path),
+                _boolean(entry, "allow_bypass", path),
+            )
+        )
+
+    environment_rules = []
+    entries = _section(root, "environments", "protocol", list, [])
+    for index in range(len(entries)):
+        path = f"protocol.environments[{index}]"
+        entry = _entry(entries, index, "protocol.environments")
+        environment_rules.append(
+            EnvironmentRule(
+                _string(entry, "name", path),
+                entry.get("branch"),
+                _integer(entry, "required_reviewers", path),
+                _strings(entry, "required_approvers", path),
+            )
+        )
+
+    # Duplicate branch entries are merged into one rule per branch.
+    checks_by_branch = {}
+    entries = _section(root, "required_status_checks", "protocol", list, [])
+    for index in range(len(entries)):
+        path = f"protocol.required_status_checks[{index}]"
+        entry = _entry(entries, index, "protocol.required_status_checks")
+        checks = checks_by_branch.setdefault(_string(entry, "branch", path), {})
+        checks.update(dict.fromkeys(_check_names(entry, path)))
+    status_checks = tuple(StatusCheckRule(branch, tuple(checks)) for branch, checks in checks_by_branch.items())
+
+    code_owners = []
+    entries = _section(root, "code_owners", "protocol", list, [])
+    for index in range(len(entries)):
+        path = f"protocol.code_owners[{index}]"
+        entry = _entry(entries, index, "protocol.code_owners")
+        code_owners.append(CodeOwnerRule(_string(entry, "path", path), _strings(entry, "owners", path)))
+
+    return ProtocolPlan(
+        root.get("project_name"),
+        owner,
+        repo,
+        tuple(approvers),
+        tuple(branch_rules),
+        tuple(environment_rules),
+        status_checks,
+        tuple(code_owners),
+    )
+
+
+# Loads and compiles a protocol file. With a cache_dir, the compiled plan is
+# pickled under the SHA-256 of the file's bytes, so an unchanged file is never
+# parsed again. The cache directory must only be writable by trusted users.
+@traced("load_plan")
+def load_plan(file_path, cache_dir=None):
+    try:
+        with open(file_path, "rb") as file:
+            content = file.read()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Protocol file not found: {file_path}")
+
+    cache_path = None
+    if cache_dir:
+        digest = hashlib.sha256(content).hexdigest()
+        cache_path = os.path.join(cache_dir, f"{digest}.v{PLAN_FORMAT_VERSION}.plan")
+        try:
+            with open(cache_path, "rb") as file:
+                return pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+
     try:
+        protocol = yaml.load(content, Loader=YAML_LOADER)
+    except yaml.YAMLError:
+        raise ValueError(f"Error parsing the protocol file: {file_path}")
+    plan = compile_protocol(protocol)
+
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        temporary = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            pickle.dump(plan, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, cache_path)
+    return plan
+
+
+# Protocol inheritance: a repository's override file is merged over an
+# org-level base (and any chain of "extends:" files, e.g. org -> team -> repo).
+# List sections are merged entry by entry on their key field, mappings are
+# merged recursively and any other value in the override replaces the base.
+PROTOCOL_MERGE_KEYS = {
+    "approvers": "name",
+    "environments": "name",
+    "branch_protection_rules": "branch",
+    "required_status_checks": "branch",
+    "code_owners": "path",
+}
+
+
+def _merge_entries(base, override, key):
+    merged = list(base)
+    positions = {entry.get(key): index for index, entry in enumerate(merged) if isinstance(entry, dict)}
+    for entry in override:
+        index = positions.get(entry.get(key)) if isinstance(entry, dict) else None
+        if index is None:
+            merged.append(entry)
+        else:
+            merged[index] = dict(merged[index], **entry)
+    return merged
+
+
+def merge_protocols(base, override):
+    merged = dict(base)
+    for key, value in override.items():
+        if key in PROTOCOL_MERGE_KEYS and isinstance(value, list) and isinstance(merged.get(key), list):
+            merged[key] = _merge_entries(merged[key], value, PROTOCOL_MERGE_KEYS[key])
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_protocols(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+# Resolves per-repository plans against a shared base. Every file is parsed
+# once per resolver, equal rules and rule tuples are interned, and plans with
+# the same rules share one rule tree, so a fleet of thousands of repositories
+# holds one copy of each distinct rule set.
+class ProtocolResolver:
+    def __init__(self, base_path=None, override_dir=None):
+        self.base_path = os.path.abspath(base_path) if base_path else None
+        self.override_dir = override_dir
+        self._documents = {}
+        self._interned = {}
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def _document(self, path, seen=()):
+        path = os.path.abspath(path)
+        if path in seen:
+            raise ValueError(f"Protocol inheritance cycle: {' -> '.join(seen + (path,))}")
+        if path not in self._documents:
+            self._documents[path] = self._load(path, seen)
+        return self._documents[path]
+
+    # Reads and merges one protocol file; each file is loaded once.
+    @traced("load_protocol")
+    def _load(self, path, seen):
+        try:
+            with open(path, "rb") as file:
+                document = yaml.load(file, Loader=YAML_LOADER)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Protocol file not found: {path}")
+        except yaml.YAMLError:
+            raise ValueError(f"Error parsing the protocol file: {path}")
+        if not isinstance(document, dict) or not isinstance(document.get("protocol", {}), dict):
+            raise ValueError(f"Error parsing the protocol file: {path} has no protocol section")
+        parent = document.get("extends")
+        if parent is not None:
+            parent = os.path.join(os.path.dirname(path), parent)
+        elif self.base_path and path != self.base_path:
+            parent = self.base_path
+        protocol = document.get("protocol", {})
+        if parent is not None:
+            protocol = merge_protocols(self._document(parent, seen + (path,)), protocol)
+        return protocol
+
+    def _intern(self, value):
+        return self._interned.setdefault(value, value)
+
+    def _share(self, plan):
+        approvers = self._intern(plan.approvers)
+        branch_rules = self._intern(tuple(self._intern(rule) for rule in plan.branch_rules))
+        environment_rules = self._intern(tuple(self._intern(rule) for rule in plan.environment_rules))
+        status_checks = self._intern(tuple(self._intern(rule) for rule in plan.status_checks))
+        code_owners = self._intern(tuple(self._intern(rule) for rule in plan.code_owners))
+        key = (plan.project_name, approvers, branch_rules, environment_rules, status_checks, code_owners)
+        shared = self._plans.get(key)
+        if shared is None:
+            shared = ProtocolPlan(
+                plan.project_name,
+                plan.owner,
+                plan.repo,
+                approvers,
+                branch_rules,
+                environment_rules,
+                status_checks,
+                code_owners,
+            )
+            self._plans[key] = shared
+        return shared.for_repository(plan.owner, plan.repo)
+
+    def plan(self, path, owner=None, repo=None):
+        with self._lock:
+            plan = self._share(compile_protocol({"protocol": self._document(path)}))
+        if owner and repo:
+            plan = plan.for_repository(owner, repo)
+        return plan
+
+    def override_path(self, owner, repo):
+        if not self.override_dir:
+            return None
+        for extension in (".yml", ".yaml"):
+            path = os.path.join(self.override_dir, owner, f"{repo}{extension}")
+            if os.path.exists(path):
+                return path
+        return None
+
+    # Caches are per process; a copy in another process starts empty.
+    def __reduce__(self):
+        return (ProtocolResolver, (self.base_path, self.override_dir))
+
+    def plan_for(self, owner, repo):
+        path = self.override_path(owner, repo) or self.base_path
+        if path is None:
+            raise ValueError(f"No protocol for {owner}/{repo}: no base protocol and no override file")
+        return self.plan(path, owner, repo)
+
+
+RETRY_STATUS_CODES = frozenset({500, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+
+# On-disk store of GET responses for conditional requests. Entries are keyed by
+# URL, Accept header and a hash of the Authorization header, so responses are
+# never shared between tokens. A file's mtime records when it was last used;
+# entries older than max_age are dropped, and the least recently used ones go
+# first once the cache grows beyond max_bytes.
+class ResponseCache:
+    def __init__(
+        self,
+        directory,
+        max_bytes=DEFAULT_CACHE_MAX_BYTES,
+        max_age=DEFAULT_CACHE_MAX_AGE,
+        clock=time.time,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.clock = clock
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def key(self, url, headers):
+        identity = hashlib.sha256(headers.get("Authorization", "").encode()).hexdigest()
+        accept = headers.get("Accept", "")
+        return hashlib.sha256(f"{identity}\n{accept}\n{url}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _entries(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if self.clock() - os.path.getmtime(path) > self.max_age:
+                self._remove(path)
+                return None
+            with open(path, "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def touch(self, key):
+        now = self.clock()
+        try:
+            os.utime(self._path(key), (now, now))
+        except OSError:
+            pass
+
+    def put(self, key, entry):
+        path = self._path(key)
+        data = json.dumps(entry)
+        with self._lock:
+            try:
+                self._size -= os.path.getsize(path)
+            except OSError:
+                pass
+            temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary, "w") as file:
+                file.write(data)
+            os.replace(temporary, path)
+            self._size += os.path.getsize(path)
+        self.touch(key)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _remove(self, path):
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                return
+            self._size -= size
+
+    def evict(self):
+        now = self.clock()
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        for path, _, mtime in entries:
+            if now - mtime > self.max_age:
+                self._remove(path)
+        for path, _, mtime in entries:
+            if self._size <= self.max_bytes:
+                break
+            if now - mtime <= self.max_age:
+                self._remove(path)
+
+
+def _response_from_cache(response, entry):
+    cached = requests.Response()
+    cached.status_code = 200
+    cached.url = response.url
+    cached.request = response.request
+    cached.headers.update(response.headers)
+    cached.headers["Content-Type"] = "application/json"
+    cached.encoding = "utf-8"
+    cached._content = entry["body"].encode("utf-8")
+    cached.from_cache = True
+    return cached
+
+
+class SystemClock:
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class _TokenBudget:
+    __slots__ = ("token", "remaining", "reset_at", "blocked_until", "allowance", "refilled_at")
+
+    def __init__(self, token, now, burst):
+        self.token = token
+        self.remaining = None  # unknown until GitHub reports it
+        self.reset_at = 0.0
+        self.blocked_until = 0.0
+        self.allowance = float(burst)
+        self.refilled_at = now
+
+    def available_at(self, now, rate):
+        start = max(now, self.blocked_until)
+        if self.remaining is not None and self.remaining <= 0:
+            start = max(start, self.reset_at)
+        if self.allowance < 1:
+            start = max(start, now + (1 - self.allowance) / rate)
+        return start
+
+
+# Hands out tokens from a pool so that each stays within its own budget:
+# a token bucket (rate/burst) paces requests per token, X-RateLimit-Remaining
+# and X-RateLimit-Reset park a token once its primary budget is spent, and
+# Retry-After (or GitHub's one-minute guidance for secondary limits) parks it
+# after a throttled response. acquire() prefers the token with the most budget
+# left and sleeps only when every token is parked.
+class RateLimitScheduler:
+    def __init__(self, tokens, rate=DEFAULT_TOKEN_RATE, burst=DEFAULT_TOKEN_BURST, clock=None):
+        if not tokens:
+            raise ValueError("RateLimitScheduler needs at least one token")
+        self.clock = clock or SystemClock()
+        self.rate = rate
+        self.burst = burst
+        self.waited = 0.0
+        now = self.clock.time()
+        self._budgets = {token: _TokenBudget(token, now, burst) for token in tokens}
+        self._lock = threading.Lock()
+
+    def _refill(self, budget, now):
+        budget.allowance = min(self.burst, budget.allowance + (now - budget.refilled_at) * self.rate)
+        budget.refilled_at = now
+        if budget.remaining is not None and budget.remaining <= 0 and now >= budget.reset_at:
+            budget.remaining = None
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = self.clock.time()
+                for budget in self._budgets.values():
+                    self._refill(budget, now)
+                ready = [budget for budget in self._budgets.values() if budget.available_at(now, self.rate) <= now]
+                if ready:
+                    budget = max(
+                        ready,
+                        key=lambda budget: (
+                            float("inf") if budget.remaining is None else budget.remaining,
+                            budget.allowance,
+                        ),
+                    )
+                    budget.allowance -= 1
+                    if budget.remaining is not None:
+                        budget.remaining -= 1
+                    return budget.token
+                wait = min(budget.available_at(now, self.rate) for budget in self._budgets.values()) - now
+                self.waited += wait
+            _count("gitverify_rate_limit_waits_total")
+            _count("gitverify_rate_limit_wait_seconds_total", wait)
+            self.clock.sleep(wait)
+
+    # Records the budget reported by a response; returns True when the
+    # request was rejected by a rate limit and should be sent again.
+    def update(self, token, response):
+        headers = response.headers
+        budget = self._budgets[token]
+        with self._lock:
+            now = self.clock.time()
+            if "X-RateLimit-Remaining" in headers:
+                budget.remaining = int(headers["X-RateLimit-Remaining"])
+            if "X-RateLimit-Reset" in headers:
+                budget.reset_at = float(headers["X-RateLimit-Reset"])
+            if response.status_code not in (403, 429):
+                return False
+            if "Retry-After" in headers:
+                budget.blocked_until = max(budget.blocked_until, now + float(headers["Retry-After"]))
+                return True
+            if budget.remaining == 0:
+                return True
+            if "rate limit" in response.text.lower():
+                budget.blocked_until = max(budget.blocked_until, now + SECONDARY_RATE_LIMIT_WAIT)
+                return True
+            return False
+
+
+# One pooled, keep-alive HTTP session shared by every GitHub call of a run.
+# Idempotent requests that hit a connection reset, a timeout or a 5xx are
+# retried with full-jitter exponential backoff. With a scheduler, every
+# request is sent with a token from its pool and rate-limited responses are
+# retried once the scheduler has a token available again.
+class GitHubClient:
+    def __init__(
+        self,
+        headers=None,
+        pool_connections=4,
+        pool_maxsize=DEFAULT_MAX_WORKERS,
+        timeout=(10, 30),
+        max_retries=3,
+        backoff_factor=0.5,
+        max_backoff=30,
+        verify=False,  # verify=False is used to ignore SSL certificate verification, due to ZScaler
+        sleep=time.sleep,
+        cache=None,
+        scheduler=None,
+        max_rate_limit_retries=5,
+    ):
+        self.cache = cache
+        self.scheduler = scheduler
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.session = requests.Session()
+        self.session.verify = verify
+        if headers:
+            self.session.headers.update(headers)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2**attempt))
+
+    def request(self, method, url, headers=None, **kwargs):
+        retryable = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        throttled = 0
+        while True:
+            token = None
+            request_headers = headers
+            if self.scheduler is not None:
+                token = self.scheduler.acquire()
+                request_headers = dict(headers or {}, Authorization=f"token {token}")
+            started = time.perf_counter() if METRICS is not None else None
+            try:
+                response = self.session.request(method, url, headers=request_headers, timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if started is not None:
+                    _observe_request(method, url, started, error=e)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                _count("gitverify_retries_total", reason="connection")
+            else:
+                if started is not None:
+                    _observe_request(method, url, started, response)
+                if token is not None and self.scheduler.update(token, response):
+                    if throttled < self.max_rate_limit_retries:
+                        response.close()
+                        throttled += 1
+                        _count("gitverify_retries_total", reason="rate_limit")
+                        continue
+                    return response
+                if response.status_code not in RETRY_STATUS_CODES or not retryable or attempt >= self.max_retries:
+                    return response
+                response.close()
+                _count("gitverify_retries_total", reason="status")
+            self.sleep(self.backoff(attempt))
+            attempt += 1
+
+    # With a cache, GETs are sent with If-None-Match/If-Modified-Since and a
+    # 304 is answered from the stored body. 304s do not count against
+    # GitHub's rate limit.
+    def get(self, url, headers=None, **kwargs):
+        if self.cache is None:
+            return self.request("GET", url, headers=headers, **kwargs)
+
+        request_headers = dict(self.session.headers)
+        request_headers.update(headers or {})
+        key = self.cache.key(url, request_headers)
+        entry = self.cache.get(key)
+        if entry is not None:
+            request_headers = dict(headers or {})
+            if entry.get("etag"):
+                request_headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                request_headers["If-Modified-Since"] = entry["last_modified"]
+            headers = request_headers
+
+        response = self.request("GET", url, headers=headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self.cache.touch(key)
+            _count("gitverify_cache_hits_total")
+            return _response_from_cache(response, entry)
+        if response.status_code == 200:
+            _count("gitverify_cache_misses_total")
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if etag or last_modified:
+                self.cache.put(
+                    key,
+                    {"url": url, "etag": etag, "last_modified": last_modified, "body": response.text},
+                )
+        return response
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Offline snapshots. SnapshotRecorder wraps a client and stores every
+# response it returns in a SnapshotWriter; SnapshotClient answers the same
+# requests from the snapshot without any network access, so a run can be
+# repeated against the exact settings seen when it was captured.
+#
+# A snapshot is one file: SNAPSHOT_MAGIC, then one zlib-compressed entry per
+# response (a JSON line with status and headers, then the body), then the
+# compressed JSON index {key: [offset, length]}, then a trailer with the
+# index's offset and length. Readers mmap the file and inflate only the
+# entries they are asked for. Entries are keyed by method, path and query,
+# and the payload hash for POSTs, never by host or token.
+SNAPSHOT_MAGIC = b"GVSNAP1\n"
+SNAPSHOT_HEADERS = ("Content-Type", "ETag", "Last-Modified", "Link")
+_SNAPSHOT_TRAILER = struct.Struct("<QQ8s")
+
+
+def snapshot_key(method, url, payload=None):
+    split = urllib.parse.urlsplit(url)
+    key = f"{method.upper()} {split.path}"
+    if split.query:
+        key += f"?{split.query}"
+    if payload is not None:
+        key += " " + hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+    return key
+
+
+class SnapshotWriter:
+    def __init__(self, path, level=6):
+        self.path = path
+        self.level = level
+        self.lock = threading.Lock()
+        self.index = {}
+        self.file = open(f"{path}.tmp", "wb")
+        self.file.write(SNAPSHOT_MAGIC)
+        self.offset = len(SNAPSHOT_MAGIC)
+        self.captured_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def add(self, key, response):
+        headers = {name: response.headers[name] for name in SNAPSHOT_HEADERS if name in response.headers}
+        meta = json.dumps({"status": response.status_code, "headers": headers}).encode()
+        entry = zlib.compress(meta + b"\n" + response.content, self.level)
+        with self.lock:
+            self.file.write(entry)
+            self.index[key] = [self.offset, len(entry)]
+            self.offset += len(entry)
+
+    # Writes the index and moves the file into place; until then a reader
+    # never sees a half-written snapshot.
+    def close(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            index = zlib.compress(json.dumps({"captured_at": self.captured_at, "entries": self.index}).encode())
+            self.file.write(index)
+            self.file.write(_SNAPSHOT_TRAILER.pack(self.offset, len(index), SNAPSHOT_MAGIC))
+            self.file.close()
+            os.replace(f"{self.path}.tmp", self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Snapshot:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < len(SNAPSHOT_MAGIC) + _SNAPSHOT_TRAILER.size or self.map[:8] != SNAPSHOT_MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a gitverify snapshot")
+        offset, length, magic = _SNAPSHOT_TRAILER.unpack(self.map[-_SNAPSHOT_TRAILER.size :])
+        if magic != SNAPSHOT_MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a gitverify snapshot")
+        index = json.loads(zlib.decompress(self.map[offset : offset + length]))
+        self.captured_at = index["captured_at"]
+        self.index = index["entries"]
+
+    # (status, headers, body) of a captured response, or None.
+    def get(self, key):
+        location = self.index.get(key)
+        if location is None:
+            return None
+        offset, length = location
+        meta, body = zlib.decompress(self.map[offset : offset + length]).split(b"\n", 1)
+        meta = json.loads(meta)
+        return meta["status"], meta["headers"], body
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SnapshotRecorder:
+    def __init__(self, client, writer):
+        self.client = client
+        self.writer = writer
+
+    def request(self, method, url, headers=None, **kwargs):
+        response = self.client.request(method, url, headers=headers, **kwargs)
+        self.writer.add(snapshot_key(method, url, kwargs.get("json")), response)
+        return response
+
+    def get(self, url, headers=None, **kwargs):
+        response = self.client.get(url, headers=headers, **kwargs)
+        self.writer.add(snapshot_key("GET", url), response)
+        return response
+
+    def close(self):
+        self.client.close()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Requests missing from the snapshot fail like a dropped connection, so the
+# fetchers report them as usual.
+class SnapshotClient:
+    def __init__(self, snapshot):
+        self.snapshot = Snapshot(snapshot) if isinstance(snapshot, str) else snapshot
+
+    def request(self, method, url, headers=None, **kwargs):
+        entry = self.snapshot.get(snapshot_key(method, url, kwargs.get("json")))
+        if entry is None:
+            raise requests.exceptions.ConnectionError(f"{method.upper()} {url} is not in snapshot {self.snapshot.path}")
+        response = requests.Response()
+        response.status_code, headers, response._content = entry
+        response._content_consumed = True
+        response.headers.update(headers)
+        response.url = url
+        return response
+
+    def get(self, url, headers=None, **kwargs):
+        return self.request("GET", url, headers=headers, **kwargs)
+
+    def close(self):
+        self.snapshot.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _github_get(url, headers, client=None):
+    if client is None:
+        started = time.perf_counter() if METRICS is not None else None
         response = requests.get(
             url, headers=headers, verify=False
         )  # verify=False is used to ignore SSL certificate verification, due to ZScaler
+        if started is not None:
+            _observe_request("GET", url, started, response)
+        return response
+    return client.get(url, headers=headers)
+
+
+def _github_post(url, headers, payload, client=None):
+    if client is None:
+        started = time.perf_counter() if METRICS is not None else None
+        response = requests.post(
+            url, headers=headers, json=payload, verify=False
+        )  # verify=False is used to ignore SSL certificate verification, due to ZScaler
+        if started is not None:
+            _observe_request("POST", url, started, response)
+        return response
+    return client.request("POST", url, headers=headers, json=payload)
+
+
+# Verification of branch protection rules
+@traced("get_branch_protection_rules")
+def get_branch_protection_rules(owner, repo, branch, headers, client=None):
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/branches/{branch}/protection"
+    try:
+        response = _github_get(url, headers, client)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -29,128 +1239,2901 @@ def get_branch_protection_rules(owner, repo, branch, headers):
 
 
 # Verification of environment protection rules
-def get_environment_protection_rules(owner, repo, environment, headers):
-    url = f"https://api.github.com/repos/{owner}/{repo}/environments/{environment}/protection"
+@traced("get_environment_protection_rules")
+def get_environment_protection_rules(owner, repo, environment, headers, client=None):
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/environments/{environment}/protection"
     try:
-        response = requests.get(
-            url, headers=headers, verify=False
-        )  # verify=False is used to ignore SSL certificate verification, due to ZScaler
+        response = _github_get(url, headers, client)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
         raise ConnectionError(f"Error fetching environment protection rules: {e}")
 
 
-def verify_environment_protection(protocol, headers):
-    results = {}
-    for environment in protocol["protocol"]["environments"]:
-        env_name = environment["name"]
-        required_reviewers = environment["required_reviewers"]
-        required_approvers = environment["required_approvers"]
-
-        env_protection = get_environment_protection_rules(
-            protocol["protocol"]["Github"]["organization"],
-            protocol["protocol"]["Github"]["project"],
-            env_name,
-            headers,
-        )
+def evaluate_environment_rule(environment, env_protection):
+    return {
+        "required_reviewers": env_protection["required_reviewers"] >= environment["required_reviewers"],
+        "required_approvers": all(
+            approver in env_protection["approvers"] for approver in environment["required_approvers"]
+        ),
+    }
 
-        results[env_name] = {
-            "required_reviewers": env_protection["required_reviewers"] >= required_reviewers,
-            "required_approvers": all(approver in env_protection["approvers"] for approver in required_approvers),
-        }
-    return results
 
+def evaluate_branch_rule(rule, branch_protection):
+    return {
+        "required_reviewers": branch_protection["required_pull_request_reviews"][
+            "required_approving_review_count"
+        ]
+        >= rule["required_reviewers"],
+        "allow_force_push": branch_protection["allow_force_pushes"]["enabled"]
+        == rule["allow_force_push"],
+        "allow_bypass": branch_protection["enforce_admins"]["enabled"]
+        == rule["allow_bypass"],
+    }
 
-def verify_branch_protection(protocol, headers):
-    results = {}
-    for rule in protocol["protocol"]["branch_protection_rules"]:
-        branch = rule["branch"]
-        required_reviewers = rule["required_reviewers"]
-        allow_force_push = rule["allow_force_push"]
-        allow_bypass = rule["allow_bypass"]
-
-        branch_protection = get_branch_protection_rules(
-            protocol["protocol"]["Github"]["organization"],
-            protocol["protocol"]["Github"]["project"],
-            branch,
-            headers,
-        )
 
-        results[branch] = {
-            "required_reviewers": branch_protection["required_pull_request_reviews"][
-                "required_approving_review_count"
-            ]
-            >= required_reviewers,
-            "allow_force_push": branch_protection["allow_force_pushes"]["enabled"]
-            == allow_force_push,
-            "allow_bypass": branch_protection["enforce_admins"]["enabled"]
-            == allow_bypass,
-        }
+# The branch's required contexts (classic "contexts" and app-bound "checks")
+# must include every check the protocol names; extra ones are allowed.
+def evaluate_status_check_rule(rule, branch_protection):
+    required = branch_protection.get("required_status_checks") or {}
+    configured = set(required.get("contexts") or ())
+    configured.update(check["context"] for check in required.get("checks") or ())
+    return {"required_status_checks": set(rule["checks"]) <= configured}
 
-    env_results = verify_environment_protection(protocol, headers)
-    results.update(env_results)
 
-    return results
+# CODEOWNERS verification. GitHub uses the first of these files that exists.
+CODEOWNERS_LOCATIONS = (".github/CODEOWNERS", "CODEOWNERS", "docs/CODEOWNERS")
 
 
-def report_results(results, format="text"):
-    report = {
-        "verification_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "repository": f"{REPO_OWNER}/{REPO_NAME}",
-        "results": results,
-    }
+def _codeowners_location(tree):
+    paths = {path for path, kind in tree if kind == "blob"}
+    return next((location for location in CODEOWNERS_LOCATIONS if location in paths), None)
+
+
+def _git_tree(owner, repo, sha, headers, client=None, recursive=True):
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/trees/{sha}" + ("?recursive=1" if recursive else "")
+    response = _github_get(url, headers, client)
+    response.raise_for_status()
+    return response.json()
+
+
+# [[path, type], ...] for every entry below `sha`. GitHub cuts recursive
+# listings off at its size limit and marks them truncated; such a tree is
+# listed one level deep instead, and each of its subtrees on its own.
+def _tree_entries(owner, repo, sha, headers, client=None, prefix=""):
+    tree = _git_tree(owner, repo, sha, headers, client)
+    if not tree.get("truncated"):
+        return [[prefix + entry["path"], entry["type"]] for entry in tree["tree"]]
+    tree = _git_tree(owner, repo, sha, headers, client, recursive=False)
+    if tree.get("truncated"):
+        raise ConnectionError(f"Error fetching CODEOWNERS: the tree listing of {prefix or '/'} is truncated")
+    entries = []
+    for entry in tree["tree"]:
+        path = prefix + entry["path"]
+        entries.append([path, entry["type"]])
+        if entry["type"] == "tree":
+            entries += _tree_entries(owner, repo, entry["sha"], headers, client, path + "/")
+    return entries
+
+
+# One tree listing (more for trees too large to list at once) and, if the
+# listing has a CODEOWNERS file, one contents request. Returns
+# {"codeowners": text or None, "tree": [[path, type], ...]}.
+def get_code_owners(owner, repo, headers, client=None, ref="HEAD"):
+    try:
+        tree = _tree_entries(owner, repo, ref, headers, client)
+        location = _codeowners_location(tree)
+        text = None
+        if location is not None:
+            response = _github_get(f"{GITHUB_API_URL}/repos/{owner}/{repo}/contents/{location}", headers, client)
+            response.raise_for_status()
+            text = base64.b64decode(response.json()["content"]).decode()
+        return {"codeowners": text, "tree": tree}
+    except requests.exceptions.RequestException as e:
+        raise ConnectionError(f"Error fetching CODEOWNERS: {e}")
+
 
-    if format == "json":
-        with open("verification_report.json", "w") as file:
-            json.dump(report, file, indent=4)
-    elif format == "html":
-        with open("verification_report.html", "w") as file:
-            file.write("<html><body><h1>Verification Report</h1>")
-            file.write(f"<p>Date: {report['verification_date']}</p>")
-            file.write(f"<p>Repository: {report['repository']}</p>")
-            file.write("<ul>")
-            for branch, branch_results in results.items():
-                file.write(f"<li>Branch: {branch}<ul>")
-                for key, value in branch_results.items():
-                    status = "PASS" if value else "FAIL"
-                    file.write(f"<li>{key}: {status}</li>")
-                file.write("</ul></li>")
-            file.write("</ul></body></html>")
-    elif format == "markdown":
-        with open("verification_report.md", "w") as file:
-            file.write("# Verification Report\n")
-            file.write(f"**Date:** {report['verification_date']}\n")
-            file.write(f"**Repository:** {report['repository']}\n")
-            for branch, branch_results in results.items():
-                file.write(f"## Branch: {branch}\n")
-                for key, value in branch_results.items():
-                    status = "PASS" if value else "FAIL"
-                    file.write(f"- **{key}:** {status}\n")
+def code_owners_resource():
+    return "codeowners"
+
+
+class _OwnerNode:
+    __slots__ = ("children", "index", "directory_index", "globs")
+
+    def __init__(self):
+        self.children = {}
+        self.index = -1
+        self.directory_index = -1
+        self.globs = []
+
+
+_GLOB = re.compile(r"[*?\[]")
+
+
+# Path-style glob: "*" and "?" stop at "/", "**" crosses it and "**/" also
+# matches no directory at all.
+def _glob_regex(body):
+    parts = []
+    position = 0
+    while position < len(body):
+        if body.startswith("**/", position):
+            parts.append("(?:.*/)?")
+            position += 3
+        elif body.startswith("**", position):
+            parts.append(".*")
+            position += 2
+        elif body[position] == "*":
+            parts.append("[^/]*")
+            position += 1
+        elif body[position] == "?":
+            parts.append("[^/]")
+            position += 1
+        elif body[position] == "[" and body.find("]", position + 1) > 0:
+            end = body.find("]", position + 1)
+            members = body[position + 1 : end].replace("\\", "\\\\")
+            parts.append("[" + ("^" + members[1:] if members.startswith("!") else members) + "]")
+            position = end + 1
+        else:
+            parts.append(re.escape(body[position]))
+            position += 1
+    return "".join(parts)
+
+
+def _codeowners_regex(body, anchored, directory_only):
+    prefix = "" if anchored else "(?:.*/)?"
+    # Unlike gitignore, "docs/*" owns only the files directly in docs/.
+    if directory_only:
+        suffix = "/.*"
+    elif body.endswith("/*") and not body.endswith("**/*"):
+        suffix = ""
     else:
-        for branch, branch_results in results.items():
-            print(f"Branch: {branch}")
-            for key, value in branch_results.items():
-                status = "PASS" if value else "FAIL"
-                print(f"{key}: {status}")
+        suffix = "(?:/.*)?"
+    return re.compile(prefix + _glob_regex(body) + suffix + r"\Z")
 
 
-if __name__ == "__main__":
-    GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-    if not GITHUB_TOKEN:
-        raise EnvironmentError("GITHUB_TOKEN environment variable is not set")
+# CODEOWNERS rules compiled for lookups by path; the last matching rule wins.
+# Plain paths go into a trie keyed by path component, plain names (matched at
+# any depth) and "*.ext" patterns into dicts. The remaining globs become
+# regexes, kept at the trie node of their literal leading directories (or at
+# the root when they have none), so a path only tries the globs under its own
+# prefix: from the last rule backwards, while they could still beat the best
+# match found so far. A pattern that matches a directory
+# matches everything below it; one ending in "/" matches only directories.
+class CodeOwners:
+    def __init__(self, rules):
+        self.rules = rules
+        self.root = _OwnerNode()
+        self.names = {}
+        self.directory_names = {}
+        self.extensions = {}
+        for index, (pattern, _) in enumerate(rules):
+            self._add(index, pattern)
 
-    REPO_OWNER = "bidma-nn"
-    REPO_NAME = "SQZC_Sandbox"
+    @classmethod
+    def parse(cls, text):
+        rules = []
+        for line in text.splitlines():
+            fields = line.split(" #", 1)[0].split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            pattern = fields[0][1:] if fields[0].startswith("\\#") else fields[0]
+            rules.append((pattern, tuple(fields[1:])))
+        return cls(rules)
 
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json",
+    def _add(self, index, pattern):
+        directory_only = pattern.endswith("/")
+        body = pattern.strip("/")
+        anchored = pattern.startswith("/") or "/" in body
+        if not body:
+            self.root.index = index
+        elif _GLOB.search(body) is None and anchored:
+            node = self.root
+            for part in body.split("/"):
+                node = node.children.setdefault(part, _OwnerNode())
+            if directory_only:
+                node.directory_index = index
+            else:
+                node.index = index
+        elif _GLOB.search(body) is None:
+            (self.directory_names if directory_only else self.names)[body] = index
+        elif not anchored and not directory_only and body.startswith("*.") and _GLOB.search(body[1:]) is None:
+            self.extensions[body[1:]] = index
+        else:
+            node = self.root
+            if anchored:
+                for part in body.split("/")[:-1]:
+                    if _GLOB.search(part) is not None:
+                        break
+                    node = node.children.setdefault(part, _OwnerNode())
+            node.globs.append((index, _codeowners_regex(body, anchored, directory_only)))
+
+    # Index of the rule that owns `path` (relative to the repository root),
+    # or -1. With directory=True the path is a directory itself.
+    def match(self, path, directory=False):
+        path = path.strip("/")
+        parts = path.split("/") if path else []
+        best = self.root.index
+        node = self.root
+        globs = list(node.globs)
+        last = len(parts) - 1
+        for depth, part in enumerate(parts):
+            contains = directory or depth < last
+            best = max(best, self.names.get(part, -1))
+            if contains:
+                best = max(best, self.directory_names.get(part, -1))
+            if self.extensions:
+                dot = part.find(".", 1)
+                while dot > 0:
+                    best = max(best, self.extensions.get(part[dot:], -1))
+                    dot = part.find(".", dot + 1)
+            if node is not None:
+                node = node.children.get(part)
+                if node is not None:
+                    best = max(best, node.index, node.directory_index if contains else -1)
+                    globs += node.globs
+        subject = path + "/" if directory else path
+        globs.sort(reverse=True)
+        for index, regex in globs:
+            if index <= best:
+                break
+            if regex.match(subject):
+                return index
+        return best
+
+    def owners(self, path, directory=False):
+        index = self.match(path, directory)
+        return self.rules[index][1] if index >= 0 else ()
+
+    def owners_for(self, paths):
+        return {path: self.owners(path) for path in paths}
+
+
+# Each protocol path passes when its effective owners include the listed
+# ones (team and user names compare case-insensitively); "CODEOWNERS" records
+# whether every file in the tree listing has an owner.
+def evaluate_code_owners(plan, code_owners):
+    text = code_owners["codeowners"]
+    matcher = CodeOwners.parse(text or "")
+    directories = {path for path, kind in code_owners["tree"] if kind == "tree"}
+    results = {}
+    for rule in plan.code_owners:
+        path = rule.path.strip("/")
+        directory = not path or rule.path.endswith("/") or path in directories
+        owners = {owner.lower() for owner in matcher.owners(path, directory)}
+        results[rule.path] = {"code_owners": text is not None and {owner.lower() for owner in rule.owners} <= owners}
+    results["CODEOWNERS"] = {
+        "all_files_owned": text is not None
+        and all(matcher.match(path) >= 0 for path, kind in code_owners["tree"] if kind == "blob")
     }
+    return results
+
+
+# Stand-in for a Future that runs the call once, when its result is first
+# requested, so the serial path still fetches (and fails) one rule at a time.
+class _Deferred:
+    __slots__ = ("fn", "args", "_lock", "_done", "_result", "_exception")
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+        self._lock = threading.Lock()
+        self._done = False
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        with self._lock:
+            if not self._done:
+                try:
+                    self._result = self.fn(*self.args)
+                except Exception as e:
+                    self._exception = e
+                self._done = True
+                self.fn = self.args = None
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+def _submit(executor, fn, *args):
+    if executor is None:
+        return _Deferred(fn, *args)
+    return executor.submit(fn, *args)
+
+
+# Per-run memo of protection lookups keyed by (owner, repo, resource), shared
+# by every verifier of a run. Concurrent lookups of the same key share one
+# in-flight future, so each document is fetched at most once per run,
+# failures included.
+class ProtectionMemo:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def submit(self, key, executor, fn, *args):
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None:
+                future = _submit(executor, fn, *args)
+                self._futures[key] = future
+        return future
+
+    def get(self, key, fn, *args):
+        return self.submit(key, None, fn, *args).result()
+
+    # Drops the given lookups so that the next submit fetches them again.
+    def forget(self, keys):
+        with self._lock:
+            for key in keys:
+                self._futures.pop(key, None)
+
+    def failed(self):
+        with self._lock:
+            futures = list(self._futures.items())
+        for key, future in futures:
+            if future.done():
+                try:
+                    future.result()
+                except Exception:
+                    yield key
+
+    def futures(self):
+        with self._lock:
+            return list(self._futures.values())
+
+    def documents(self):
+        with self._lock:
+            futures = list(self._futures.items())
+        for key, future in futures:
+            if future.done():
+                try:
+                    yield key, future.result()
+                except Exception:
+                    continue
+
+    def __len__(self):
+        return len(self._futures)
+
+
+def branch_protection_resource(branch):
+    return f"branches/{branch}/protection"
+
+
+# A branch_protection_rules entry such as "release/*" covers every branch
+# whose name matches it. As in GitHub's own rule patterns, "*" does not match
+# "/": "release/*" covers release/1.0 but not release/1.0/fix, which
+# "release/**" does.
+def is_branch_pattern(branch):
+    return any(character in branch for character in "*?[")
+
+
+@functools.lru_cache(maxsize=None)
+def _branch_pattern_regex(pattern):
+    return re.compile(_glob_regex(pattern) + r"\Z")
+
+
+def branch_matches(branch, pattern):
+    return _branch_pattern_regex(pattern).match(branch) is not None
+
+
+def _branch_page(url, headers, client=None):
+    try:
+        response = _github_get(url, headers, client)
+        response.raise_for_status()
+        return response
+    except requests.exceptions.RequestException as e:
+        raise ConnectionError(f"Error listing branches: {e}")
+
+
+def _branch_page_items(url, headers, client=None):
+    return _branch_page(url, headers, client).json()
+
+
+def _last_page(response):
+    url = response.links.get("last", {}).get("url")
+    if url is None:
+        return None
+    page = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get("page")
+    return int(page[0]) if page else None
+
+
+# The repository's branches ({"name": ..., "protected": ...}), yielded page by
+# page as they arrive. Once the first page's Link header gives the page
+# count, the remaining pages are fetched on the executor, at most `window`
+# ahead of the one being consumed; otherwise (or without an executor) the
+# "next" links are followed one page at a time. No more than `window` pages
+# are held in memory.
+def iter_branches(owner, repo, headers, client=None, executor=None, window=BRANCH_PAGE_WINDOW):
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/branches?per_page={BRANCH_PAGE_SIZE}"
+    response = _branch_page(url, headers, client)
+    yield from response.json()
+    last = _last_page(response)
+    if executor is None or last is None:
+        url = response.links.get("next", {}).get("url")
+        while url:
+            response = _branch_page(url, headers, client)
+            yield from response.json()
+            url = response.links.get("next", {}).get("url")
+        return
+    pages = (f"{url}&page={page}" for page in range(2, last + 1))
+    in_flight = collections.deque(
+        executor.submit(_branch_page_items, page_url, headers, client) for page_url in itertools.islice(pages, window)
+    )
+    while in_flight:
+        items = in_flight.popleft().result()
+        in_flight.extend(
+            executor.submit(_branch_page_items, page_url, headers, client) for page_url in itertools.islice(pages, 1)
+        )
+        yield from items
+
+
+# GitHub has no protection document for an unprotected branch (the request
+# fails with 404); it is evaluated as this one: no reviews, force pushes
+# allowed, admins not enforced.
+def unprotected_branch_protection():
+    return {
+        "required_pull_request_reviews": {"required_approving_review_count": 0},
+        "allow_force_pushes": {"enabled": True},
+        "enforce_admins": {"enabled": False},
+    }
+
+
+def environment_protection_resource(environment):
+    return f"environments/{environment}/protection"
+
+
+def _repository(plan):
+    if not plan.owner or not plan.repo:
+        raise _invalid("protocol.Github", "must name the organization and project to verify")
+    return plan.owner, plan.repo
+
+
+def _submit_environment_fetches(plan, headers, executor=None, client=None, memo=None, fetch=None):
+    owner, repo = _repository(plan)
+    memo = ProtectionMemo() if memo is None else memo
+    return [
+        (
+            environment,
+            memo.submit(
+                (owner, repo, environment_protection_resource(environment["name"])),
+                executor,
+                fetch or get_environment_protection_rules,
+                owner,
+                repo,
+                environment["name"],
+                headers,
+                client,
+            ),
+        )
+        for environment in plan.environment_rules
+    ]
+
+
+def _submit_branch_fetches(plan, headers, executor=None, client=None, memo=None, fetch=None):
+    owner, repo = _repository(plan)
+    memo = ProtectionMemo() if memo is None else memo
+    pending = [
+        (
+            rule,
+            memo.submit(
+                (owner, repo, branch_protection_resource(rule["branch"])),
+                executor,
+                fetch or get_branch_protection_rules,
+                owner,
+                repo,
+                rule["branch"],
+                headers,
+                client,
+            ),
+        )
+        for rule in plan.branch_rules
+        if not is_branch_pattern(rule.branch)
+    ]
+    if fetch is None:
+        pending.extend(_submit_branch_pattern_fetches(plan, headers, executor, client, memo))
+    elif any(is_branch_pattern(rule.branch) for rule in plan.branch_rules):
+        # On the async API, one task lists the branches and fetches the
+        # matching ones; it resolves to their (rule, protection) pairs.
+        future = memo.submit(
+            (owner, repo, "branches"),
+            executor,
+            _branch_pattern_protection_async,
+            plan,
+            headers,
+            executor,
+            client,
+            memo,
+            fetch,
+        )
+        pending.append((plan, future))
+    return pending
+
+
+# Each listed branch matching a pattern rule (and not named by an exact rule)
+# gets that rule, the first matching pattern winning.
+def _branch_pattern_rule(plan, patterns, name):
+    if name in plan.branches:
+        return None
+    rule = next((rule for rule in patterns if branch_matches(name, rule.branch)), None)
+    if rule is None:
+        return None
+    return BranchRule(name, rule.required_reviewers, rule.allow_force_push, rule.allow_bypass)
+
+
+# A matching branch's protection fetch is submitted as soon as its page
+# arrives, while later pages are still loading.
+def _submit_branch_pattern_fetches(plan, headers, executor, client, memo):
+    patterns = [rule for rule in plan.branch_rules if is_branch_pattern(rule.branch)]
+    if not patterns:
+        return []
+    owner, repo = _repository(plan)
+    pending = []
+    for branch in iter_branches(owner, repo, headers, client, executor):
+        name = branch["name"]
+        rule = _branch_pattern_rule(plan, patterns, name)
+        if rule is None:
+            continue
+        key = (owner, repo, branch_protection_resource(name))
+        if branch.get("protected", True):
+            future = memo.submit(key, executor, get_branch_protection_rules, owner, repo, name, headers, client)
+        else:
+            future = memo.submit(key, None, unprotected_branch_protection)
+        pending.append((rule, future))
+    return pending
+
+
+# Status checks are read from the same branch protection document as the
+# branch's protection rule, so through a shared memo they cost no request.
+def _submit_status_check_fetches(plan, headers, executor=None, client=None, memo=None, fetch=None):
+    owner, repo = _repository(plan)
+    memo = ProtectionMemo() if memo is None else memo
+    return [
+        (
+            rule,
+            memo.submit(
+                (owner, repo, branch_protection_resource(rule["branch"])),
+                executor,
+                fetch or get_branch_protection_rules,
+                owner,
+                repo,
+                rule["branch"],
+                headers,
+                client,
+            ),
+        )
+        for rule in plan.status_checks
+    ]
+
+
+# The tree listing and CODEOWNERS file are fetched once per repository, and
+# only when the plan has code_owners rules.
+def _submit_code_owner_fetches(plan, headers, executor=None, client=None, memo=None, fetch=None):
+    owner, repo = _repository(plan)
+    if not plan.code_owners:
+        return []
+    memo = ProtectionMemo() if memo is None else memo
+    future = memo.submit(
+        (owner, repo, code_owners_resource()), executor, fetch or get_code_owners, owner, repo, headers, client
+    )
+    return [(plan, future)]
+
+
+def _evaluate_code_owners(pending, results=None):
+    results = {} if results is None else results
+    for plan, future in pending:
+        results.update(evaluate_code_owners(plan, future.result()))
+    return results
+
+
+def _evaluate_environments(pending):
+    results = {}
+    for environment, future in pending:
+        results[environment["name"]] = evaluate_environment_rule(environment, future.result())
+    return results
+
+
+def _evaluate_branches(pending):
+    results = {}
+    for rule, future in pending:
+        if isinstance(rule, ProtocolPlan):
+            for branch_rule, protection in future.result():
+                results[branch_rule["branch"]] = evaluate_branch_rule(branch_rule, protection)
+        else:
+            results[rule["branch"]] = evaluate_branch_rule(rule, future.result())
+    return results
+
+
+def _evaluate_status_checks(pending, results=None):
+    results = {} if results is None else results
+    for rule, future in pending:
+        results.setdefault(rule["branch"], {}).update(evaluate_status_check_rule(rule, future.result()))
+    return results
+
+
+# protocol may be the loaded protocol mapping or a compiled ProtocolPlan.
+@traced("verify_environment_protection")
+def verify_environment_protection(protocol, headers, executor=None, client=None, memo=None):
+    plan = compile_protocol(protocol)
+    return _evaluate_environments(_submit_environment_fetches(plan, headers, executor, client, memo))
+
+
+@traced("verify_status_checks")
+def verify_status_checks(protocol, headers, executor=None, client=None, memo=None):
+    plan = compile_protocol(protocol)
+    return _evaluate_status_checks(_submit_status_check_fetches(plan, headers, executor, client, memo))
+
+
+@traced("verify_code_owners")
+def verify_code_owners(protocol, headers, executor=None, client=None, memo=None):
+    plan = compile_protocol(protocol)
+    return _evaluate_code_owners(_submit_code_owner_fetches(plan, headers, executor, client, memo))
+
+
+@traced("verify_branch_protection")
+def verify_branch_protection(protocol, headers, executor=None, client=None, memo=None):
+    plan = compile_protocol(protocol)
+    memo = ProtectionMemo() if memo is None else memo
+    branches = _submit_branch_fetches(plan, headers, executor, client, memo)
+    status_checks = _submit_status_check_fetches(plan, headers, executor, client, memo)
+    environments = _submit_environment_fetches(plan, headers, executor, client, memo)
+    code_owners = _submit_code_owner_fetches(plan, headers, executor, client, memo)
+    results = _evaluate_branches(branches)
+    _evaluate_status_checks(status_checks, results)
+    _evaluate_code_owners(code_owners, results)
+
+    env_results = _evaluate_environments(environments)
+    results.update(env_results)
+
+    return results
+
+
+# GraphQL backend: every branch protection rule and environment of a
+# repository in one query, mapped onto the REST-shaped documents the
+# evaluate_* functions expect.
+GRAPHQL_PROTECTION_FRAGMENT = """
+fragment ProtectionFields on Repository {
+  branchProtectionRules(first: 100) {
+    nodes {
+      pattern
+      requiredApprovingReviewCount
+      allowsForcePushes
+      isAdminEnforced
+      requiredStatusCheckContexts
+    }
+  }
+  environments(first: 100) {
+    nodes {
+      name
+      protectionRules(first: 10) {
+        nodes {
+          type
+          reviewers(first: 100) {
+            nodes {
+              ... on User { login name }
+              ... on Team { slug name }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+def _graphql_query(headers, query, client=None, variables=None):
+    url = f"{GITHUB_API_URL}/graphql"
+    try:
+        response = _github_post(url, headers, {"query": query, "variables": variables or {}}, client)
+        response.raise_for_status()
+        payload = response.json()
+    except requests.exceptions.RequestException as e:
+        raise ConnectionError(f"Error fetching protection rules via GraphQL: {e}")
+    if payload.get("data") is None:
+        messages = "; ".join(error.get("message", "") for error in payload.get("errors", []))
+        raise ConnectionError(f"Error fetching protection rules via GraphQL: {messages}")
+    return payload
+
+
+def _graphql_errors_by_alias(payload):
+    errors = {}
+    for error in payload.get("errors", []):
+        alias = (error.get("path") or [None])[0]
+        errors.setdefault(alias, error.get("message", ""))
+    return errors
+
+
+def branch_protection_from_graphql(node):
+    return {
+        "pattern": node["pattern"],
+        "required_pull_request_reviews": {
+            "required_approving_review_count": node["requiredApprovingReviewCount"] or 0
+        },
+        "allow_force_pushes": {"enabled": node["allowsForcePushes"]},
+        "enforce_admins": {"enabled": node["isAdminEnforced"]},
+        "required_status_checks": {"contexts": node["requiredStatusCheckContexts"] or []},
+    }
+
+
+def environment_protection_from_graphql(node):
+    reviewers = [
+        reviewer
+        for rule in node["protectionRules"]["nodes"]
+        if rule["type"] == "REQUIRED_REVIEWERS"
+        for reviewer in rule["reviewers"]["nodes"]
+    ]
+    approvers = [
+        value
+        for reviewer in reviewers
+        for value in (reviewer.get("name"), reviewer.get("login"), reviewer.get("slug"))
+        if value
+    ]
+    return {"required_reviewers": len(reviewers), "approvers": approvers}
+
+
+def repository_protection_from_graphql(repository):
+    return {
+        "branch_protection_rules": [
+            branch_protection_from_graphql(node) for node in repository["branchProtectionRules"]["nodes"]
+        ],
+        "environments": {
+            node["name"]: environment_protection_from_graphql(node)
+            for node in repository["environments"]["nodes"]
+        },
+    }
+
+
+def get_repository_protection_graphql(owner, repo, headers, client=None):
+    query = (
+        "query($owner: String!, $name: String!) "
+        "{ repository(owner: $owner, name: $name) { ...ProtectionFields } }"
+        + GRAPHQL_PROTECTION_FRAGMENT
+    )
+    payload = _graphql_query(headers, query, client, {"owner": owner, "name": repo})
+    if payload["data"].get("repository") is None:
+        messages = "; ".join(error.get("message", "") for error in payload.get("errors", []))
+        raise ConnectionError(f"Error fetching protection rules via GraphQL: {messages}")
+    return repository_protection_from_graphql(payload["data"]["repository"])
+
+
+# One aliased query for a batch of repositories; returns a protection document
+# or a ConnectionError per repository, keyed by "owner/repo".
+def get_fleet_protection_graphql(repositories, headers, client=None):
+    fields = " ".join(
+        f"r{index}: repository(owner: {json.dumps(owner)}, name: {json.dumps(repo)}) {{ ...ProtectionFields }}"
+        for index, (owner, repo) in enumerate(repositories)
+    )
+    payload = _graphql_query(headers, f"query {{ {fields} }}" + GRAPHQL_PROTECTION_FRAGMENT, client)
+    errors = _graphql_errors_by_alias(payload)
+    protection = {}
+    for index, (owner, repo) in enumerate(repositories):
+        repository = payload["data"].get(f"r{index}")
+        if repository is None:
+            message = errors.get(f"r{index}", "repository not found")
+            protection[f"{owner}/{repo}"] = ConnectionError(
+                f"Error fetching protection rules via GraphQL: {message}"
+            )
+        else:
+            protection[f"{owner}/{repo}"] = repository_protection_from_graphql(repository)
+    return protection
+
+
+def _match_branch_protection(protection, branch):
+    rules = protection["branch_protection_rules"]
+    for rule in rules:
+        if rule["pattern"] == branch:
+            return rule
+    for rule in rules:
+        if branch_matches(branch, rule["pattern"]):
+            return rule
+    raise ConnectionError(f"Error fetching branch protection rules: no protection rule matches {branch}")
+
+
+def evaluate_repository_protection(protocol, protection):
+    plan = compile_protocol(protocol)
+    results = {}
+    for rule in plan.branch_rules:
+        results[rule["branch"]] = evaluate_branch_rule(rule, _match_branch_protection(protection, rule["branch"]))
+    for rule in plan.status_checks:
+        branch_protection = _match_branch_protection(protection, rule["branch"])
+        results.setdefault(rule["branch"], {}).update(evaluate_status_check_rule(rule, branch_protection))
+    for environment in plan.environment_rules:
+        env_protection = protection["environments"].get(environment["name"])
+        if env_protection is None:
+            raise ConnectionError(f"Error fetching environment protection rules: {environment['name']} not found")
+        results[environment["name"]] = evaluate_environment_rule(environment, env_protection)
+    return results
+
+
+@traced("verify_repository_graphql")
+def verify_repository_graphql(protocol, headers, client=None):
+    plan = compile_protocol(protocol)
+    owner, repo = _repository(plan)
+    protection = get_repository_protection_graphql(owner, repo, headers, client)
+    results = evaluate_repository_protection(plan, protection)
+    # GraphQL has no tree listing; CODEOWNERS is read over REST.
+    return _evaluate_code_owners(_submit_code_owner_fetches(plan, headers, client=client), results)
+
+
+# Fleet verification: the same protocol applied to many repositories
+def parse_repository(full_name):
+    owner, _, repo = full_name.strip().partition("/")
+    if not owner or not repo or "/" in repo:
+        raise ValueError(f"Invalid repository name, expected owner/repo: {full_name}")
+    return owner, repo
+
+
+def load_repository_list(file_path):
+    try:
+        with open(file_path, "r") as file:
+            return [
+                parse_repository(line)
+                for line in file
+                if line.strip() and not line.lstrip().startswith("#")
+            ]
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Repository list not found: {file_path}")
+
+
+def list_organization_repositories(organization, headers, client=None):
+    url = f"{GITHUB_API_URL}/orgs/{organization}/repos?per_page=100"
+    repositories = []
+    while url:
+        try:
+            response = _github_get(url, headers, client)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise ConnectionError(f"Error listing organization repositories: {e}")
+        repositories.extend((organization, repo["name"]) for repo in response.json())
+        url = response.links.get("next", {}).get("url")
+    return repositories
+
+
+# A ProtocolResolver or anything else with plan_for(owner, repo).
+def _resolves_plans(protocol):
+    return hasattr(protocol, "plan_for")
+
+
+def protocol_for_repository(protocol, owner, repo):
+    if _resolves_plans(protocol):
+        return protocol.plan_for(owner, repo)
+    return compile_protocol(protocol).for_repository(owner, repo)
+
+
+def _evaluate_rest_repository(branches, environments, status_checks=(), code_owners=()):
+    results = _evaluate_status_checks(status_checks, _evaluate_branches(branches))
+    _evaluate_code_owners(code_owners, results)
+    results.update(_evaluate_environments(environments))
+    return results
+
+
+def _rest_settings(memo, owner, repo):
+    return {key[2]: document for key, document in memo.documents() if key[:2] == (owner, repo)}
+
+
+def _graphql_settings(batch, full_name):
+    return {"graphql": batch.result()[full_name]}
+
+
+def _evaluate_graphql_repository(protocol, batch, full_name, code_owners=()):
+    protection = batch.result()[full_name]
+    if isinstance(protection, Exception):
+        raise protection
+    return _evaluate_code_owners(code_owners, evaluate_repository_protection(protocol, protection))
+
+
+# A fleet memo is either one ProtectionMemo shared by every repository or
+# anything with for_repository(owner, repo) handing out one per repository.
+def _repository_memo(memo, owner, repo):
+    if memo is None:
+        return ProtectionMemo()
+    if hasattr(memo, "for_repository"):
+        return memo.for_repository(owner, repo)
+    return memo
+
+
+def _reraise(error):
+    raise error
+
+
+# The _submit_*_fleet generators submit a repository's fetches only when the
+# caller pulls it, so verify_fleet can bound how many repositories are in
+# flight at once. Each yields (full_name, evaluate, settings); settings()
+# returns the raw protection documents by resource once evaluate() succeeded.
+def _submit_rest_fleet(
+    protocol,
+    repositories,
+    headers,
+    executor,
+    client,
+    memo,
+    fetch_branch=None,
+    fetch_environment=None,
+    fetch_code_owners=None,
+):
+    for owner, repo in repositories:
+        # A malformed override and, for branch pattern rules, a failed
+        # branch listing are that repository's error.
+        try:
+            repo_protocol = protocol_for_repository(protocol, owner, repo)
+            repo_memo = _repository_memo(memo, owner, repo)
+            branches = _submit_branch_fetches(repo_protocol, headers, executor, client, repo_memo, fetch_branch)
+        except (ConnectionError, ValueError, FileNotFoundError) as e:
+            yield f"{owner}/{repo}", functools.partial(_reraise, e), None
+            continue
+        status_checks = _submit_status_check_fetches(
+            repo_protocol, headers, executor, client, repo_memo, fetch_branch
+        )
+        environments = _submit_environment_fetches(
+            repo_protocol, headers, executor, client, repo_memo, fetch_environment
+        )
+        code_owners = _submit_code_owner_fetches(
+            repo_protocol, headers, executor, client, repo_memo, fetch_code_owners
+        )
+        yield (
+            f"{owner}/{repo}",
+            functools.partial(_evaluate_rest_repository, branches, environments, status_checks, code_owners),
+            functools.partial(_rest_settings, repo_memo, owner, repo),
+        )
+
+
+def _submit_graphql_fleet(protocol, repositories, headers, executor, client, memo):
+    repositories = list(repositories)
+    for start in range(0, len(repositories), GRAPHQL_BATCH_SIZE):
+        chunk = repositories[start : start + GRAPHQL_BATCH_SIZE]
+        batch = executor.submit(get_fleet_protection_graphql, chunk, headers, client)
+        for owner, repo in chunk:
+            full_name = f"{owner}/{repo}"
+            try:
+                repo_protocol = protocol_for_repository(protocol, owner, repo)
+            except (ValueError, FileNotFoundError) as e:
+                yield full_name, functools.partial(_reraise, e), None
+                continue
+            # GraphQL has no tree listing; CODEOWNERS is read over REST.
+            code_owners = _submit_code_owner_fetches(
+                repo_protocol, headers, executor, client, _repository_memo(memo, owner, repo)
+            )
+            yield (
+                full_name,
+                functools.partial(_evaluate_graphql_repository, repo_protocol, batch, full_name, code_owners),
+                functools.partial(_graphql_settings, batch, full_name),
+            )
+
+
+# All fetches for all repositories share one bounded pool; a repository whose
+# fetch fails is reported in errors instead of aborting the whole run. The
+# "graphql" backend fetches GRAPHQL_BATCH_SIZE repositories per request.
+#
+# At most `window` repositories (default: four per worker) are in flight, and
+# on_result(full_name, results, error) is called for each one, in input order,
+# as soon as it is verified. With collect=False nothing is accumulated and the
+# returned dicts are empty, so memory stays flat however large the fleet is.
+# Without an explicit memo, each repository gets its own, released with it.
+# on_settings(full_name, documents) receives the raw protection documents of
+# each verified repository just before its on_result call.
+@traced("verify_fleet")
+def verify_fleet(
+    protocol,
+    repositories,
+    headers,
+    max_workers=DEFAULT_MAX_WORKERS,
+    client=None,
+    backend="rest",
+    memo=None,
+    window=None,
+    on_result=None,
+    collect=True,
+    on_settings=None,
+):
+    if client is None:
+        with GitHubClient(pool_maxsize=max_workers) as client:
+            return verify_fleet(
+                protocol,
+                repositories,
+                headers,
+                max_workers,
+                client,
+                backend,
+                memo,
+                window,
+                on_result,
+                collect,
+                on_settings,
+            )
+
+    if not _resolves_plans(protocol):
+        protocol = compile_protocol(protocol)
+    if window is None:
+        window = max_workers * 4
+    submit = _submit_graphql_fleet if backend == "graphql" else _submit_rest_fleet
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = submit(protocol, repositories, headers, executor, client, memo)
+        return _collect_fleet(pending, window, on_result, collect, on_settings)
+
+
+def _verify_pending(evaluate):
+    try:
+        return evaluate(), None
+    except ConnectionError as e:
+        return None, str(e)
+    except KeyError as e:
+        return None, f"Unexpected protection response, missing {e}"
+    except (ValueError, FileNotFoundError) as e:
+        return None, str(e)
+
+
+def _collect_fleet(pending, window=None, on_result=None, collect=True, on_settings=None):
+    results = {}
+    errors = {}
+    pending = iter(pending)
+    in_flight = collections.deque(itertools.islice(pending, window))
+    while in_flight:
+        full_name, evaluate, settings = in_flight.popleft()
+        in_flight.extend(itertools.islice(pending, 1))
+        repo_results, error = _verify_pending(evaluate)
+        if on_settings is not None and error is None:
+            on_settings(full_name, settings())
+        if on_result is not None:
+            on_result(full_name, repo_results, error)
+        if not collect:
+            continue
+        if error is None:
+            results[full_name] = repo_results
+        else:
+            errors[full_name] = error
+    return results, errors
+
+
+# Incremental mode: a JSONL feed of webhook payloads or audit-log events is
+# reduced to the (repository, branch/environment) pairs it touches, and only
+# those are verified again. Recognised events:
+#   branch_protection_rule webhooks ({"rule": {"name": ...}, "repository": ...})
+#   deployment_protection_rule webhooks ({"environment": ..., "repository": ...})
+#   audit-log protected_branch.* and environment.* actions ({"repo": ...})
+#   repository_ruleset webhooks and audit-log actions (all branches)
+# A webhook payload may carry its X-GitHub-Event name as "event" (except
+# deployment_protection_rule payloads, whose "event" is their own field and
+# which are recognised by their deployment_callback_url). A rule name
+# is matched as a pattern against the protocol's branches; "*" means all.
+def change_target(event):
+    repository = event.get("repository") or event.get("repo")
+    if isinstance(repository, dict):
+        repository = repository.get("full_name")
+    if not repository:
+        return None
+    name = event.get("event") or event.get("type") or ""
+    action = event.get("action") or ""
+    if name == "branch_protection_rule" or action.startswith("protected_branch.") or "rule" in event:
+        rule = event.get("rule") or {}
+        return repository, "branches", rule.get("name") or event.get("branch") or event.get("name") or "*"
+    deployment = name == "deployment_protection_rule" or "deployment_callback_url" in event
+    if deployment or name == "environment" or action.startswith("environment."):
+        environment = event.get("environment") or event.get("environment_name") or event.get("name") or "*"
+        if isinstance(environment, dict):
+            environment = environment.get("name") or "*"
+        return repository, "environments", environment
+    if name == "repository_ruleset" or action.startswith("repository_ruleset."):
+        return repository, "branches", "*"
+    return None
+
+
+# {full_name: {"branches": patterns, "environments": patterns}} in the order
+# repositories first appear in the feed.
+def load_change_events(file_path):
+    changes = {}
+    with open(file_path) as file:
+        for event in read_stream(file):
+            target = change_target(event)
+            if target is None:
+                continue
+            repository, kind, pattern = target
+            change = changes.setdefault(repository, {"branches": set(), "environments": set()})
+            change[kind].add(pattern)
+    return changes
+
+
+# A changed name covers a protocol name it matches ("*" matching every name),
+# and a protocol pattern such as "feature/*" covers the changed branches it
+# matches, so the pattern rule is verified again.
+def _changed(names, patterns):
+    return [
+        name
+        for name in names
+        if any(
+            pattern == "*"
+            or branch_matches(name, pattern)
+            or (is_branch_pattern(name) and branch_matches(pattern, name))
+            for pattern in patterns
+        )
+    ]
+
+
+# Resolves each changed repository to its plan cut down to the changed pairs.
+class ChangedPlans:
+    def __init__(self, protocol, changes):
+        self.protocol = protocol if _resolves_plans(protocol) else compile_protocol(protocol)
+        self.changes = changes
+
+    def plan_for(self, owner, repo):
+        plan = protocol_for_repository(self.protocol, owner, repo)
+        change = self.changes[f"{owner}/{repo}"]
+        return plan.restrict(
+            _changed(plan.branches, change["branches"]),
+            _changed(plan.environments, change["environments"]),
+        )
+
+
+# Verifies only what the changes touch, with verify_fleet's callbacks; the
+# results hold just the re-verified branches/environments of each repository.
+@traced("verify_changes")
+def verify_changes(
+    protocol,
+    changes,
+    headers,
+    max_workers=DEFAULT_MAX_WORKERS,
+    client=None,
+    on_result=None,
+    collect=True,
+    on_settings=None,
+):
+    repositories = [parse_repository(full_name) for full_name in changes]
+    return verify_fleet(
+        ChangedPlans(protocol, changes),
+        repositories,
+        headers,
+        max_workers,
+        client,
+        on_result=on_result,
+        collect=collect,
+        on_settings=on_settings,
+    )
+
+
+# Sharded runs. shard_of assigns every repository to one of `count` shards by
+# a hash of its name, so any process or CI runner given the same repository
+# list and shard index verifies the same slice. verify_shard writes its slice
+# as an NDJSON partial: a "run" record naming the shard, each repository's
+# records tagged with its position in the full list, and a closing "end"
+# record. merge_shards interleaves complete partials back into list order,
+# giving the same stream, and so the same reports, as a single-process run.
+def shard_of(full_name, count):
+    digest = hashlib.sha256(full_name.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+def parse_shard(text):
+    index, _, count = text.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError(f"Invalid shard {text!r}, expected INDEX/COUNT") from None
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {text!r}, expected 0 <= INDEX < COUNT")
+    return index, count
+
+
+def verify_shard(
+    protocol,
+    repositories,
+    headers,
+    index,
+    count,
+    output_path,
+    max_workers=DEFAULT_MAX_WORKERS,
+    client=None,
+    backend="rest",
+):
+    positions = {}
+
+    def selected():
+        for position, (owner, repo) in enumerate(repositories):
+            full_name = f"{owner}/{repo}"
+            if shard_of(full_name, count) == index:
+                positions.setdefault(full_name, collections.deque()).append(position)
+                yield owner, repo
+
+    with open(output_path, "w") as file:
+        writer = NDJSONWriter(file, positions)
+        writer.run(shard=(index, count))
+        verify_fleet(
+            protocol, selected(), headers, max_workers, client, backend, on_result=writer.on_result, collect=False
+        )
+        writer.write({"type": "end"})
+
+
+def _verify_shard_process(
+    api_url, protocol, repositories, headers, index, count, output_path, max_workers, backend, client_options=None
+):
+    global GITHUB_API_URL
+    GITHUB_API_URL = api_url
+    if client_options is None:
+        client = GitHubClient(pool_maxsize=max_workers)
+    else:
+        client = build_client(**client_options)
+    with client:
+        verify_shard(protocol, repositories, headers, index, count, output_path, max_workers, client, backend)
+
+
+# Runs every shard in its own process and returns the partials' paths. Each
+# process builds its client from client_options (see build_client); the
+# per-token rate and burst are split between the shards, so together they
+# stay within each token's budget.
+def verify_sharded(
+    protocol,
+    repositories,
+    headers,
+    shards,
+    directory,
+    max_workers=DEFAULT_MAX_WORKERS,
+    backend="rest",
+    client_options=None,
+):
+    repositories = list(repositories)
+    if client_options is not None:
+        if client_options.get("snapshot"):
+            raise ValueError("Shard processes cannot share one snapshot file")
+        client_options = dict(
+            client_options,
+            rate=client_options.get("rate", DEFAULT_TOKEN_RATE) / shards,
+            burst=max(1, client_options.get("burst", DEFAULT_TOKEN_BURST) // shards),
+        )
+    paths = [os.path.join(directory, f"shard-{index}-of-{shards}.ndjson") for index in range(shards)]
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=shards, mp_context=context) as executor:
+        futures = [
+            executor.submit(
+                _verify_shard_process,
+                GITHUB_API_URL,
+                protocol,
+                repositories,
+                headers,
+                index,
+                shards,
+                path,
+                max_workers,
+                backend,
+                client_options,
+            )
+            for index, path in enumerate(paths)
+        ]
+        for future in futures:
+            future.result()
+    return paths
+
+
+def _shard_groups(records, path):
+    group = None
+    for record in records:
+        kind = record.get("type")
+        if kind == "end":
+            break
+        if kind in ("repository", "error"):
+            if group is not None:
+                yield group
+            group = (record.pop("position"), [record])
+        elif group is not None:
+            group[1].append(record)
+    else:
+        raise ValueError(f"Shard partial {path} is incomplete")
+    if group is not None:
+        yield group
+
+
+def merge_shards(paths, output_path):
+    with contextlib.ExitStack() as stack:
+        streams = [read_stream(stack.enter_context(open(path))) for path in paths]
+        runs = [next(stream, None) or {} for stream in streams]
+        for path, run in zip(paths, runs):
+            if run.get("type") != "run" or "shard" not in run:
+                raise ValueError(f"{path} is not a shard partial")
+        count = runs[0]["shards"]
+        if sorted(run["shard"] for run in runs) != list(range(count)) or any(run["shards"] != count for run in runs):
+            raise ValueError(f"Expected one partial for each of {count} shards")
+        with open(output_path, "w") as file:
+            writer = NDJSONWriter(file)
+            writer.run(min(run["verification_date"] for run in runs))
+            groups = [_shard_groups(stream, path) for stream, path in zip(streams, paths)]
+            for _, records in heapq.merge(*groups, key=lambda group: group[0]):
+                writer.write(*records)
+
+
+# Columnar evaluation. SettingsTable holds the fetched protection settings of
+# a whole fleet as one column per (resource, setting), one row per
+# repository; evaluate_table then checks each protocol rule as a single
+# operation over its columns and returns a repositories x rules PassFailMatrix.
+# Once the table is built, evaluating another protocol touches no JSON. Columns
+# are NumPy arrays when NumPy is installed and plain lists otherwise.
+#
+# Column names are "<resource>:<setting>": "present" (the document was
+# fetched), "reviews" (-1 when reviews are not required), "force_push",
+# "enforce_admins", "context:<name>" (one per required status check),
+# "reviewers" and "approver:<name>" (one per approver).
+def _column(values, dtype):
+    if numpy is not None:
+        return numpy.fromiter(values, dtype=dtype)
+    return list(values)
+
+
+def _fill(count, value, dtype):
+    return _column(itertools.repeat(value, count), dtype)
+
+
+def _at_least(column, value):
+    if numpy is not None:
+        return column >= value
+    return [item >= value for item in column]
+
+
+def _equal(column, value):
+    if numpy is not None:
+        return column == value
+    return [item == value for item in column]
+
+
+def _all_of(count, *columns):
+    if not columns:
+        return _fill(count, True, bool)
+    if numpy is not None:
+        return numpy.logical_and.reduce(columns)
+    return [all(items) for items in zip(*columns)]
+
+
+class SettingsTable:
+    def __init__(self, repositories, columns):
+        self.repositories = list(repositories)
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.repositories)
+
+    def column(self, name, default, dtype):
+        column = self.columns.get(name)
+        return _fill(len(self), default, dtype) if column is None else column
+
+    # documents: {full_name: {resource: raw protection document}}, as passed
+    # to verify_fleet's on_settings or returned by ResultStore.settings.
+    @classmethod
+    def from_documents(cls, documents):
+        repositories = list(documents)
+        values = {}
+        for row, full_name in enumerate(repositories):
+            for resource, document in documents[full_name].items():
+                for setting, value in _document_settings(resource, document):
+                    values.setdefault((resource, setting), {})[row] = value
+        columns = {}
+        for (resource, setting), cells in values.items():
+            default, dtype = _SETTING_DEFAULTS[setting.split(":", 1)[0]]
+            column = (cells.get(row, default) for row in range(len(repositories)))
+            columns[f"{resource}:{setting}"] = _column(column, dtype)
+        return cls(repositories, columns)
+
+
+_SETTING_DEFAULTS = {
+    "present": (False, bool),
+    "reviews": (-1, int),
+    "force_push": (False, bool),
+    "enforce_admins": (False, bool),
+    "reviewers": (-1, int),
+    "approver": (False, bool),
+    "context": (False, bool),
+}
+
+
+def _document_settings(resource, document):
+    yield "present", True
+    if resource.startswith("branches/"):
+        reviews = document.get("required_pull_request_reviews") or {}
+        yield "reviews", reviews.get("required_approving_review_count", -1)
+        yield "force_push", bool((document.get("allow_force_pushes") or {}).get("enabled"))
+        yield "enforce_admins", bool((document.get("enforce_admins") or {}).get("enabled"))
+        required = document.get("required_status_checks") or {}
+        for context in required.get("contexts") or ():
+            yield f"context:{context}", True
+        for check in required.get("checks") or ():
+            yield f"context:{check['context']}", True
+    elif resource.startswith("environments/"):
+        yield "reviewers", document.get("required_reviewers", -1)
+        for approver in document.get("approvers", ()):
+            yield f"approver:{approver}", True
+
+
+class PassFailMatrix:
+    def __init__(self, repositories, rules, columns):
+        self.repositories = repositories
+        self.rules = rules
+        self.columns = columns
+
+    # Rows of the matrix: one tuple of booleans per repository.
+    def rows(self):
+        if numpy is not None and self.columns:
+            return [tuple(row) for row in numpy.column_stack(self.columns).tolist()]
+        return list(zip(*self.columns)) if self.columns else [() for _ in self.repositories]
+
+    def column(self, target, rule):
+        return self.columns[self.rules.index((target, rule))]
+
+    # Same shape as verify_fleet's results.
+    def results(self):
+        results = {}
+        for full_name, row in zip(self.repositories, self.rows()):
+            repo_results = results[full_name] = {}
+            for (target, rule), passed in zip(self.rules, row):
+                repo_results.setdefault(target, {})[rule] = bool(passed)
+        return results
+
+    def failures(self):
+        return [
+            (full_name, target, rule)
+            for full_name, row in zip(self.repositories, self.rows())
+            for (target, rule), passed in zip(self.rules, row)
+            if not passed
+        ]
+
+
+# Pattern rules apply to every branch the table has settings for that no exact
+# rule names, the first matching pattern winning.
+def _table_branch_rules(plan, table):
+    patterns = [rule for rule in plan.branch_rules if is_branch_pattern(rule.branch)]
+    rules = [rule for rule in plan.branch_rules if not is_branch_pattern(rule.branch)]
+    if not patterns:
+        return rules
+    prefix, suffix = "branches/", "/protection:present"
+    for name in table.columns:
+        if not (name.startswith(prefix) and name.endswith(suffix)):
+            continue
+        branch = name[len(prefix) : -len(suffix)]
+        if branch in plan.branches:
+            continue
+        rule = next((rule for rule in patterns if branch_matches(branch, rule.branch)), None)
+        if rule is not None:
+            rules.append(BranchRule(branch, rule.required_reviewers, rule.allow_force_push, rule.allow_bypass))
+    return rules
+
+
+# Checks a single plan against every repository of the table; a rule whose
+# document is missing for a repository fails.
+def evaluate_table(protocol, table):
+    plan = compile_protocol(protocol)
+    count = len(table)
+    rules = []
+    columns = []
+    for rule in _table_branch_rules(plan, table):
+        resource = branch_protection_resource(rule.branch)
+        present = table.column(f"{resource}:present", False, bool)
+        checks = (
+            ("required_reviewers", _at_least(table.column(f"{resource}:reviews", -1, int), rule.required_reviewers)),
+            ("allow_force_push", _equal(table.column(f"{resource}:force_push", False, bool), rule.allow_force_push)),
+            ("allow_bypass", _equal(table.column(f"{resource}:enforce_admins", False, bool), rule.allow_bypass)),
+        )
+        for name, column in checks:
+            rules.append((rule.branch, name))
+            columns.append(_all_of(count, present, column))
+    for rule in plan.status_checks:
+        resource = branch_protection_resource(rule.branch)
+        present = table.column(f"{resource}:present", False, bool)
+        contexts = [table.column(f"{resource}:context:{name}", False, bool) for name in rule.checks]
+        rules.append((rule.branch, "required_status_checks"))
+        columns.append(_all_of(count, present, *contexts))
+    for rule in plan.environment_rules:
+        resource = environment_protection_resource(rule.name)
+        present = table.column(f"{resource}:present", False, bool)
+        reviewers = _at_least(table.column(f"{resource}:reviewers", -1, int), rule.required_reviewers)
+        approvers = [table.column(f"{resource}:approver:{name}", False, bool) for name in rule.required_approvers]
+        rules.append((rule.name, "required_reviewers"))
+        columns.append(_all_of(count, present, reviewers))
+        rules.append((rule.name, "required_approvers"))
+        columns.append(_all_of(count, present, *approvers))
+    return PassFailMatrix(table.repositories, rules, columns)
+
+
+# Async API: the same fetch/evaluate pipeline on one event loop, built on
+# aiohttp (an optional dependency, only needed here). A single loop keeps
+# up to `limit` requests in flight over one pooled connector.
+ASYNC_REQUEST_ERRORS = (asyncio.TimeoutError,) + ((aiohttp.ClientError,) if aiohttp is not None else ())
+
+
+class AsyncGitHubClient:
+    def __init__(
+        self,
+        headers=None,
+        limit=100,
+        timeout=(10, 30),
+        max_retries=3,
+        backoff_factor=0.5,
+        max_backoff=30,
+        verify=False,  # verify=False is used to ignore SSL certificate verification, due to ZScaler
+        sleep=asyncio.sleep,
+    ):
+        if aiohttp is None:
+            raise ImportError("The async API requires aiohttp: pip install aiohttp")
+        self.headers = headers
+        self.limit = limit
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.verify = verify
+        self.sleep = sleep
+        self._session = None
+
+    backoff = GitHubClient.backoff
+
+    def _get_session(self):
+        if self._session is None:
+            connect, read = self.timeout
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit, ssl=None if self.verify else False),
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+            )
+        return self._session
+
+    async def get_json(self, url, headers=None):
+        payload, _ = await self.get_page(url, headers)
+        return payload
+
+    # The JSON body and, for a paginated listing, the URL of the next page.
+    async def get_page(self, url, headers=None):
+        session = self._get_session()
+        attempt = 0
+        while True:
+            started = time.perf_counter() if METRICS is not None else None
+            try:
+                async with session.get(url, headers=headers) as response:
+                    if started is not None:
+                        body = await response.read()
+                        _observe_attempt("GET", url, started, str(response.status), len(body))
+                    if response.status not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                        response.raise_for_status()
+                        next_url = response.links.get("next", {}).get("url")
+                        return await response.json(content_type=None), next_url and str(next_url)
+                    _count("gitverify_retries_total", reason="status")
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if started is not None:
+                    _observe_attempt("GET", url, started, type(e).__name__)
+                if attempt >= self.max_retries:
+                    raise
+                _count("gitverify_retries_total", reason="connection")
+            await self.sleep(self.backoff(attempt))
+            attempt += 1
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+@contextlib.asynccontextmanager
+async def _async_client(client, **kwargs):
+    if client is not None:
+        yield client
+        return
+    async with AsyncGitHubClient(**kwargs) as client:
+        yield client
+
+
+# Futures for the memo and _submit_* helpers, as tasks on the running loop.
+class _TaskExecutor:
+    def submit(self, fn, *args):
+        return asyncio.ensure_future(fn(*args))
+
+
+async def _wait_all(*pending):
+    await asyncio.gather(*(future for group in pending for _, future in group), return_exceptions=True)
+
+
+@traced("get_branch_protection_rules_async")
+async def get_branch_protection_rules_async(owner, repo, branch, headers, client=None):
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/branches/{branch}/protection"
+    async with _async_client(client) as client:
+        try:
+            return await client.get_json(url, headers)
+        except ASYNC_REQUEST_ERRORS as e:
+            raise ConnectionError(f"Error fetching branch protection rules: {e}")
+
+
+@traced("get_environment_protection_rules_async")
+async def get_environment_protection_rules_async(owner, repo, environment, headers, client=None):
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/environments/{environment}/protection"
+    async with _async_client(client) as client:
+        try:
+            return await client.get_json(url, headers)
+        except ASYNC_REQUEST_ERRORS as e:
+            raise ConnectionError(f"Error fetching environment protection rules: {e}")
+
+
+# The repository's branches, following the listing's "next" links.
+async def list_branches_async(owner, repo, headers, client=None):
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/branches?per_page={BRANCH_PAGE_SIZE}"
+    async with _async_client(client) as client:
+        branches = []
+        try:
+            while url:
+                page, url = await client.get_page(url, headers)
+                branches += page
+        except ASYNC_REQUEST_ERRORS as e:
+            raise ConnectionError(f"Error listing branches: {e}")
+        return branches
+
+
+async def _branch_pattern_protection_async(plan, headers, executor, client, memo, fetch):
+    patterns = [rule for rule in plan.branch_rules if is_branch_pattern(rule.branch)]
+    owner, repo = _repository(plan)
+    pending = []
+    for branch in await list_branches_async(owner, repo, headers, client):
+        rule = _branch_pattern_rule(plan, patterns, branch["name"])
+        if rule is None:
+            continue
+        future = None
+        if branch.get("protected", True):
+            key = (owner, repo, branch_protection_resource(rule.branch))
+            future = memo.submit(key, executor, fetch, owner, repo, rule.branch, headers, client)
+        pending.append((rule, future))
+    return [(rule, unprotected_branch_protection() if future is None else await future) for rule, future in pending]
+
+
+async def _git_tree_async(owner, repo, sha, headers, client, recursive=True):
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/trees/{sha}" + ("?recursive=1" if recursive else "")
+    return await client.get_json(url, headers)
+
+
+async def _tree_entries_async(owner, repo, sha, headers, client, prefix=""):
+    tree = await _git_tree_async(owner, repo, sha, headers, client)
+    if not tree.get("truncated"):
+        return [[prefix + entry["path"], entry["type"]] for entry in tree["tree"]]
+    tree = await _git_tree_async(owner, repo, sha, headers, client, recursive=False)
+    if tree.get("truncated"):
+        raise ConnectionError(f"Error fetching CODEOWNERS: the tree listing of {prefix or '/'} is truncated")
+    entries = []
+    for entry in tree["tree"]:
+        path = prefix + entry["path"]
+        entries.append([path, entry["type"]])
+        if entry["type"] == "tree":
+            entries += await _tree_entries_async(owner, repo, entry["sha"], headers, client, path + "/")
+    return entries
+
+
+async def get_code_owners_async(owner, repo, headers, client=None, ref="HEAD"):
+    async with _async_client(client) as client:
+        try:
+            tree = await _tree_entries_async(owner, repo, ref, headers, client)
+            location = _codeowners_location(tree)
+            text = None
+            if location is not None:
+                document = await client.get_json(f"{GITHUB_API_URL}/repos/{owner}/{repo}/contents/{location}", headers)
+                text = base64.b64decode(document["content"]).decode()
+            return {"codeowners": text, "tree": tree}
+        except ASYNC_REQUEST_ERRORS as e:
+            raise ConnectionError(f"Error fetching CODEOWNERS: {e}")
+
+
+@traced("verify_environment_protection_async")
+async def verify_environment_protection_async(protocol, headers, client=None, memo=None):
+    plan = compile_protocol(protocol)
+    async with _async_client(client) as client:
+        environments = _submit_environment_fetches(
+            plan, headers, _TaskExecutor(), client, memo, get_environment_protection_rules_async
+        )
+        await _wait_all(environments)
+        return _evaluate_environments(environments)
+
+
+@traced("verify_branch_protection_async")
+async def verify_branch_protection_async(protocol, headers, client=None, memo=None):
+    plan = compile_protocol(protocol)
+    memo = ProtectionMemo() if memo is None else memo
+    async with _async_client(client) as client:
+        executor = _TaskExecutor()
+        branches = _submit_branch_fetches(plan, headers, executor, client, memo, get_branch_protection_rules_async)
+        status_checks = _submit_status_check_fetches(
+            plan, headers, executor, client, memo, get_branch_protection_rules_async
+        )
+        environments = _submit_environment_fetches(
+            plan, headers, executor, client, memo, get_environment_protection_rules_async
+        )
+        code_owners = _submit_code_owner_fetches(plan, headers, executor, client, memo, get_code_owners_async)
+        await _wait_all(branches, status_checks, environments, code_owners)
+        return _evaluate_rest_repository(branches, environments, status_checks, code_owners)
+
+
+@traced("verify_fleet_async")
+async def verify_fleet_async(protocol, repositories, headers, limit=100, client=None, memo=None):
+    if not _resolves_plans(protocol):
+        protocol = compile_protocol(protocol)
+    memo = ProtectionMemo() if memo is None else memo
+    async with _async_client(client, limit=limit) as client:
+        pending = list(
+            _submit_rest_fleet(
+                protocol,
+                repositories,
+                headers,
+                _TaskExecutor(),
+                client,
+                memo,
+                get_branch_protection_rules_async,
+                get_environment_protection_rules_async,
+                get_code_owners_async,
+            )
+        )
+        await asyncio.gather(*memo.futures(), return_exceptions=True)
+        return _collect_fleet(pending)
+
+
+def result_kind(target_results):
+    if "required_approvers" in target_results:
+        return "environment"
+    if "code_owners" in target_results or "all_files_owned" in target_results:
+        return "path"
+    return "branch"
+
+
+# Streaming output: one NDJSON record per line, flushed as soon as it is
+# written, so a crash mid-run keeps everything verified so far. A stream is a
+# "run" record followed, per repository, by a "repository" record and one
+# "result" record per branch/environment, or by a single "error" record.
+# on_result matches verify_fleet's callback and is safe to call from threads.
+class NDJSONWriter:
+    def __init__(self, file, positions=None):
+        self.file = file
+        self.positions = positions
+        self.lock = threading.Lock()
+
+    def write(self, *records):
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with self.lock:
+            self.file.write(lines)
+            self.file.flush()
+
+    def run(self, verification_date=None, shard=None):
+        if verification_date is None:
+            verification_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        record = {"type": "run", "verification_date": verification_date}
+        if shard is not None:
+            record["shard"], record["shards"] = shard
+        self.write(record)
+
+    # With `positions` ({full_name: deque of positions}), each repository's
+    # first record carries its next position, dropped once written; a
+    # repository listed twice is verified and written twice, in list order.
+    def on_result(self, full_name, results, error):
+        if error is not None:
+            record = {"type": "error", "repository": full_name, "error": error}
+        else:
+            record = {"type": "repository", "repository": full_name}
+        if self.positions is not None:
+            record["position"] = self.positions[full_name].popleft()
+        if error is not None:
+            self.write(record)
+            return
+        records = [record]
+        for target, target_results in results.items():
+            records.append(
+                {
+                    "type": "result",
+                    "repository": full_name,
+                    "target": target,
+                    "kind": result_kind(target_results),
+                    "results": target_results,
+                }
+            )
+        self.write(*records)
+
+
+# Yields the records of an NDJSON stream; a truncated last line (the writer
+# was killed mid-write) is skipped.
+def read_stream(file):
+    for line in file:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            if line.endswith("\n"):
+                raise
+            return
+
+
+# Reports are rendered in one walk over the results: render_report feeds every
+# repository to each sink (one per output format) in turn, so text for the
+# console, JSON for archival and HTML for auditors come from the same pass.
+# Sinks build each repository's output as one string and write it to a file
+# opened with a REPORT_BUFFER_SIZE buffer. Given a repository name, begin()
+# selects the single-repository layout; otherwise the fleet layout, with
+# errors listed after all repositories.
+REPORT_BUFFER_SIZE = 1 << 16
+DEFAULT_REPOSITORY = "your-repo-owner/your-repo-name"
+
+
+def _status(value):
+    return "PASS" if value else "FAIL"
+
+
+def _target_label(target, target_results):
+    return f"{result_kind(target_results).capitalize()}: {target}"
+
+
+class ReportSink:
+    def __init__(self, file):
+        self.file = file
+
+    def begin(self, verification_date, repository=None):
+        self.fleet = repository is None
+
+    def repository(self, repository, repo_results):
+        pass
+
+    def error(self, repository, error):
+        pass
+
+    def end(self):
+        pass
+
+
+def _json_member(key, value, depth):
+    indent = " " * 4 * depth
+    return indent + json.dumps(key) + ": " + json.dumps(value, indent=4).replace("\n", "\n" + indent)
+
+
+# Writes exactly what json.dump(report, file, indent=4) would.
+class JSONReportSink(ReportSink):
+    def begin(self, verification_date, repository=None):
+        super().begin(verification_date, repository)
+        self.section = "repositories" if self.fleet else "results"
+        self.count = 0
+        parts = ["{\n", _json_member("verification_date", verification_date, 1), ",\n"]
+        if not self.fleet:
+            parts += [_json_member("repository", repository, 1), ",\n"]
+        parts.append(f'    "{self.section}": {{')
+        self.file.write("".join(parts))
+
+    def _members(self, items):
+        parts = []
+        for key, value in items:
+            parts.append(("," if self.count else "") + "\n" + _json_member(key, value, 2))
+            self.count += 1
+        self.file.write("".join(parts))
+
+    def _close(self):
+        self.file.write("\n    }" if self.count else "}")
+
+    def repository(self, repository, repo_results):
+        if self.fleet:
+            self._members([(repository, repo_results)])
+        else:
+            self._members(repo_results.items())
+
+    def error(self, repository, error):
+        if self.section != "errors":
+            self._close()
+            self.file.write(',\n    "errors": {')
+            self.section = "errors"
+            self.count = 0
+        self._members([(repository, error)])
+
+    def end(self):
+        self._close()
+        if self.section == "repositories":
+            self.file.write(',\n    "errors": {}')
+        self.file.write("\n}")
+
+
+class HTMLReportSink(ReportSink):
+    def begin(self, verification_date, repository=None):
+        super().begin(verification_date, repository)
+        title = "Fleet Verification Report" if self.fleet else "Verification Report"
+        parts = [f"<html><body><h1>{title}</h1>", f"<p>Date: {verification_date}</p>"]
+        if not self.fleet:
+            parts.append(f"<p>Repository: {repository}</p><ul>")
+        self.file.write("".join(parts))
+
+    def repository(self, repository, repo_results):
+        parts = [f"<h2>Repository: {repository}</h2><ul>"] if self.fleet else []
+        for target, target_results in repo_results.items():
+            parts.append(f"<li>{_target_label(target, target_results)}<ul>")
+            for key, value in target_results.items():
+                parts.append(f"<li>{key}: {_status(value)}</li>")
+            parts.append("</ul></li>")
+        if self.fleet:
+            parts.append("</ul>")
+        self.file.write("".join(parts))
+
+    def error(self, repository, error):
+        self.file.write(f"<h2>Repository: {repository}</h2><p>ERROR: {error}</p>")
+
+    def end(self):
+        self.file.write("</body></html>" if self.fleet else "</ul></body></html>")
+
+
+class MarkdownReportSink(ReportSink):
+    def begin(self, verification_date, repository=None):
+        super().begin(verification_date, repository)
+        title = "Fleet Verification Report" if self.fleet else "Verification Report"
+        parts = [f"# {title}\n", f"**Date:** {verification_date}\n"]
+        if not self.fleet:
+            parts.append(f"**Repository:** {repository}\n")
+        self.file.write("".join(parts))
+
+    def repository(self, repository, repo_results):
+        parts = [f"## Repository: {repository}\n"] if self.fleet else []
+        heading = "###" if self.fleet else "##"
+        for target, target_results in repo_results.items():
+            parts.append(f"{heading} {_target_label(target, target_results)}\n")
+            for key, value in target_results.items():
+                parts.append(f"- **{key}:** {_status(value)}\n")
+        self.file.write("".join(parts))
+
+    def error(self, repository, error):
+        self.file.write(f"## Repository: {repository}\n**ERROR:** {error}\n")
+
+
+class TextReportSink(ReportSink):
+    def repository(self, repository, repo_results):
+        parts = [f"Repository: {repository}\n"] if self.fleet else []
+        for target, target_results in repo_results.items():
+            parts.append(f"{_target_label(target, target_results)}\n")
+            for key, value in target_results.items():
+                parts.append(f"{key}: {_status(value)}\n")
+        self.file.write("".join(parts))
+
+    def error(self, repository, error):
+        self.file.write(f"Repository: {repository}\nERROR: {error}\n")
+
+
+# format: (sink, single-repository output, fleet output); None is stdout.
+REPORT_SINKS = {
+    "json": (JSONReportSink, "verification_report.json", "fleet_verification_report.json"),
+    "html": (HTMLReportSink, "verification_report.html", "fleet_verification_report.html"),
+    "markdown": (MarkdownReportSink, "verification_report.md", "fleet_verification_report.md"),
+    "text": (TextReportSink, None, None),
+}
+
+
+def _formats(format):
+    return [format] if isinstance(format, str) else list(format)
+
+
+@contextlib.contextmanager
+def open_report_sinks(formats, outputs=None, fleet=True):
+    outputs = outputs or {}
+    with contextlib.ExitStack() as stack:
+        sinks = []
+        for format in _formats(formats):
+            sink_class, single_output, fleet_output = REPORT_SINKS.get(format, REPORT_SINKS["text"])
+            output = outputs.get(format) or (fleet_output if fleet else single_output)
+            if output is None:
+                file = sys.stdout
+            else:
+                file = stack.enter_context(open(output, "w", buffering=REPORT_BUFFER_SIZE))
+            sinks.append(sink_class(file))
+        yield sinks
+
+
+# repositories is an iterable of (full_name, results) and errors one of
+# (full_name, error); each is consumed once, repositories first.
+def render_report(sinks, repositories, errors=(), verification_date=None, repository=None):
+    if verification_date is None:
+        verification_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for sink in sinks:
+        sink.begin(verification_date, repository)
+    for full_name, repo_results in repositories:
+        for sink in sinks:
+            sink.repository(full_name, repo_results)
+    for full_name, error in errors:
+        for sink in sinks:
+            sink.error(full_name, error)
+    for sink in sinks:
+        sink.end()
+
+
+@traced("report_results")
+def report_results(results, format="text", repository=None, outputs=None):
+    repository = repository or DEFAULT_REPOSITORY
+    with open_report_sinks(format, outputs, fleet=False) as sinks:
+        render_report(sinks, [(repository, results)], repository=repository)
+
+
+@traced("report_fleet_results")
+def report_fleet_results(results, errors, format="text", outputs=None):
+    with open_report_sinks(format, outputs) as sinks:
+        render_report(sinks, results.items(), errors.items())
+
+
+def _spooled_errors(spool):
+    spool.seek(0)
+    for line in spool:
+        yield tuple(json.loads(line))
+
+
+def _stream_repositories(records, spool):
+    repository = None
+    repo_results = {}
+    for record in records:
+        kind = record.get("type")
+        if kind == "error":
+            spool.write(json.dumps([record["repository"], record["error"]]) + "\n")
+        elif kind == "result" and record["repository"] == repository:
+            repo_results[record["target"]] = record["results"]
+        elif kind == "repository":
+            if repository is not None:
+                yield repository, repo_results
+            repository = record["repository"]
+            repo_results = {}
+    if repository is not None:
+        yield repository, repo_results
+
+
+# Builds fleet reports from an NDJSON stream in one pass. Each repository is
+# rendered as soon as its records end; errors, which every format lists last,
+# are spooled to a temporary file (on disk once large) until the stream ends.
+@traced("report_from_stream")
+def report_from_stream(stream_path, format="text", outputs=None):
+    with open(stream_path) as stream, tempfile.SpooledTemporaryFile(mode="w+") as spool:
+        records = read_stream(stream)
+        run = next(records, None)
+        if run is None or run.get("type") != "run":
+            raise ValueError(f"{stream_path} is not a verification stream")
+        with open_report_sinks(format, outputs) as sinks:
+            render_report(
+                sinks,
+                _stream_repositories(records, spool),
+                _spooled_errors(spool),
+                run["verification_date"],
+            )
+
+
+# Append-only history of verification runs in SQLite. Every run adds one row
+# per repository, branch/environment and check to `results`, the raw
+# protection documents it was judged on to `run_settings` (the documents
+# themselves are stored once per distinct content in `settings`), and fetch
+# failures to `errors`. A run is written in a single transaction.
+#
+# `results` is clustered by run; results_by_repository and results_by_rule
+# cover the per-repository/per-rule queries. Run ids grow with time, so the
+# state "as of" a time is the row with the highest run id at or before the
+# last run started by then, found with SQLite's MAX() bare-column rule.
+# Partial (incremental) runs hold only the checks they re-verified; they are
+# merged into the state the same way.
+RESULT_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    partial INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS runs_by_time ON runs (started_at);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL,
+    repository TEXT NOT NULL,
+    target TEXT NOT NULL,
+    rule TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    passed INTEGER NOT NULL,
+    PRIMARY KEY (run_id, repository, target, rule)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_by_repository ON results (repository, target, rule, run_id, passed);
+CREATE INDEX IF NOT EXISTS results_by_rule ON results (rule, run_id, passed);
+CREATE TABLE IF NOT EXISTS errors (
+    run_id INTEGER NOT NULL,
+    repository TEXT NOT NULL,
+    error TEXT NOT NULL,
+    PRIMARY KEY (run_id, repository)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS settings (
+    digest TEXT PRIMARY KEY,
+    document TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS run_settings (
+    run_id INTEGER NOT NULL,
+    repository TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (repository, resource, run_id)
+) WITHOUT ROWID;
+"""
+
+_STATE_AS_OF = """
+SELECT repository, target, rule, MAX(run_id) AS run_id, passed
+FROM results
+WHERE run_id <= ?
+GROUP BY repository, target, rule
+"""
+
+
+class ResultStore:
+    def __init__(self, path, clock=time.time):
+        self.clock = clock
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(RESULT_STORE_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # with store.run() as run: feed run.on_settings/run.on_result (they match
+    # verify_fleet's callbacks); rows are committed together when the block
+    # exits and rolled back if it raises.
+    @contextlib.contextmanager
+    def run(self, started_at=None, partial=False):
+        self.connection.execute("BEGIN")
+        try:
+            run = _StoreRun(self, self.clock() if started_at is None else started_at, partial)
+            yield run
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def record_run(self, results, errors=None, settings=None, started_at=None, partial=False):
+        with self.run(started_at, partial) as run:
+            for repository, documents in (settings or {}).items():
+                run.on_settings(repository, documents)
+            for repository, repo_results in results.items():
+                run.on_result(repository, repo_results, None)
+            for repository, error in (errors or {}).items():
+                run.on_result(repository, None, error)
+        return run.id
+
+    def _run_as_of(self, when):
+        if when is None:
+            row = self.connection.execute("SELECT MAX(id) FROM runs").fetchone()
+        else:
+            row = self.connection.execute("SELECT MAX(id) FROM runs WHERE started_at <= ?", (when,)).fetchone()
+        return row[0] or 0
+
+    # Latest outcome of every (repository, target, rule) as of `when`.
+    def state(self, when=None, repository=None):
+        if repository is None:
+            rows = self.connection.execute(_STATE_AS_OF, (self._run_as_of(when),))
+        else:
+            rows = self.connection.execute(
+                """
+                SELECT repository, target, rule, MAX(run_id), passed
+                FROM results
+                WHERE repository = ? AND run_id <= ?
+                GROUP BY target, rule
+                """,
+                (repository, self._run_as_of(when)),
+            )
+        return {(repository, target, rule): bool(passed) for repository, target, rule, run_id, passed in rows}
+
+    # A repository's current results, shaped like verify_branch_protection's.
+    def results(self, repository, when=None):
+        results = {}
+        for (_, target, rule), passed in self.state(when, repository).items():
+            results.setdefault(target, {})[rule] = passed
+        return results
+
+    # Checks that passed as of `since` and fail as of `until` (default: now).
+    def drift(self, since, until=None):
+        rows = self.connection.execute(
+            f"""
+            WITH earlier AS ({_STATE_AS_OF}), later AS ({_STATE_AS_OF})
+            SELECT later.repository, later.target, later.rule, runs.started_at
+            FROM later
+            JOIN earlier USING (repository, target, rule)
+            JOIN runs ON runs.id = later.run_id
+            WHERE earlier.passed = 1 AND later.passed = 0
+            ORDER BY later.repository, later.target, later.rule
+            """,
+            (self._run_as_of(since), self._run_as_of(until)),
+        )
+        return [
+            {"repository": repository, "target": target, "rule": rule, "failed_at": failed_at}
+            for repository, target, rule, failed_at in rows
+        ]
+
+    # Passed/failed check counts per full run, optionally for one repository
+    # or one rule, oldest run first.
+    def trend(self, repository=None, rule=None, since=None, partial=False):
+        conditions = ["runs.started_at >= ?"]
+        parameters = [since or 0]
+        if not partial:
+            conditions.append("runs.partial = 0")
+        if repository is not None:
+            conditions.append("results.repository = ?")
+            parameters.append(repository)
+        if rule is not None:
+            conditions.append("results.rule = ?")
+            parameters.append(rule)
+        rows = self.connection.execute(
+            f"""
+            SELECT runs.id, runs.started_at, SUM(results.passed), COUNT(*) - SUM(results.passed)
+            FROM results
+            JOIN runs ON runs.id = results.run_id
+            WHERE {" AND ".join(conditions)}
+            GROUP BY runs.id
+            ORDER BY runs.id
+            """,
+            parameters,
+        )
+        return [
+            {"run_id": run_id, "started_at": started_at, "passed": passed, "failed": failed}
+            for run_id, started_at, passed, failed in rows
+        ]
+
+    # The most recent run after which every check of the repository passed,
+    # with the raw settings it had then; None if it never fully passed.
+    def last_known_good(self, repository):
+        rows = self.connection.execute(
+            """
+            SELECT results.run_id, runs.started_at, results.target, results.rule, results.passed
+            FROM results
+            JOIN runs ON runs.id = results.run_id
+            WHERE results.repository = ?
+            ORDER BY results.run_id
+            """,
+            (repository,),
+        )
+        state = {}
+        good = None
+        for run_id, group in itertools.groupby(rows, key=lambda row: row[:2]):
+            for _, _, target, rule, passed in group:
+                state[target, rule] = passed
+            if all(state.values()):
+                good = run_id
+        if good is None:
+            return None
+        run_id, started_at = good
+        return {"run_id": run_id, "started_at": started_at, "settings": self.settings(repository, run_id)}
+
+    # The raw settings of a repository as of a run.
+    def settings(self, repository, run_id=None):
+        rows = self.connection.execute(
+            """
+            SELECT run_settings.resource, MAX(run_settings.run_id), settings.document
+            FROM run_settings
+            JOIN settings USING (digest)
+            WHERE run_settings.repository = ? AND run_settings.run_id <= ?
+            GROUP BY run_settings.resource
+            """,
+            (repository, run_id or self._run_as_of(None)),
+        )
+        return {resource: json.loads(document) for resource, run_id, document in rows}
+
+
+class _StoreRun:
+    def __init__(self, store, started_at, partial=False):
+        self.connection = store.connection
+        self.id = self.connection.execute(
+            "INSERT INTO runs (started_at, partial) VALUES (?, ?)", (started_at, int(partial))
+        ).lastrowid
+
+    def on_settings(self, repository, documents):
+        settings = []
+        links = []
+        for resource, document in documents.items():
+            text = json.dumps(document, sort_keys=True)
+            digest = hashlib.sha256(text.encode()).hexdigest()
+            settings.append((digest, text))
+            links.append((self.id, repository, resource, digest))
+        self.connection.executemany("INSERT OR IGNORE INTO settings VALUES (?, ?)", settings)
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO run_settings (run_id, repository, resource, digest) VALUES (?, ?, ?, ?)", links
+        )
+
+    def on_result(self, repository, results, error):
+        if error is not None:
+            self.connection.execute("INSERT OR REPLACE INTO errors VALUES (?, ?, ?)", (self.id, repository, error))
+            return
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (self.id, repository, target, rule, result_kind(target_results), int(bool(passed)))
+                for target, target_results in results.items()
+                for rule, passed in target_results.items()
+            ],
+        )
+
+
+# Watch mode: a long-running process that keeps the compiled protocol, the
+# client's connection pool and cache, and every repository's last known
+# protection documents in memory. Each (repository, resource) pair is due
+# again after its repository's interval: hot_interval for repositories listed
+# as hot or whose settings changed within the last `interval` seconds, else
+# `interval`. A refresh forgets only the due documents and re-verifies their
+# repositories, so everything else is evaluated from memory; branch pattern
+# rules list the repository's branches again. A repository whose fetch
+# failed keeps its last results and is retried after hot_interval.
+class WatchDaemon:
+    def __init__(
+        self,
+        protocol,
+        repositories,
+        headers,
+        client,
+        max_workers=DEFAULT_MAX_WORKERS,
+        interval=DEFAULT_REFRESH_INTERVAL,
+        hot_interval=DEFAULT_HOT_INTERVAL,
+        hot=(),
+        clock=None,
+    ):
+        self.protocol = protocol if _resolves_plans(protocol) else compile_protocol(protocol)
+        self.repositories = [f"{owner}/{repo}" for owner, repo in repositories]
+        self.headers = headers
+        self.client = client
+        self.max_workers = max_workers
+        self.interval = interval
+        self.hot_interval = hot_interval
+        self.hot = set(hot)
+        self.clock = clock or SystemClock()
+        self.memos = {}
+        self.settings = {}
+        self.changed_at = {}
+        self.state = {}
+        self._due = {}
+        self._schedule = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        now = self.clock.time()
+        for full_name in self.repositories:
+            self._reschedule(full_name, None, now)
+
+    def for_repository(self, owner, repo):
+        memo = self.memos.get(f"{owner}/{repo}")
+        if memo is None:
+            memo = self.memos[f"{owner}/{repo}"] = ProtectionMemo()
+        return memo
+
+    def interval_for(self, full_name, now):
+        if full_name in self.hot or now - self.changed_at.get(full_name, -math.inf) < self.interval:
+            return self.hot_interval
+        return self.interval
+
+    # resource None stands for the whole repository (not verified yet, or
+    # failed); its documents are then fetched as the memo lacks them.
+    def _reschedule(self, full_name, resource, due_at):
+        self._due[full_name, resource] = due_at
+        heapq.heappush(self._schedule, (due_at, full_name, resource or ""))
+
+    def next_due(self):
+        while self._schedule:
+            due_at, full_name, resource = self._schedule[0]
+            if self._due.get((full_name, resource or None)) == due_at:
+                return due_at
+            heapq.heappop(self._schedule)
+        return None
+
+    # Re-verifies every repository with a due resource; returns their names.
+    def refresh(self):
+        now = self.clock.time()
+        due = collections.defaultdict(list)
+        while self.next_due() is not None and self._schedule[0][0] <= now:
+            _, full_name, resource = heapq.heappop(self._schedule)
+            del self._due[full_name, resource or None]
+            due[full_name].append(resource or None)
+        for full_name, resources in due.items():
+            owner, repo = parse_repository(full_name)
+            self.for_repository(owner, repo).forget(
+                (owner, repo, resource) for resource in resources if resource is not None
+            )
+        if due:
+            handled = set()
+            try:
+                verify_fleet(
+                    self.protocol,
+                    [parse_repository(full_name) for full_name in due],
+                    self.headers,
+                    self.max_workers,
+                    self.client,
+                    memo=self,
+                    on_result=functools.partial(self._on_result, due, now, handled),
+                    collect=False,
+                    on_settings=functools.partial(self._on_settings, now),
+                )
+            except Exception:
+                # Repositories the pass did not get to are retried like failed ones.
+                for full_name in due:
+                    if full_name not in handled:
+                        self._retry(full_name, due[full_name], now)
+                raise
+        return list(due)
+
+    def _retry(self, full_name, resources, now):
+        owner, repo = parse_repository(full_name)
+        memo = self.for_repository(owner, repo)
+        memo.forget(list(memo.failed()))
+        for resource in resources:
+            self._reschedule(full_name, resource, now + self.hot_interval)
+
+    def _on_settings(self, now, full_name, documents):
+        previous = self.settings.get(full_name)
+        if previous is not None and previous != documents:
+            self.changed_at[full_name] = now
+        self.settings[full_name] = documents
+
+    def _on_result(self, due, now, handled, full_name, results, error):
+        handled.add(full_name)
+        with self._lock:
+            state = dict(self.state.get(full_name, {}), checked_at=now, error=error)
+            if error is None:
+                state.update(results=results, verified_at=now)
+            self.state[full_name] = state
+        if error is not None:
+            self._retry(full_name, due[full_name], now)
+            return
+        interval = self.interval_for(full_name, now)
+        for resource in self.settings.get(full_name, {}):
+            if (full_name, resource) not in self._due:
+                self._reschedule(full_name, resource, now + interval)
+
+    def results(self, full_name=None):
+        with self._lock:
+            if full_name is not None:
+                return self.state.get(full_name)
+            return dict(self.state)
+
+    # A failed pass is reported and its repositories retried; it never ends
+    # the loop.
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error: refresh failed: {e}", file=sys.stderr)
+            due_at = self.next_due()
+            wait = self.interval if due_at is None else max(0.0, due_at - self.clock.time())
+            self._stopped.wait(wait)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class _WatchHandler(http.server.BaseHTTPRequestHandler):
+    daemon = None
+
+    def log_message(self, format, *args):
+        pass
+
+    # Unix socket peers have no (host, port) address.
+    def address_string(self):
+        return str(self.client_address)
+
+    def _send(self, status, body, content_type="application/json"):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path.rstrip("/")
+        if path == "/metrics":
+            if METRICS is None:
+                return self._send(404, json.dumps({"error": "metrics are not enabled"}))
+            return self._send(200, METRICS.prometheus(), "text/plain; version=0.0.4")
+        if path == "/healthz":
+            state = self.daemon.results()
+            body = {
+                "repositories": len(self.daemon.repositories),
+                "verified": sum("results" in entry for entry in state.values()),
+                "errors": sum(entry["error"] is not None for entry in state.values()),
+            }
+            return self._send(200, json.dumps(body))
+        if path == "/results":
+            return self._send(200, json.dumps(self.daemon.results()))
+        if path.startswith("/results/"):
+            state = self.daemon.results(path[len("/results/") :])
+            if state is None:
+                return self._send(404, json.dumps({"error": "repository is not watched"}))
+            return self._send(200, json.dumps(state))
+        self._send(404, json.dumps({"error": "not found"}))
+
+
+class _WatchServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixWatchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# Serves the daemon's current results read-only: GET /results (every
+# repository), /results/OWNER/REPO, /healthz and, with metrics enabled,
+# /metrics. address is "HOST:PORT" or, for a Unix socket, a path; a stale
+# socket left at the path is replaced, any other file is an error.
+def serve_watch_results(daemon, address=DEFAULT_WATCH_ADDRESS):
+    handler = type("WatchHandler", (_WatchHandler,), {"daemon": daemon})
+    if "/" in address:
+        try:
+            mode = os.lstat(address).st_mode
+        except FileNotFoundError:
+            mode = None
+        if mode is not None:
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError(f"Cannot listen on {address}: the file exists and is not a socket")
+            os.unlink(address)
+        server = _UnixWatchServer(address, handler)
+    else:
+        host, port = address.rsplit(":", 1)
+        server = _WatchServer((host, int(port)), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_watch(args, protocol, repositories, headers, client):
+    daemon = WatchDaemon(
+        protocol,
+        repositories,
+        headers,
+        client,
+        args.max_workers,
+        args.refresh_interval,
+        args.hot_interval,
+        args.hot_repos or (),
+    )
+    server = serve_watch_results(daemon, args.listen)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.stop()
+        server.shutdown()
+        server.server_close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Verify GitHub repository settings against a protocol file.")
+    parser.add_argument("--protocol", default="protocol.yml", help="path to the protocol file")
+    parser.add_argument(
+        "--base-protocol",
+        help="org-level protocol that --protocol and per-repository override files extend",
+    )
+    parser.add_argument(
+        "--override-dir",
+        help="fleet mode: directory with OWNER/REPO.yml protocol overrides merged over --base-protocol",
+    )
+    parser.add_argument("--plan-cache-dir", help="directory for compiled protocol plans, keyed by file hash")
+    parser.add_argument(
+        "--stream",
+        metavar="PATH",
+        help="fleet mode: write each repository's results to this NDJSON file as soon as it is verified",
+    )
+    parser.add_argument(
+        "--report-from-stream",
+        metavar="PATH",
+        help="build the --format report from an NDJSON stream file and exit",
+    )
+    sharding = parser.add_mutually_exclusive_group()
+    sharding.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="INDEX/COUNT",
+        help="fleet mode: verify only this shard and write its partial to --stream (default shard-I-of-N.ndjson)",
+    )
+    sharding.add_argument("--shards", type=int, help="fleet mode: verify in this many shard processes and merge")
+    sharding.add_argument(
+        "--merge-shards",
+        nargs="+",
+        metavar="PARTIAL",
+        help="merge shard partials into one --format report (and --stream, if given) and exit",
+    )
+    parser.add_argument(
+        "--snapshot",
+        metavar="PATH",
+        help="capture every GitHub response of this run into a snapshot file",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="PATH",
+        help="answer every GitHub request from a snapshot file instead of the network",
+    )
+    parser.add_argument("--store", metavar="PATH", help="append each run's results to this SQLite result store")
+    parser.add_argument(
+        "--drift-since",
+        metavar="YYYY-MM-DD",
+        help="print the checks in --store that passed at this date and fail now, and exit",
+    )
+    parser.add_argument(
+        "--format",
+        nargs="+",
+        choices=sorted(REPORT_SINKS),
+        default=["html"],
+        help="one or more report formats, all rendered in the same pass",
+    )
+    fleet = parser.add_mutually_exclusive_group()
+    fleet.add_argument("--repos", nargs="+", metavar="OWNER/REPO", help="verify these repositories")
+    fleet.add_argument("--repos-file", help="file with one OWNER/REPO per line")
+    fleet.add_argument("--org", help="verify every repository of this organization")
+    fleet.add_argument(
+        "--changes",
+        metavar="EVENTS",
+        help="re-verify only the branches/environments touched by this JSONL feed of webhook or audit-log events",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help="maximum number of concurrent GitHub requests in fleet mode",
+    )
+    parser.add_argument("--connect-timeout", type=float, default=10, help="seconds to wait for a connection")
+    parser.add_argument("--read-timeout", type=float, default=30, help="seconds to wait for a response")
+    parser.add_argument("--max-retries", type=int, default=3, help="retries for failed idempotent requests")
+    parser.add_argument(
+        "--backend",
+        choices=["rest", "graphql"],
+        default="rest",
+        help="fetch protection settings per rule (rest) or per repository in one query (graphql)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=DEFAULT_TOKEN_RATE,
+        help="sustained requests per second allowed per token",
+    )
+    parser.add_argument("--burst", type=int, default=DEFAULT_TOKEN_BURST, help="request burst allowed per token")
+    parser.add_argument("--cache-dir", help="directory for the conditional-request (ETag) response cache")
+    parser.add_argument(
+        "--cache-max-mb",
+        type=float,
+        default=DEFAULT_CACHE_MAX_BYTES / (1024 * 1024),
+        help="evict least recently used cache entries beyond this size",
+    )
+    parser.add_argument(
+        "--cache-max-age",
+        type=float,
+        default=DEFAULT_CACHE_MAX_AGE / 3600,
+        help="evict cache entries unused for this many hours",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running: refresh settings as they become stale and serve current results over --listen",
+    )
+    parser.add_argument(
+        "--listen",
+        default=DEFAULT_WATCH_ADDRESS,
+        help="watch mode: HOST:PORT or Unix socket path to serve results on",
+    )
+    parser.add_argument(
+        "--refresh-interval",
+        type=float,
+        default=DEFAULT_REFRESH_INTERVAL,
+        help="watch mode: seconds after which a repository's settings are fetched again",
+    )
+    parser.add_argument(
+        "--hot-interval",
+        type=float,
+        default=DEFAULT_HOT_INTERVAL,
+        help="watch mode: refresh interval for --hot-repos and repositories whose settings recently changed",
+    )
+    parser.add_argument("--hot-repos", nargs="+", metavar="OWNER/REPO", help="watch mode: always use --hot-interval")
+    parser.add_argument(
+        "--metrics-file",
+        metavar="PATH",
+        help="write request, cache, retry and stage metrics to this Prometheus textfile on exit",
+    )
+    parser.add_argument(
+        "--trace-file",
+        metavar="PATH",
+        help="write a span per stage and GitHub request to this Chrome trace JSON file on exit",
+    )
+    args = parser.parse_args(argv)
+    if args.shards and args.snapshot:
+        parser.error("--snapshot cannot be combined with --shards: shard processes cannot share one snapshot file")
+    if args.drift_since and not args.store:
+        parser.error("--drift-since requires --store")
+    return args
+
+
+def _on_each(callbacks):
+    def on_result(full_name, results, error):
+        for callback in callbacks:
+            callback(full_name, results, error)
+
+    return on_result if callbacks else None
+
+
+def report_shards(paths, format, stream_path=None):
+    with tempfile.TemporaryDirectory() as directory:
+        stream_path = stream_path or os.path.join(directory, "merged.ndjson")
+        merge_shards(paths, stream_path)
+        report_from_stream(stream_path, format=format)
+
+
+# Fleet mode of the CLI: --stream and --store both receive each repository as
+# soon as it is verified; with --stream the report is built from the stream.
+# With --changes only the changed pairs are verified, stored as a partial run,
+# and the report shows each changed repository's merged stored state. With
+# --shard only the partial is written; --shards runs all of them locally.
+def run_fleet(args, protocol, repositories, headers, client, client_options=None):
+    if args.shard:
+        index, count = args.shard
+        output_path = args.stream or f"shard-{index}-of-{count}.ndjson"
+        verify_shard(protocol, repositories, headers, index, count, output_path, args.max_workers, client, args.backend)
+        return
+    if args.shards:
+        with tempfile.TemporaryDirectory() as directory:
+            paths = verify_sharded(
+                protocol,
+                repositories,
+                headers,
+                args.shards,
+                directory,
+                args.max_workers,
+                args.backend,
+                client_options,
+            )
+            report_shards(paths, args.format, args.stream)
+        return
+    changes = load_change_events(args.changes) if args.changes else None
+    with contextlib.ExitStack() as stack:
+        callbacks = []
+        on_settings = None
+        if args.stream:
+            writer = NDJSONWriter(stack.enter_context(open(args.stream, "w")))
+            writer.run()
+            callbacks.append(writer.on_result)
+        if args.store:
+            store = stack.enter_context(ResultStore(args.store))
+            run = stack.enter_context(store.run(partial=changes is not None))
+            callbacks.append(run.on_result)
+            on_settings = run.on_settings
+        options = {"on_result": _on_each(callbacks), "collect": not args.stream, "on_settings": on_settings}
+        if changes is not None:
+            results, errors = verify_changes(protocol, changes, headers, args.max_workers, client, **options)
+        else:
+            results, errors = verify_fleet(
+                protocol, repositories, headers, args.max_workers, client, args.backend, **options
+            )
+    if changes is not None and args.store and not args.stream:
+        with ResultStore(args.store) as store:
+            results = {repository: store.results(repository) for repository in results}
+    if args.stream:
+        report_from_stream(args.stream, format=args.format)
+    else:
+        report_fleet_results(results, errors, format=args.format)
+
+
+# The CLI's client, from plain values so that shard processes can build the
+# same one: a SnapshotClient with replay, else a pooled GitHubClient with the
+# ETag cache and a rate-limit scheduler over the tokens, recording into a
+# snapshot when one is given.
+def build_client(
+    tokens=(),
+    max_workers=DEFAULT_MAX_WORKERS,
+    connect_timeout=10,
+    read_timeout=30,
+    max_retries=3,
+    rate=DEFAULT_TOKEN_RATE,
+    burst=DEFAULT_TOKEN_BURST,
+    cache_dir=None,
+    cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+    cache_max_age=DEFAULT_CACHE_MAX_AGE,
+    replay=None,
+    snapshot=None,
+):
+    if replay:
+        return SnapshotClient(replay)
+    cache = None
+    if cache_dir:
+        cache = ResponseCache(cache_dir, max_bytes=cache_max_bytes, max_age=cache_max_age)
+    client = GitHubClient(
+        pool_maxsize=max_workers,
+        timeout=(connect_timeout, read_timeout),
+        max_retries=max_retries,
+        cache=cache,
+        scheduler=RateLimitScheduler(list(tokens), rate=rate, burst=burst) if tokens else None,
+    )
+    if snapshot:
+        client = SnapshotRecorder(client, SnapshotWriter(snapshot))
+    return client
+
+
+def cli_client_options(args, tokens):
+    return {
+        "tokens": tuple(tokens),
+        "max_workers": args.max_workers,
+        "connect_timeout": args.connect_timeout,
+        "read_timeout": args.read_timeout,
+        "max_retries": args.max_retries,
+        "rate": args.rate,
+        "burst": args.burst,
+        "cache_dir": args.cache_dir,
+        "cache_max_bytes": int(args.cache_max_mb * 1024 * 1024),
+        "cache_max_age": args.cache_max_age * 3600,
+        "replay": args.replay,
+        "snapshot": args.snapshot,
+    }
+
+
+def write_metrics(metrics, metrics_path=None, trace_path=None):
+    if metrics_path:
+        metrics.write_prometheus(metrics_path)
+    if trace_path:
+        metrics.write_trace(trace_path)
+
+
+def print_drift(store_path, since):
+    with ResultStore(store_path) as store:
+        for drift in store.drift(datetime.strptime(since, "%Y-%m-%d").timestamp()):
+            failed_at = datetime.fromtimestamp(drift["failed_at"]).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{drift['repository']} {drift['target']} {drift['rule']}: PASS -> FAIL ({failed_at})")
+
+
+def fleet_repositories(args, headers, client=None):
+    if args.repos:
+        return [parse_repository(name) for name in args.repos]
+    if args.repos_file:
+        return load_repository_list(args.repos_file)
+    if args.org:
+        return list_organization_repositories(args.org, headers, client)
+    return None
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.metrics_file or args.trace_file:
+        atexit.register(write_metrics, enable_metrics(trace=bool(args.trace_file)), args.metrics_file, args.trace_file)
+
+    if args.report_from_stream:
+        report_from_stream(args.report_from_stream, format=args.format)
+        sys.exit(0)
+    if args.drift_since:
+        print_drift(args.store, args.drift_since)
+        sys.exit(0)
+    if args.merge_shards:
+        report_shards(args.merge_shards, args.format, args.stream)
+        sys.exit(0)
+
+    GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
+    # Optional comma-separated pool of tokens or app installation tokens, each
+    # with its own rate-limit budget.
+    GITHUB_TOKENS = [token.strip() for token in os.getenv("GITHUB_TOKENS", "").split(",") if token.strip()]
+    if not GITHUB_TOKEN and not GITHUB_TOKENS and not args.replay:
+        raise EnvironmentError("GITHUB_TOKEN environment variable is not set")
+    GITHUB_TOKEN = GITHUB_TOKEN or (GITHUB_TOKENS[0] if GITHUB_TOKENS else "")
+
+    headers = {
+        "Authorization": f"token {GITHUB_TOKEN}",
+        "Accept": "application/vnd.github.v3+json",
+    }
+
+    client_options = cli_client_options(args, GITHUB_TOKENS or [GITHUB_TOKEN])
+    client = build_client(**client_options)
 
     try:
-        protocol = load_protocol("protocol.yml")
-        verification_results = verify_branch_protection(protocol, headers)
-        report_results(verification_results, format="html")
+        repositories = fleet_repositories(args, headers, client)
+        fleet = repositories is not None or args.changes
+        if args.base_protocol or args.override_dir:
+            resolver = ProtocolResolver(args.base_protocol or args.protocol, args.override_dir)
+            protocol = resolver if fleet else resolver.plan(args.protocol)
+        else:
+            protocol = load_plan(args.protocol, args.plan_cache_dir)
+        if args.watch:
+            run_watch(args, protocol, repositories or [_repository(protocol)], headers, client)
+        elif not fleet:
+            memo = None
+            if args.backend == "graphql":
+                verification_results = verify_repository_graphql(protocol, headers, client)
+            else:
+                memo = ProtectionMemo()
+                verification_results = verify_branch_protection(protocol, headers, client=client, memo=memo)
+            repository = f"{protocol.owner}/{protocol.repo}"
+            if args.store:
+                settings = {key[2]: document for key, document in memo.documents()} if memo else {}
+                with ResultStore(args.store) as store:
+                    store.record_run({repository: verification_results}, settings={repository: settings})
+            report_results(verification_results, args.format, repository)
+        else:
+            run_fleet(args, protocol, repositories, headers, client, client_options)
     except Exception as e:
         print(f"Error: {e}")
+    finally:
+        client.close()
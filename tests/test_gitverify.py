@@ -1,9 +1,15 @@
+import io
+import asyncio
 import os
 import sys
 import pytest
+import threading
 import requests
+import socket
 import yaml
-from unittest.mock import patch, mock_open
+import json
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch, mock_open
 
 # Adjust the import path to the location of the gitverify.py file
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -15,7 +21,55 @@ from gitverify import (
     verify_branch_protection,
     verify_environment_protection,
     report_results,
+    parse_repository,
+    list_organization_repositories,
+    verify_fleet,
+    GitHubClient,
+    ResponseCache,
+    verify_repository_graphql,
+    RateLimitScheduler,
+    ProtectionMemo,
+    compile_protocol,
+    load_plan,
+    ProtocolResolver,
+    AsyncGitHubClient,
+    verify_branch_protection_async,
+    verify_fleet_async,
+    NDJSONWriter,
+    report_fleet_results,
+    report_from_stream,
+    render_report,
+    HTMLReportSink,
+    JSONReportSink,
+    TextReportSink,
+    ResultStore,
+    load_change_events,
+    verify_changes,
+    Snapshot,
+    SnapshotClient,
+    SnapshotRecorder,
+    SnapshotWriter,
+    shard_of,
+    verify_shard,
+    verify_sharded,
+    merge_shards,
+    read_stream,
+    SettingsTable,
+    evaluate_table,
+    verify_status_checks,
+    CodeOwners,
+    verify_code_owners,
+    get_code_owners,
+    iter_branches,
+    branch_matches,
+    branch_protection_from_graphql,
+    enable_metrics,
+    disable_metrics,
+    endpoint_label,
+    WatchDaemon,
+    serve_watch_results,
 )
+from fake_github import FakeGitHub
 
 
 def test_load_protocol_valid_file():
@@ -413,3 +467,1406 @@ def test_report_results_markdown():
         assert "## Environment: Production" in content
         assert "- **required_reviewers:** PASS" in content
         assert "- **required_approvers:** PASS" in content
+
+
+def test_parse_repository():
+    assert parse_repository("test_owner/test_repo") == ("test_owner", "test_repo")
+    with pytest.raises(ValueError):
+        parse_repository("test_repo")
+
+
+def test_list_organization_repositories_follows_pagination():
+    first_page = Mock()
+    first_page.json.return_value = [{"name": "repo_a"}, {"name": "repo_b"}]
+    first_page.links = {"next": {"url": "https://api.github.com/orgs/test_owner/repos?page=2"}}
+    second_page = Mock()
+    second_page.json.return_value = [{"name": "repo_c"}]
+    second_page.links = {}
+    headers = {"Authorization": "token test_token"}
+    with patch("requests.get", side_effect=[first_page, second_page]) as mock_get:
+        repositories = list_organization_repositories("test_owner", headers)
+        assert repositories == [("test_owner", "repo_a"), ("test_owner", "repo_b"), ("test_owner", "repo_c")]
+        assert mock_get.call_count == 2
+
+
+def test_verify_fleet():
+    protocol = {
+        "protocol": {
+            "branch_protection_rules": [
+                {
+                    "branch": "main",
+                    "required_reviewers": 2,
+                    "allow_force_push": False,
+                    "allow_bypass": False,
+                },
+            ],
+            "environments": [
+                {
+                    "name": "Production",
+                    "required_reviewers": 3,
+                    "required_approvers": ["Reviewer 1", "Reviewer 2"]
+                },
+            ],
+        }
+    }
+    branch_protection = {
+        "required_pull_request_reviews": {"required_approving_review_count": 2},
+        "allow_force_pushes": {"enabled": False},
+        "enforce_admins": {"enabled": False},
+    }
+    env_protection = {
+        "required_reviewers": 1,
+        "approvers": ["Reviewer 1", "Reviewer 2"]
+    }
+
+    def branch_rules(owner, repo, branch, headers, client=None):
+        if repo == "broken_repo":
+            raise ConnectionError("Error fetching branch protection rules: 404")
+        return branch_protection
+
+    headers = {"Authorization": "token test_token"}
+    repositories = [("test_owner", "repo_a"), ("test_owner", "broken_repo"), ("other_owner", "repo_b")]
+    with patch("gitverify.get_branch_protection_rules", side_effect=branch_rules) as mock_branch:
+        with patch("gitverify.get_environment_protection_rules", return_value=env_protection):
+            results, errors = verify_fleet(protocol, repositories, headers, max_workers=4)
+    assert list(results) == ["test_owner/repo_a", "other_owner/repo_b"]
+    assert results["test_owner/repo_a"]["main"]["required_reviewers"] is True
+    assert results["test_owner/repo_a"]["Production"]["required_reviewers"] is False
+    assert results["other_owner/repo_b"]["Production"]["required_approvers"] is True
+    assert "404" in errors["test_owner/broken_repo"]
+    assert ("other_owner", "repo_b", "main", headers) in [call.args[:4] for call in mock_branch.call_args_list]
+
+
+def _response(status_code, payload=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(payload).encode() if payload is not None else b""
+    response.raw = io.BytesIO(response._content)
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+def test_github_client_retries_transient_failures():
+    delays = []
+    client = GitHubClient(max_retries=3, sleep=delays.append)
+    responses = [
+        requests.exceptions.ConnectionError("connection reset"),
+        _response(503),
+        _response(200, {"enforce_admins": {"enabled": True}}),
+    ]
+    with patch.object(client.session, "request", side_effect=responses) as mock_request:
+        protection = get_branch_protection_rules("test_owner", "test_repo", "main", {}, client)
+    assert protection["enforce_admins"]["enabled"] is True
+    assert mock_request.call_count == 3
+    assert len(delays) == 2
+    assert all(0 <= delay <= client.backoff_factor * 2**attempt for attempt, delay in enumerate(delays))
+
+
+def test_github_client_gives_up_after_max_retries():
+    client = GitHubClient(max_retries=2, sleep=lambda delay: None)
+    with patch.object(client.session, "request", return_value=_response(502)) as mock_request:
+        with pytest.raises(ConnectionError):
+            get_environment_protection_rules("test_owner", "test_repo", "production", {}, client)
+    assert mock_request.call_count == 3
+
+
+def test_github_client_does_not_retry_non_idempotent_requests():
+    client = GitHubClient(max_retries=3, sleep=lambda delay: None)
+    with patch.object(client.session, "request", return_value=_response(503)) as mock_request:
+        response = client.request("POST", "https://api.github.com/graphql")
+    assert response.status_code == 503
+    assert mock_request.call_count == 1
+
+
+def test_github_client_serves_not_modified_from_cache(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    client = GitHubClient(cache=cache)
+    fresh = _response(200, {"required_reviewers": 3, "approvers": ["Reviewer 1"]})
+    fresh.headers["ETag"] = '"abc"'
+    headers = {"Authorization": "token test_token"}
+    with patch.object(client.session, "request", side_effect=[fresh, _response(304)]) as mock_request:
+        first = get_environment_protection_rules("test_owner", "test_repo", "production", headers, client)
+        second = get_environment_protection_rules("test_owner", "test_repo", "production", headers, client)
+    assert first == second == {"required_reviewers": 3, "approvers": ["Reviewer 1"]}
+    assert "If-None-Match" not in mock_request.call_args_list[0].kwargs["headers"]
+    assert mock_request.call_args_list[1].kwargs["headers"]["If-None-Match"] == '"abc"'
+
+
+def test_response_cache_is_keyed_by_token(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    url = "https://api.github.com/repos/test_owner/test_repo/branches/main/protection"
+    first = cache.key(url, {"Authorization": "token first_token"})
+    second = cache.key(url, {"Authorization": "token second_token"})
+    assert first != second
+    cache.put(first, {"url": url, "etag": '"abc"', "last_modified": None, "body": "{}"})
+    assert cache.get(first)["etag"] == '"abc"'
+    assert cache.get(second) is None
+    assert not any("first_token" in path.read_text() for path in tmp_path.iterdir())
+
+
+def test_response_cache_evicts_by_age_and_size(tmp_path):
+    now = [1000.0]
+    cache = ResponseCache(str(tmp_path), max_bytes=250, max_age=100, clock=lambda: now[0])
+    entry = {"url": "u", "etag": '"e"', "last_modified": None, "body": "x" * 50}
+    cache.put("old", entry)
+    now[0] += 150
+    assert cache.get("old") is None
+    cache.put("a", entry)
+    now[0] += 1
+    cache.put("b", entry)
+    now[0] += 1
+    cache.get("a")
+    cache.touch("a")
+    now[0] += 1
+    cache.put("c", entry)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+GRAPHQL_REPOSITORY = {
+    "branchProtectionRules": {
+        "nodes": [
+            {
+                "pattern": "main",
+                "requiredApprovingReviewCount": 2,
+                "allowsForcePushes": False,
+                "isAdminEnforced": False,
+                "requiredStatusCheckContexts": ["build"],
+            },
+            {
+                "pattern": "release*",
+                "requiredApprovingReviewCount": 1,
+                "allowsForcePushes": True,
+                "isAdminEnforced": False,
+                "requiredStatusCheckContexts": [],
+            },
+        ]
+    },
+    "environments": {
+        "nodes": [
+            {
+                "name": "Production",
+                "protectionRules": {
+                    "nodes": [
+                        {"type": "WAIT_TIMER", "reviewers": {"nodes": []}},
+                        {
+                            "type": "REQUIRED_REVIEWERS",
+                            "reviewers": {"nodes": [{"login": "reviewer1", "name": "Reviewer 1"}, {"slug": "qa", "name": "QA"}]},
+                        },
+                    ]
+                },
+            }
+        ]
+    },
+}
+
+GRAPHQL_PROTOCOL = {
+    "protocol": {
+        "Github": {"organization": "test_owner", "project": "test_repo"},
+        "branch_protection_rules": [
+            {"branch": "main", "required_reviewers": 2, "allow_force_push": False, "allow_bypass": False},
+            {"branch": "release", "required_reviewers": 2, "allow_force_push": False, "allow_bypass": False},
+        ],
+        "environments": [
+            {"name": "Production", "required_reviewers": 2, "required_approvers": ["Reviewer 1", "QA"]},
+        ],
+    }
+}
+
+
+def test_verify_repository_graphql_uses_one_request():
+    headers = {"Authorization": "token test_token"}
+    with patch("requests.post", return_value=_response(200, {"data": {"repository": GRAPHQL_REPOSITORY}})) as mock_post:
+        results = verify_repository_graphql(GRAPHQL_PROTOCOL, headers)
+    assert mock_post.call_count == 1
+    assert mock_post.call_args.kwargs["json"]["variables"] == {"owner": "test_owner", "name": "test_repo"}
+    assert results == {
+        "main": {"required_reviewers": True, "allow_force_push": True, "allow_bypass": True},
+        "release": {"required_reviewers": False, "allow_force_push": False, "allow_bypass": True},
+        "Production": {"required_reviewers": True, "required_approvers": True},
+    }
+
+
+def test_verify_fleet_graphql_batches_repositories():
+    payload = {
+        "data": {"r0": GRAPHQL_REPOSITORY, "r1": None},
+        "errors": [{"path": ["r1"], "message": "Could not resolve to a Repository"}],
+    }
+    client = GitHubClient()
+    repositories = [("test_owner", "repo_a"), ("test_owner", "missing_repo")]
+    with patch.object(client.session, "request", return_value=_response(200, payload)) as mock_request:
+        results, errors = verify_fleet(GRAPHQL_PROTOCOL, repositories, {}, client=client, backend="graphql")
+    assert mock_request.call_count == 1
+    query = mock_request.call_args.kwargs["json"]["query"]
+    assert 'r0: repository(owner: "test_owner", name: "repo_a")' in query
+    assert results["test_owner/repo_a"]["main"]["required_reviewers"] is True
+    assert "Could not resolve" in errors["test_owner/missing_repo"]
+
+
+def test_rest_and_graphql_backends_match_branches_alike():
+    # One repository whose GitHub rule "release/*" protects release/1.0 but,
+    # as "*" does not match "/", not release/1.0/fix.
+    node = dict(GRAPHQL_REPOSITORY["branchProtectionRules"]["nodes"][0], pattern="release/*")
+    repository = {"branchProtectionRules": {"nodes": [node]}, "environments": {"nodes": []}}
+    protection = dict(branch_protection_from_graphql(node))
+    del protection["pattern"]
+
+    def request(method, url, **kwargs):
+        if method == "POST":
+            return _response(200, {"data": {"r0": repository}})
+        if url.endswith("/branches/release/1.0/protection"):
+            return _response(200, protection)
+        return _response(404, {"message": "Branch not protected"})
+
+    verdicts = {}
+    for branch in ["release/1.0", "release/1.0/fix"]:
+        protocol = {
+            "protocol": {
+                "branch_protection_rules": [
+                    {"branch": branch, "required_reviewers": 2, "allow_force_push": False, "allow_bypass": False}
+                ]
+            }
+        }
+        for backend in ["rest", "graphql"]:
+            client = GitHubClient(max_retries=0)
+            with patch.object(client.session, "request", side_effect=request):
+                results, errors = verify_fleet(protocol, [("test_owner", "test_repo")], {}, client=client, backend=backend)
+            verdicts[branch, backend] = results, sorted(errors)
+    assert verdicts["release/1.0", "rest"] == verdicts["release/1.0", "graphql"]
+    assert verdicts["release/1.0", "rest"][0]["test_owner/test_repo"]["release/1.0"]["required_reviewers"] is True
+    assert verdicts["release/1.0/fix", "rest"] == verdicts["release/1.0/fix", "graphql"] == ({}, ["test_owner/test_repo"])
+
+
+class FakeClock:
+    def __init__(self, now=1_700_000_000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def _rate_limited_response(status_code, remaining, reset, retry_after=None):
+    response = _response(status_code, {})
+    response.headers["X-RateLimit-Remaining"] = str(remaining)
+    response.headers["X-RateLimit-Reset"] = str(reset)
+    if retry_after is not None:
+        response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+def test_rate_limit_scheduler_paces_with_token_bucket():
+    clock = FakeClock()
+    scheduler = RateLimitScheduler(["token_a"], rate=2.0, burst=2, clock=clock)
+    assert [scheduler.acquire() for _ in range(3)] == ["token_a"] * 3
+    assert clock.sleeps == [0.5]
+
+
+def test_rate_limit_scheduler_spreads_load_over_token_pool():
+    clock = FakeClock()
+    scheduler = RateLimitScheduler(["token_a", "token_b"], clock=clock)
+    scheduler.update("token_a", _rate_limited_response(200, 0, clock.now + 600))
+    scheduler.update("token_b", _rate_limited_response(200, 100, clock.now + 600))
+    assert scheduler.acquire() == "token_b"
+    assert clock.sleeps == []
+
+    scheduler.update("token_b", _rate_limited_response(200, 0, clock.now + 300))
+    assert scheduler.acquire() == "token_b"
+    assert clock.sleeps == [300]
+
+
+def test_github_client_waits_for_retry_after():
+    clock = FakeClock()
+    scheduler = RateLimitScheduler(["token_a"], clock=clock)
+    client = GitHubClient(scheduler=scheduler)
+    responses = [
+        _rate_limited_response(429, 10, clock.now + 3600, retry_after=30),
+        _response(200, {"required_reviewers": 1, "approvers": []}),
+    ]
+    with patch.object(client.session, "request", side_effect=responses) as mock_request:
+        protection = get_environment_protection_rules("test_owner", "test_repo", "production", {}, client)
+    assert protection["required_reviewers"] == 1
+    assert mock_request.call_count == 2
+    assert mock_request.call_args.kwargs["headers"]["Authorization"] == "token token_a"
+    assert clock.sleeps == [30]
+    assert scheduler.waited == 30
+
+
+def test_verify_branch_protection_fetches_each_branch_once():
+    protocol = {
+        "protocol": {
+            "Github": {"organization": "test_owner", "project": "test_repo"},
+            "branch_protection_rules": [
+                {"branch": "main", "required_reviewers": 1, "allow_force_push": False, "allow_bypass": False},
+                {"branch": "main", "required_reviewers": 3, "allow_force_push": False, "allow_bypass": False},
+            ],
+            "environments": [],
+        }
+    }
+    branch_protection = {
+        "required_pull_request_reviews": {"required_approving_review_count": 2},
+        "allow_force_pushes": {"enabled": False},
+        "enforce_admins": {"enabled": False},
+    }
+    memo = ProtectionMemo()
+    with patch("gitverify.get_branch_protection_rules", return_value=branch_protection) as mock_branch:
+        results = verify_branch_protection(protocol, {}, memo=memo)
+        verify_branch_protection(protocol, {}, memo=memo)
+    assert mock_branch.call_count == 1
+    assert results["main"]["required_reviewers"] is False
+    assert dict(memo.documents()) == {("test_owner", "test_repo", "branches/main/protection"): branch_protection}
+
+
+def test_protection_memo_coalesces_concurrent_lookups():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_fetch(owner, repo, branch, headers, client=None):
+        calls.append(branch)
+        started.set()
+        release.wait(5)
+        return {"branch": branch}
+
+    memo = ProtectionMemo()
+    key = ("test_owner", "test_repo", "branches/main/protection")
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        first = memo.submit(key, executor, slow_fetch, "test_owner", "test_repo", "main", {})
+        started.wait(5)
+        second = memo.submit(key, executor, slow_fetch, "test_owner", "test_repo", "main", {})
+        release.set()
+        assert first.result() == second.result() == {"branch": "main"}
+    assert calls == ["main"]
+
+
+def test_compile_protocol_groups_rules():
+    plan = compile_protocol(load_protocol(os.path.join(os.path.dirname(__file__), "..", "protocol.yml")))
+    assert (plan.owner, plan.repo) == ("bidma-nn", "SQZC_sandbox")
+    assert [rule.branch for rule in plan.branch_rules] == ["main", "release"]
+    assert plan.branches["main"][0]["required_reviewers"] == 1
+    assert plan.environments["Production"].required_approvers == ("Reviewer 1", "Reviewer 2")
+    assert [(rule.branch, rule.checks) for rule in plan.status_checks] == [("main", ("build", "test"))]
+    assert plan.for_repository("test_owner", "test_repo").branch_rules is plan.branch_rules
+
+
+def test_compile_protocol_reports_malformed_entry():
+    protocol = {
+        "protocol": {
+            "branch_protection_rules": [
+                {"branch": "main", "required_reviewers": 1, "allow_force_push": False, "allow_bypass": False},
+                {"branch": "release", "required_reviewers": "two", "allow_force_push": False, "allow_bypass": False},
+            ]
+        }
+    }
+    with pytest.raises(ValueError, match=r"branch_protection_rules\[1\]\.required_reviewers"):
+        compile_protocol(protocol)
+
+
+def test_load_plan_caches_compiled_plan_by_content(tmp_path):
+    protocol_file = tmp_path / "protocol.yml"
+    protocol_file.write_text(
+        "protocol:\n"
+        "  Github: {organization: test_owner, project: test_repo}\n"
+        "  branch_protection_rules:\n"
+        "    - {branch: main, required_reviewers: 2, allow_force_push: false, allow_bypass: false}\n"
+    )
+    cache_dir = tmp_path / "plans"
+    first = load_plan(str(protocol_file), str(cache_dir))
+    with patch("yaml.load") as mock_load:
+        second = load_plan(str(protocol_file), str(cache_dir))
+    mock_load.assert_not_called()
+    assert second.branch_rules == first.branch_rules
+    assert second.branches["main"][0].required_reviewers == 2
+
+    protocol_file.write_text(protocol_file.read_text().replace("required_reviewers: 2", "required_reviewers: 3"))
+    assert load_plan(str(protocol_file), str(cache_dir)).branch_rules[0].required_reviewers == 3
+
+
+def _write_protocols(tmp_path):
+    (tmp_path / "base.yml").write_text(
+        "protocol:\n"
+        "  environments:\n"
+        "    - {name: Production, required_reviewers: 2, required_approvers: [Reviewer 1]}\n"
+        "  branch_protection_rules:\n"
+        "    - {branch: main, required_reviewers: 1, allow_force_push: false, allow_bypass: false}\n"
+        "    - {branch: release, required_reviewers: 2, allow_force_push: false, allow_bypass: false}\n"
+    )
+    (tmp_path / "team.yml").write_text(
+        "protocol:\n"
+        "  branch_protection_rules:\n"
+        "    - {branch: main, required_reviewers: 2}\n"
+    )
+    overrides = tmp_path / "overrides" / "test_owner"
+    overrides.mkdir(parents=True)
+    (overrides / "strict_repo.yml").write_text(
+        "extends: ../../team.yml\n"
+        "protocol:\n"
+        "  environments:\n"
+        "    - {name: Production, required_reviewers: 3}\n"
+        "    - {name: Test, required_reviewers: 1, required_approvers: []}\n"
+    )
+    (overrides / "same_repo.yml").write_text(
+        "protocol:\n"
+        "  branch_protection_rules:\n"
+        "    - {branch: main, required_reviewers: 1}\n"
+    )
+
+
+def test_protocol_resolver_merges_overrides_over_base(tmp_path):
+    _write_protocols(tmp_path)
+    resolver = ProtocolResolver(str(tmp_path / "base.yml"), str(tmp_path / "overrides"))
+    plan = resolver.plan_for("test_owner", "strict_repo")
+    assert (plan.owner, plan.repo) == ("test_owner", "strict_repo")
+    assert [(rule.branch, rule.required_reviewers) for rule in plan.branch_rules] == [("main", 2), ("release", 2)]
+    assert plan.environments["Production"].required_reviewers == 3
+    assert plan.environments["Production"].required_approvers == ("Reviewer 1",)
+    assert plan.environments["Test"].required_reviewers == 1
+
+
+def test_protocol_resolver_shares_rules_and_parses_base_once(tmp_path):
+    _write_protocols(tmp_path)
+    resolver = ProtocolResolver(str(tmp_path / "base.yml"), str(tmp_path / "overrides"))
+    with patch("yaml.load", wraps=yaml.load) as mock_load:
+        plans = [resolver.plan_for("test_owner", f"repo_{index}") for index in range(50)]
+        same = resolver.plan_for("test_owner", "same_repo")
+        strict = resolver.plan_for("test_owner", "strict_repo")
+    assert mock_load.call_count == 4
+    assert all(plan.branch_rules is plans[0].branch_rules for plan in plans)
+    assert same.branch_rules is plans[0].branch_rules
+    assert strict.branch_rules[1] is plans[0].branch_rules[1]
+    assert [plan.repo for plan in plans[:2]] == ["repo_0", "repo_1"]
+
+
+def test_protocol_resolver_rejects_inheritance_cycle(tmp_path):
+    (tmp_path / "a.yml").write_text("extends: b.yml\nprotocol: {}\n")
+    (tmp_path / "b.yml").write_text("extends: a.yml\nprotocol: {}\n")
+    with pytest.raises(ValueError, match="cycle"):
+        ProtocolResolver().plan(str(tmp_path / "a.yml"))
+
+
+def test_fleet_reports_a_malformed_override_as_an_error(tmp_path):
+    with FakeGitHub(repositories=3, branches=1, environments=0) as fake:
+        (tmp_path / "base.yml").write_text(yaml.safe_dump(fake.protocol()))
+        overrides = tmp_path / "overrides" / fake.organization
+        overrides.mkdir(parents=True)
+        (overrides / "repo-00001.yml").write_text(
+            "protocol:\n  branch_protection_rules:\n    - {branch: main, required_reviewers: two}\n"
+        )
+        resolver = ProtocolResolver(str(tmp_path / "base.yml"), str(tmp_path / "overrides"))
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            results, errors = verify_fleet(resolver, fake.repositories, {}, max_workers=2)
+    bad = f"{fake.organization}/repo-00001"
+    assert sorted(results) == [f"{fake.organization}/repo-00000", f"{fake.organization}/repo-00002"]
+    assert list(errors) == [bad]
+    assert "required_reviewers must be a non-negative integer" in errors[bad]
+
+
+async def _serve_protection(handler_calls, fail_repo=None):
+    web = pytest.importorskip("aiohttp.web")
+
+    async def branch(request):
+        handler_calls.append(request.path)
+        if request.match_info["repo"] == fail_repo:
+            return web.json_response({"message": "Not Found"}, status=404)
+        return web.json_response(
+            {
+                "required_pull_request_reviews": {"required_approving_review_count": 2},
+                "allow_force_pushes": {"enabled": False},
+                "enforce_admins": {"enabled": False},
+            }
+        )
+
+    async def environment(request):
+        handler_calls.append(request.path)
+        return web.json_response({"required_reviewers": 3, "approvers": ["Reviewer 1", "Reviewer 2"]})
+
+    app = web.Application()
+    app.router.add_get("/repos/{owner}/{repo}/branches/{branch}/protection", branch)
+    app.router.add_get("/repos/{owner}/{repo}/environments/{environment}/protection", environment)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+ASYNC_PROTOCOL = {
+    "protocol": {
+        "Github": {"organization": "test_owner", "project": "test_repo"},
+        "branch_protection_rules": [
+            {"branch": "main", "required_reviewers": 2, "allow_force_push": False, "allow_bypass": False},
+            {"branch": "main", "required_reviewers": 1, "allow_force_push": False, "allow_bypass": False},
+            {"branch": "release", "required_reviewers": 3, "allow_force_push": False, "allow_bypass": False},
+        ],
+        "environments": [
+            {"name": "Production", "required_reviewers": 3, "required_approvers": ["Reviewer 1"]},
+        ],
+    }
+}
+
+
+def test_verify_branch_protection_async():
+    pytest.importorskip("aiohttp")
+    calls = []
+
+    async def run():
+        runner, url = await _serve_protection(calls)
+        try:
+            with patch("gitverify.GITHUB_API_URL", url):
+                return await verify_branch_protection_async(ASYNC_PROTOCOL, {"Authorization": "token test_token"})
+        finally:
+            await runner.cleanup()
+
+    results = asyncio.run(run())
+    assert results == {
+        "main": {"required_reviewers": True, "allow_force_push": True, "allow_bypass": True},
+        "release": {"required_reviewers": False, "allow_force_push": True, "allow_bypass": True},
+        "Production": {"required_reviewers": True, "required_approvers": True},
+    }
+    assert sorted(calls) == [
+        "/repos/test_owner/test_repo/branches/main/protection",
+        "/repos/test_owner/test_repo/branches/release/protection",
+        "/repos/test_owner/test_repo/environments/Production/protection",
+    ]
+
+
+def test_verify_fleet_async_reports_failed_repositories():
+    pytest.importorskip("aiohttp")
+    calls = []
+    repositories = [("test_owner", f"repo_{index}") for index in range(20)] + [("test_owner", "broken_repo")]
+
+    async def run():
+        runner, url = await _serve_protection(calls, fail_repo="broken_repo")
+        try:
+            with patch("gitverify.GITHUB_API_URL", url):
+                async with AsyncGitHubClient(limit=10) as client:
+                    return await verify_fleet_async(ASYNC_PROTOCOL, repositories, {}, client=client)
+        finally:
+            await runner.cleanup()
+
+    results, errors = asyncio.run(run())
+    assert len(results) == 20
+    assert results["test_owner/repo_7"]["Production"]["required_approvers"] is True
+    assert "404" in errors["test_owner/broken_repo"]
+    assert len(calls) == 21 * 3
+
+
+def test_verify_fleet_against_fake_github(tmp_path):
+    with FakeGitHub(repositories=12, branches=3, environments=2, page_size=5) as fake:
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with GitHubClient(cache=ResponseCache(str(tmp_path))) as client:
+                repositories = list_organization_repositories(fake.organization, {}, client)
+                assert repositories == fake.repositories
+                results, errors = verify_fleet(fake.protocol(), repositories, {}, max_workers=4, client=client)
+                assert fake.requests == 3 + 12 * 5
+                rerun, _ = verify_fleet(fake.protocol(), repositories, {}, max_workers=4, client=client)
+    assert errors == {}
+    assert rerun == results
+    assert fake.not_modified == 12 * 5
+    for owner, repo in fake.repositories:
+        expected = fake.branch_protection(repo, "main")["required_pull_request_reviews"]["required_approving_review_count"]
+        assert results[f"{owner}/{repo}"]["main"]["required_reviewers"] is (expected >= 2)
+
+
+def test_fake_github_rate_limit_is_handled_by_scheduler():
+    clock = FakeClock()
+    with FakeGitHub(repositories=2, branches=2, environments=1, rate_limit=3) as fake:
+        scheduler = RateLimitScheduler(["token_a", "token_b"], clock=clock)
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with GitHubClient(scheduler=scheduler) as client:
+                results, errors = verify_fleet(fake.protocol(), fake.repositories, {}, max_workers=1, client=client)
+    assert errors == {}
+    assert len(results) == 2
+    assert fake.rate_limited == 0
+    assert clock.sleeps == []
+
+
+def test_stream_report_matches_in_memory_report(tmp_path):
+    stream_path = tmp_path / "results.ndjson"
+    with FakeGitHub(repositories=6, branches=2, environments=1) as fake:
+        repositories = fake.repositories + [("bench-org", "missing")]
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with GitHubClient() as client:
+                results, errors = verify_fleet(fake.protocol(), repositories, {}, max_workers=2, client=client)
+                with open(stream_path, "w") as stream:
+                    writer = NDJSONWriter(stream)
+                    writer.run("2024-01-01 00:00:00")
+                    streamed = verify_fleet(
+                        fake.protocol(),
+                        repositories,
+                        {},
+                        max_workers=2,
+                        client=client,
+                        window=1,
+                        on_result=writer.on_result,
+                        collect=False,
+                    )
+    assert streamed == ({}, {})
+    assert list(errors) == ["bench-org/missing"]
+
+    with patch("gitverify.datetime") as mock_datetime:
+        mock_datetime.now.return_value.strftime.return_value = "2024-01-01 00:00:00"
+        for format in ("json", "html", "markdown"):
+            report_fleet_results(results, errors, format, outputs={format: str(tmp_path / f"memory.{format}")})
+            report_from_stream(str(stream_path), format, outputs={format: str(tmp_path / f"stream.{format}")})
+            assert (tmp_path / f"stream.{format}").read_text() == (tmp_path / f"memory.{format}").read_text()
+    with open(tmp_path / "stream.json") as file:
+        assert json.load(file) == {"verification_date": "2024-01-01 00:00:00", "repositories": results, "errors": errors}
+
+
+def test_report_from_stream_skips_truncated_last_record(tmp_path):
+    stream_path = tmp_path / "results.ndjson"
+    with open(stream_path, "w") as stream:
+        writer = NDJSONWriter(stream)
+        writer.run("2024-01-01 00:00:00")
+        writer.on_result("o/a", {"main": {"required_reviewers": True}}, None)
+        stream.write('{"type": "repository", "repo')
+    report_from_stream(str(stream_path), "json", outputs={"json": str(tmp_path / "report.json")})
+    with open(tmp_path / "report.json") as file:
+        report = json.load(file)
+    assert report["repositories"] == {"o/a": {"main": {"required_reviewers": True}}}
+
+
+def test_render_report_feeds_every_sink_in_one_pass():
+    def repositories():
+        yield "o/a", {"main": {"required_reviewers": True}}
+        yield "o/b", {"Production": {"required_reviewers": False, "required_approvers": True}}
+
+    files = [io.StringIO(), io.StringIO(), io.StringIO()]
+    sinks = [JSONReportSink(files[0]), HTMLReportSink(files[1]), TextReportSink(files[2])]
+    render_report(sinks, repositories(), iter([("o/c", "boom")]), "2024-01-01 00:00:00")
+    assert json.loads(files[0].getvalue()) == {
+        "verification_date": "2024-01-01 00:00:00",
+        "repositories": {
+            "o/a": {"main": {"required_reviewers": True}},
+            "o/b": {"Production": {"required_reviewers": False, "required_approvers": True}},
+        },
+        "errors": {"o/c": "boom"},
+    }
+    assert "<h2>Repository: o/b</h2><ul><li>Environment: Production<ul>" in files[1].getvalue()
+    assert files[2].getvalue().splitlines() == [
+        "Repository: o/a",
+        "Branch: main",
+        "required_reviewers: PASS",
+        "Repository: o/b",
+        "Environment: Production",
+        "required_reviewers: FAIL",
+        "required_approvers: PASS",
+        "Repository: o/c",
+        "ERROR: boom",
+    ]
+
+
+def test_report_results_names_repository_and_writes_several_formats(tmp_path, capsys):
+    outputs = {"json": str(tmp_path / "report.json"), "markdown": str(tmp_path / "report.md")}
+    report_results({"main": {"required_reviewers": True}}, ["text", "json", "markdown"], "o/a", outputs)
+    with open(outputs["json"]) as file:
+        report = json.load(file)
+    assert report["repository"] == "o/a"
+    assert report["results"] == {"main": {"required_reviewers": True}}
+    assert "**Repository:** o/a" in open(outputs["markdown"]).read()
+    assert "Branch: main" in capsys.readouterr().out
+
+
+def test_result_store_answers_drift_trend_and_last_known_good(tmp_path):
+    passing = {"main": {"required_reviewers": True, "allow_force_push": True}}
+    failing = {"main": {"required_reviewers": False, "allow_force_push": True}}
+    with ResultStore(str(tmp_path / "results.db")) as store:
+        store.record_run(
+            {"o/a": passing, "o/b": passing},
+            settings={"o/a": {"branches/main/protection": {"reviews": 2}}},
+            started_at=100,
+        )
+        store.record_run({"o/a": failing, "o/b": passing}, {"o/c": "boom"}, started_at=200)
+        store.record_run({"o/b": failing}, started_at=300)
+
+        assert store.drift(since=150) == [
+            {"repository": "o/a", "target": "main", "rule": "required_reviewers", "failed_at": 200},
+            {"repository": "o/b", "target": "main", "rule": "required_reviewers", "failed_at": 300},
+        ]
+        assert store.drift(since=150, until=250) == [
+            {"repository": "o/a", "target": "main", "rule": "required_reviewers", "failed_at": 200},
+        ]
+        assert [(run["passed"], run["failed"]) for run in store.trend()] == [(4, 0), (3, 1), (1, 1)]
+        assert [run["failed"] for run in store.trend(repository="o/b", rule="required_reviewers")] == [0, 0, 1]
+        assert store.state()[("o/a", "main", "required_reviewers")] is False
+
+        good = store.last_known_good("o/a")
+        assert good["started_at"] == 100
+        assert good["settings"] == {"branches/main/protection": {"reviews": 2}}
+        assert store.last_known_good("o/b")["started_at"] == 200
+        assert store.last_known_good("o/c") is None
+
+
+def test_verify_fleet_records_results_and_settings_in_one_store_run(tmp_path):
+    with FakeGitHub(repositories=3, branches=2, environments=1) as fake:
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with ResultStore(str(tmp_path / "results.db")) as store:
+                with store.run(started_at=100) as run:
+                    verify_fleet(
+                        fake.protocol(),
+                        fake.repositories,
+                        {},
+                        max_workers=2,
+                        on_result=run.on_result,
+                        on_settings=run.on_settings,
+                        collect=False,
+                    )
+                state = store.state()
+                settings = store.settings("bench-org/repo-00000", run.id)
+    assert len(state) == 3 * (2 * 3 + 2)
+    assert settings["branches/main/protection"] == fake.branch_protection("repo-00000", "main")
+    assert settings["environments/env-0/protection"] == fake.environment_protection("repo-00000", "env-0")
+
+
+def test_load_change_events_reduces_feed_to_changed_pairs(tmp_path):
+    events = [
+        {"event": "branch_protection_rule", "action": "edited", "rule": {"name": "release/*"},
+         "repository": {"full_name": "o/a"}},
+        {"action": "requested", "environment": "Production", "deployment_callback_url": "https://x",
+         "event": "deployment", "repository": {"full_name": "o/a"}},
+        {"action": "protected_branch.update", "repo": "o/b", "branch": "main"},
+        {"action": "environment.update_protection_rule", "repo": "o/b", "environment_name": "Test"},
+        {"action": "repository_ruleset.create", "repo": "o/c"},
+        {"action": "repo.rename", "repo": "o/d"},
+    ]
+    path = tmp_path / "events.jsonl"
+    path.write_text("".join(json.dumps(event) + "\n" for event in events))
+    assert load_change_events(str(path)) == {
+        "o/a": {"branches": {"release/*"}, "environments": {"Production"}},
+        "o/b": {"branches": {"main"}, "environments": {"Test"}},
+        "o/c": {"branches": {"*"}, "environments": set()},
+    }
+
+
+def test_verify_changes_fetches_only_changed_pairs_and_merges_into_store(tmp_path):
+    with FakeGitHub(repositories=4, branches=3, environments=2) as fake:
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with ResultStore(str(tmp_path / "results.db")) as store:
+                with GitHubClient() as client:
+                    full, _ = verify_fleet(fake.protocol(), fake.repositories, {}, max_workers=2, client=client)
+                    store.record_run(full, started_at=100)
+                    fake.reset_stats()
+                    changes = {
+                        "bench-org/repo-00001": {"branches": {"branch-*"}, "environments": set()},
+                        "bench-org/repo-00002": {"branches": set(), "environments": {"env-0"}},
+                    }
+                    results, errors = verify_changes(fake.protocol(), changes, {}, 2, client)
+                    assert fake.requests == 2 + 1
+                store.record_run(results, errors, started_at=200, partial=True)
+                merged = store.results("bench-org/repo-00001")
+                trend = store.trend()
+    assert errors == {}
+    assert set(results["bench-org/repo-00001"]) == {"branch-1", "branch-2"}
+    assert set(results["bench-org/repo-00002"]) == {"env-0"}
+    assert merged == full["bench-org/repo-00001"]
+    assert len(trend) == 1
+
+
+def test_verify_changes_reverifies_pattern_rules_matching_changed_branches():
+    with FakeGitHub(repositories=1, branches=2, environments=1, extra_branches=3) as fake:
+        protocol = fake.protocol()
+        protocol["protocol"]["branch_protection_rules"].append(
+            {"branch": "feature/*", "required_reviewers": 0, "allow_force_push": True, "allow_bypass": False}
+        )
+        changes = {"bench-org/repo-00000": {"branches": {"feature/1"}, "environments": set()}}
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            results, errors = verify_changes(protocol, changes, {})
+        assert fake.requests == 1
+    assert errors == {}
+    assert set(results["bench-org/repo-00000"]) == {"feature/0", "feature/1", "feature/2"}
+
+
+def test_snapshot_replays_a_run_without_network(tmp_path):
+    path = str(tmp_path / "run.snapshot")
+    with FakeGitHub(repositories=3, branches=2, environments=1, page_size=2) as fake:
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with SnapshotRecorder(GitHubClient(), SnapshotWriter(path)) as client:
+                repositories = list_organization_repositories(fake.organization, {}, client)
+                live = verify_fleet(fake.protocol(), repositories, {}, max_workers=2, client=client)
+                single = verify_branch_protection(fake.protocol(), {}, client=client)
+    with Snapshot(path) as snapshot:
+        assert len(snapshot) == 2 + 3 * 3
+        status, headers, body = snapshot.get("GET /repos/bench-org/repo-00000/branches/main/protection")
+        assert status == 200
+        assert json.loads(body) == fake.branch_protection("repo-00000", "main")
+
+    with patch("gitverify.GITHUB_API_URL", "http://127.0.0.1:9"):
+        with SnapshotClient(path) as client:
+            assert list_organization_repositories(fake.organization, {}, client) == repositories
+            assert verify_fleet(fake.protocol(), repositories, {}, max_workers=2, client=client) == live
+            assert verify_branch_protection(fake.protocol(), {}, client=client) == single
+            _, errors = verify_fleet(fake.protocol(), [("bench-org", "unknown")], {}, client=client)
+    assert "is not in snapshot" in errors["bench-org/unknown"]
+
+
+def test_merged_shards_report_like_a_single_process_run(tmp_path):
+    with FakeGitHub(repositories=9, branches=2, environments=1) as fake:
+        repositories = fake.repositories + [("bench-org", "missing")]
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with GitHubClient() as client:
+                results, errors = verify_fleet(fake.protocol(), repositories, {}, max_workers=2, client=client)
+                paths = []
+                for index in range(3):
+                    paths.append(str(tmp_path / f"shard-{index}.ndjson"))
+                    verify_shard(fake.protocol(), repositories, {}, index, 3, paths[-1], 2, client)
+            processes = verify_sharded(compile_protocol(fake.protocol()), repositories, {}, 2, str(tmp_path), 2)
+
+    assert sorted({shard_of(f"{owner}/{repo}", 3) for owner, repo in repositories}) == [0, 1, 2]
+    with patch("gitverify.datetime") as mock_datetime:
+        mock_datetime.now.return_value.strftime.return_value = "2024-01-01 00:00:00"
+        report_fleet_results(results, errors, "json", outputs={"json": str(tmp_path / "single.json")})
+    for name, partials in (("threads", paths), ("processes", processes)):
+        for path in partials:
+            with open(path) as file:
+                lines = file.read().splitlines()
+            lines[0] = lines[0].replace(json.loads(lines[0])["verification_date"], "2024-01-01 00:00:00")
+            with open(path, "w") as file:
+                file.write("\n".join(lines) + "\n")
+        merge_shards(partials, str(tmp_path / f"{name}.ndjson"))
+        report_from_stream(str(tmp_path / f"{name}.ndjson"), "json", outputs={"json": str(tmp_path / f"{name}.json")})
+        assert (tmp_path / f"{name}.json").read_text() == (tmp_path / "single.json").read_text()
+
+    with open(paths[1], "a") as file:
+        file.write("\n")
+    with open(paths[2]) as file:
+        truncated = file.read().splitlines()[:-1]
+    with open(paths[2], "w") as file:
+        file.write("\n".join(truncated) + "\n")
+    with pytest.raises(ValueError, match="incomplete"):
+        merge_shards(paths, str(tmp_path / "broken.ndjson"))
+    with pytest.raises(ValueError, match="one partial for each"):
+        merge_shards(paths[:2], str(tmp_path / "broken.ndjson"))
+
+
+def test_shards_verify_a_repository_listed_twice(tmp_path):
+    with FakeGitHub(repositories=3, branches=1, environments=0) as fake:
+        repositories = fake.repositories + [fake.repositories[0]]
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            paths = [str(tmp_path / f"shard-{index}.ndjson") for index in range(2)]
+            for index, path in enumerate(paths):
+                verify_shard(fake.protocol(), repositories, {}, index, 2, path)
+    merge_shards(paths, str(tmp_path / "merged.ndjson"))
+    with open(tmp_path / "merged.ndjson") as file:
+        order = [record["repository"] for record in read_stream(file) if record["type"] == "repository"]
+    assert order == [f"{owner}/{repo}" for owner, repo in repositories]
+
+
+def test_shard_processes_rebuild_the_cli_client(tmp_path):
+    snapshot = str(tmp_path / "run.snapshot")
+    with FakeGitHub(repositories=4, branches=2, environments=1) as fake:
+        protocol = compile_protocol(fake.protocol())
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with SnapshotRecorder(GitHubClient(), SnapshotWriter(snapshot)) as client:
+                results, _ = verify_fleet(protocol, fake.repositories, {}, max_workers=2, client=client)
+            api_url = fake.url
+    # The server is gone: the shards can only answer from the snapshot.
+    with patch("gitverify.GITHUB_API_URL", api_url):
+        paths = verify_sharded(protocol, fake.repositories, {}, 2, str(tmp_path), 2, client_options={"replay": snapshot})
+        with pytest.raises(ValueError, match="snapshot"):
+            verify_sharded(protocol, fake.repositories, {}, 2, str(tmp_path), 2, client_options={"snapshot": snapshot})
+    merge_shards(paths, str(tmp_path / "merged.ndjson"))
+    report_from_stream(str(tmp_path / "merged.ndjson"), "json", outputs={"json": str(tmp_path / "merged.json")})
+    with open(tmp_path / "merged.json") as file:
+        assert json.load(file)["repositories"] == results
+
+
+def test_evaluate_table_matches_per_rule_evaluation(tmp_path):
+    documents = {}
+    with FakeGitHub(repositories=12, branches=3, environments=2) as fake:
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            results, errors = verify_fleet(
+                fake.protocol(), fake.repositories, {}, max_workers=4, on_settings=documents.__setitem__
+            )
+    assert errors == {}
+    table = SettingsTable.from_documents(documents)
+    matrix = evaluate_table(fake.protocol(), table)
+    assert len(matrix.rules) == 3 * 3 + 2 * 2
+    assert matrix.results() == results
+
+    stricter = fake.protocol()
+    stricter["protocol"]["branch_protection_rules"][0]["required_reviewers"] = 3
+    stricter["protocol"]["environments"][0]["required_approvers"] = ["Reviewer 1", "Reviewer 3"]
+    matrix = evaluate_table(stricter, table)
+    assert [bool(passed) for passed in matrix.column("main", "required_reviewers")] == [
+        fake.branch_protection(repo, "main")["required_pull_request_reviews"]["required_approving_review_count"] >= 3
+        for _, repo in fake.repositories
+    ]
+    assert not any(matrix.column("env-0", "required_approvers"))
+
+
+def test_evaluate_table_fails_rules_without_settings():
+    table = SettingsTable.from_documents(
+        {
+            "o/a": {"branches/main/protection": {"allow_force_pushes": {"enabled": False}}},
+            "o/b": {},
+        }
+    )
+    protocol = {
+        "protocol": {
+            "branch_protection_rules": [
+                {"branch": "main", "required_reviewers": 0, "allow_force_push": False, "allow_bypass": False}
+            ],
+        }
+    }
+    assert evaluate_table(protocol, table).failures() == [
+        ("o/a", "main", "required_reviewers"),
+        ("o/b", "main", "required_reviewers"),
+        ("o/b", "main", "allow_force_push"),
+        ("o/b", "main", "allow_bypass"),
+    ]
+
+
+def test_status_checks_share_the_branch_protection_fetch():
+    with FakeGitHub(repositories=1, branches=2, environments=0) as fake:
+        protocol = fake.protocol()
+        protocol["protocol"]["required_status_checks"] = [
+            {"branch": "main", "checks": [{"name": "build"}]},
+            {"branch": "branch-1", "checks": ["build", "lint"]},
+            {"branch": "main", "checks": ["test"]},
+        ]
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with GitHubClient() as client:
+                results = verify_branch_protection(protocol, {}, client=client)
+                assert fake.requests == 2
+                assert verify_status_checks(protocol, {}, client=client) == {
+                    "main": {"required_status_checks": True},
+                    "branch-1": {"required_status_checks": False},
+                }
+    assert results["main"]["required_status_checks"] is True
+    assert results["main"]["allow_force_push"] is True
+    assert results["branch-1"]["required_status_checks"] is False
+
+
+def test_status_checks_accept_app_bound_checks():
+    rule = compile_protocol({"protocol": {"required_status_checks": [{"branch": "main", "checks": ["build", "test"]}]}})
+    protection = {"required_status_checks": {"contexts": ["build"], "checks": [{"context": "test", "app_id": 15368}]}}
+    with patch("gitverify.get_branch_protection_rules", return_value=protection) as mock_branch:
+        assert verify_status_checks(rule.for_repository("o", "a"), {}) == {"main": {"required_status_checks": True}}
+    assert mock_branch.call_count == 1
+
+
+def test_code_owners_last_matching_rule_wins():
+    matcher = CodeOwners.parse(
+        """
+        # Default owners
+        *       @myOrg/reviewers
+        *.js    @js-owner  # inline comment
+        /build/logs/ @doug
+        docs/*  docs@example.com
+        apps/   @octocat
+        /src/   @myOrg/developers
+        **/logs @logs
+        /scripts/*.sh @ops
+        """
+    )
+    assert matcher.owners("README.md") == ("@myOrg/reviewers",)
+    assert matcher.owners("web/app.js") == ("@js-owner",)
+    assert matcher.owners("docs/index.md") == ("docs@example.com",)
+    assert matcher.owners("docs/guide/index.md") == ("@myOrg/reviewers",)
+    assert matcher.owners("services/apps/main.py") == ("@octocat",)
+    assert matcher.owners("src/main.py") == ("@myOrg/developers",)
+    assert matcher.owners("src", directory=True) == ("@myOrg/developers",)
+    assert matcher.owners("src") == ("@myOrg/reviewers",)
+    assert matcher.owners("build/logs/today.txt") == ("@logs",)
+    assert matcher.owners("scripts/deploy.sh") == ("@ops",)
+    assert matcher.owners("scripts/ci/deploy.sh") == ("@myOrg/reviewers",)
+    assert CodeOwners.parse("/src/ @a").match("lib/main.py") == -1
+
+
+def test_code_owners_fetch_the_tree_and_file_once():
+    files = ["README.md", "src/main.py", "src/util/helpers.py"]
+    codeowners = "* @myOrg/reviewers\n/src/ @myOrg/Developers @alice\n"
+    with FakeGitHub(repositories=1, branches=1, environments=0, files=files, codeowners=codeowners) as fake:
+        protocol = fake.protocol()
+        protocol["protocol"]["code_owners"] = [
+            {"path": "/", "owners": ["@myOrg/reviewers"]},
+            {"path": "/src", "owners": ["@myOrg/developers"]},
+            {"path": "/src/util/helpers.py", "owners": ["@bob"]},
+        ]
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with GitHubClient() as client:
+                results = verify_branch_protection(protocol, {}, client=client)
+                assert fake.requests == 3
+                assert verify_code_owners(protocol, {}, client=client) == {
+                    "/": {"code_owners": True},
+                    "/src": {"code_owners": True},
+                    "/src/util/helpers.py": {"code_owners": False},
+                    "CODEOWNERS": {"all_files_owned": True},
+                }
+    assert results["main"]["allow_force_push"] is True
+    assert results["/src"] == {"code_owners": True}
+
+
+def test_code_owners_walk_truncated_trees():
+    files = ["README.md", "src/a.py", "src/b.py", "src/lib/c.py", "src/lib/d.py", "docs/x.md", "tools/run.sh"]
+    codeowners = "/README.md @all\n/src/ @dev\n/docs/ @doc\n/.github/ @all\n"
+    with FakeGitHub(repositories=1, branches=1, environments=0, files=files, codeowners=codeowners, tree_limit=3) as fake:
+        protocol = fake.protocol()
+        protocol["protocol"]["code_owners"] = [{"path": "/src/lib", "owners": ["@dev"]}]
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            listing = get_code_owners(fake.organization, fake.repository_names[0], {})
+            results = verify_code_owners(protocol, {})
+    assert sorted(path for path, kind in listing["tree"] if kind == "blob") == sorted(files + [".github/CODEOWNERS"])
+    assert results == {"/src/lib": {"code_owners": True}, "CODEOWNERS": {"all_files_owned": False}}
+
+
+def test_code_owners_are_verified_on_the_graphql_and_async_paths():
+    files = ["README.md", "src/a.py", "src/lib/b.py", "tools/run.sh"]
+    codeowners = "* @all\n/src/ @dev\n"
+    expected = {"/src": {"code_owners": True}, "/tools": {"code_owners": False}, "CODEOWNERS": {"all_files_owned": True}}
+    with FakeGitHub(repositories=1, branches=1, environments=0, files=files, codeowners=codeowners, tree_limit=2) as fake:
+        protocol = fake.protocol()
+        protocol["protocol"]["code_owners"] = [
+            {"path": "/src", "owners": ["@dev"]},
+            {"path": "/tools", "owners": ["@dev"]},
+        ]
+        main = dict(fake.branch_protection(fake.repository_names[0], "main"), pattern="main")
+        protection = {"branch_protection_rules": [main], "environments": {}}
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with patch("gitverify.get_repository_protection_graphql", return_value=protection):
+                results = verify_repository_graphql(protocol, {})
+            assert {key: results[key] for key in expected} == expected
+
+
+            pytest.importorskip("aiohttp")
+
+            async def run():
+                async with AsyncGitHubClient() as client:
+                    return await verify_branch_protection_async(protocol, {}, client=client)
+
+            results = asyncio.run(run())
+            assert {key: results[key] for key in expected} == expected
+
+
+def test_code_owners_fail_without_a_codeowners_file():
+    with FakeGitHub(repositories=1, branches=1, environments=0, files=["README.md"]) as fake:
+        protocol = fake.protocol()
+        protocol["protocol"]["code_owners"] = [{"path": "/", "owners": ["@myOrg/reviewers"]}]
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            results = verify_code_owners(protocol, {})
+    assert results == {"/": {"code_owners": False}, "CODEOWNERS": {"all_files_owned": False}}
+
+
+def test_iter_branches_fetches_known_pages_in_parallel():
+    with FakeGitHub(repositories=1, branches=2, environments=0, extra_branches=448, page_size=100) as fake:
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with GitHubClient() as client:
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    branches = iter_branches(fake.organization, fake.repository_names[0], {}, client, executor, window=2)
+                    first = next(branches)
+                    assert fake.requests == 1
+                    names = [first["name"]] + [branch["name"] for branch in branches]
+                serial = [branch["name"] for branch in iter_branches(fake.organization, fake.repository_names[0], {}, client)]
+    assert names == serial == [branch["name"] for branch in fake.all_branches(fake.repository_names[0])]
+    assert fake.requests == 5 + 5
+
+
+def test_branch_patterns_expand_to_listed_branches():
+    with FakeGitHub(repositories=1, branches=3, environments=0, extra_branches=150, page_size=100) as fake:
+        protocol = fake.protocol()
+        protocol["protocol"]["branch_protection_rules"] = [
+            {"branch": "branch-*", "required_reviewers": 1, "allow_force_push": False, "allow_bypass": False},
+            {"branch": "main", "required_reviewers": 1, "allow_force_push": True, "allow_bypass": False},
+            {"branch": "feature/*", "required_reviewers": 0, "allow_force_push": True, "allow_bypass": False},
+            {"branch": "*", "required_reviewers": 0, "allow_force_push": True, "allow_bypass": False},
+        ]
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with GitHubClient() as client:
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    results = verify_branch_protection(protocol, {}, executor, client)
+        # Two branch list pages and the three protected branches; the
+        # unprotected feature branches need no protection request.
+        assert fake.requests == 2 + 3
+    assert list(results)[:3] == ["main", "branch-1", "branch-2"]
+    assert len(results) == 3 + 150
+    assert results["main"]["allow_force_push"] is False
+    assert results["branch-2"] == {"required_reviewers": True, "allow_force_push": True, "allow_bypass": True}
+    assert results["feature/149"] == {"required_reviewers": True, "allow_force_push": True, "allow_bypass": True}
+
+
+def test_branch_patterns_expand_on_the_async_api():
+    pytest.importorskip("aiohttp")
+    with FakeGitHub(repositories=2, branches=3, environments=1, extra_branches=12, page_size=5) as fake:
+        protocol = fake.protocol()
+        protocol["protocol"]["branch_protection_rules"] = [
+            {"branch": "main", "required_reviewers": 1, "allow_force_push": False, "allow_bypass": False},
+            {"branch": "branch-*", "required_reviewers": 2, "allow_force_push": False, "allow_bypass": False},
+            {"branch": "feature/*", "required_reviewers": 0, "allow_force_push": True, "allow_bypass": False},
+        ]
+
+        async def run():
+            async with AsyncGitHubClient() as client:
+                single = await verify_branch_protection_async(protocol, {}, client=client)
+                fleet = await verify_fleet_async(protocol, fake.repositories, {}, client=client)
+                return single, fleet
+
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            expected = verify_fleet(protocol, fake.repositories, {}, max_workers=2)
+            fake.reset_stats()
+            single, fleet = asyncio.run(run())
+        # Per repository: three pages of 15 branches and the two protected
+        # branch-* branches besides main; the fleet run repeats all of it.
+        assert fake.requests == 3 * (3 + 3 + 1)
+    assert fleet == expected
+    assert single == expected[0]["bench-org/repo-00000"]
+    assert len(single) == 3 + 12 + 1
+
+
+def test_branch_patterns_do_not_cross_slashes():
+    assert branch_matches("release/1.0", "release/*")
+    assert not branch_matches("release/1.0/fix", "release/*")
+    assert branch_matches("release/1.0/fix", "release/**")
+    assert branch_matches("release/1.0/fix", "release/**/fix")
+    assert not branch_matches("hotfix/1", "release/*")
+
+
+def test_fleet_reports_a_failed_branch_listing_as_an_error():
+    with FakeGitHub(repositories=2, branches=2, environments=0) as fake:
+        protocol = fake.protocol()
+        protocol["protocol"]["branch_protection_rules"][1]["branch"] = "branch-*"
+        repositories = [fake.repositories[0], (fake.organization, "broken"), fake.repositories[1]]
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            results, errors = verify_fleet(protocol, repositories, {}, max_workers=2)
+    assert sorted(results) == [f"{owner}/{repo}" for owner, repo in fake.repositories]
+    assert "branch-1" in results[f"{fake.organization}/repo-00001"]
+    assert list(errors) == [f"{fake.organization}/broken"]
+    assert "Error listing branches" in errors[f"{fake.organization}/broken"]
+
+
+def test_evaluate_table_expands_branch_patterns():
+    protection = {
+        "required_pull_request_reviews": {"required_approving_review_count": 2},
+        "allow_force_pushes": {"enabled": False},
+        "enforce_admins": {"enabled": False},
+    }
+    table = SettingsTable.from_documents(
+        {
+            "o/a": {"branches/release/1.0/protection": protection, "branches/main/protection": protection},
+            "o/b": {"branches/release/2.0/protection": protection},
+        }
+    )
+    protocol = {
+        "protocol": {
+            "branch_protection_rules": [
+                {"branch": "release/*", "required_reviewers": 2, "allow_force_push": False, "allow_bypass": False}
+            ],
+        }
+    }
+    assert evaluate_table(protocol, table).failures() == [
+        ("o/a", "release/2.0", "required_reviewers"),
+        ("o/a", "release/2.0", "allow_force_push"),
+        ("o/a", "release/2.0", "allow_bypass"),
+        ("o/b", "release/1.0", "required_reviewers"),
+        ("o/b", "release/1.0", "allow_force_push"),
+        ("o/b", "release/1.0", "allow_bypass"),
+    ]
+
+
+def test_endpoint_label_hides_names():
+    with patch("gitverify.GITHUB_API_URL", "https://github.example.com/api/v3"):
+        assert endpoint_label("https://github.example.com/api/v3/repos/o/r/branches/release/1.x/protection") == (
+            "/repos/*/branches/*/protection"
+        )
+        assert endpoint_label("https://github.example.com/api/v3/orgs/o/repos?page=2") == "/orgs/*/repos"
+
+
+def test_metrics_count_requests_cache_hits_and_stages(tmp_path):
+    with FakeGitHub(repositories=1, branches=2, environments=1) as fake:
+        protocol = fake.protocol()
+        metrics = enable_metrics(trace=True)
+        try:
+            with patch("gitverify.GITHUB_API_URL", fake.url):
+                with GitHubClient(cache=ResponseCache(str(tmp_path / "cache"))) as client:
+                    verify_branch_protection(protocol, {}, client=client)
+                    verify_branch_protection(protocol, {}, client=client)
+        finally:
+            disable_metrics()
+    endpoint = "/repos/*/branches/*/protection"
+    assert metrics.counters["gitverify_requests_total", (("endpoint", endpoint), ("status", "200"))] == 2
+    assert metrics.counters["gitverify_requests_total", (("endpoint", endpoint), ("status", "304"))] == 2
+    assert metrics.counters["gitverify_cache_hits_total", ()] == 3
+    assert metrics.counters["gitverify_cache_misses_total", ()] == 3
+    assert metrics.histograms["gitverify_stage_duration_seconds", (("stage", "verify_branch_protection"),)][2] == 2
+    assert metrics.histograms["gitverify_stage_duration_seconds", (("stage", "get_branch_protection_rules"),)][2] == 4
+
+    metrics.write_prometheus(tmp_path / "gitverify.prom")
+    text = (tmp_path / "gitverify.prom").read_text()
+    assert "# TYPE gitverify_request_duration_seconds histogram" in text
+    assert f'gitverify_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} 4' in text
+    assert "gitverify_cache_hits_total 3" in text
+    metrics.write_trace(tmp_path / "trace.json")
+    spans = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert sum(span["name"] == f"GET {endpoint}" for span in spans) == 4
+    assert sum(span["name"] == "verify_branch_protection" for span in spans) == 2
+
+
+def test_metrics_time_the_protocol_loading_the_cli_uses(tmp_path):
+    _write_protocols(tmp_path)
+    metrics = enable_metrics()
+    try:
+        load_plan(str(tmp_path / "base.yml"))
+        resolver = ProtocolResolver(str(tmp_path / "base.yml"), str(tmp_path / "overrides"))
+        for repo in ["strict_repo", "repo_1", "repo_2"]:
+            resolver.plan_for("test_owner", repo)
+    finally:
+        disable_metrics()
+    stage = "gitverify_stage_duration_seconds"
+    assert metrics.histograms[stage, (("stage", "load_plan"),)][2] == 1
+    # base.yml, strict_repo.yml and team.yml, each read once.
+    assert metrics.histograms[stage, (("stage", "load_protocol"),)][2] == 3
+
+
+def test_metrics_count_async_requests():
+    pytest.importorskip("aiohttp")
+    with FakeGitHub(repositories=2, branches=2, environments=1) as fake:
+        protocol = fake.protocol()
+
+        async def run():
+            async with AsyncGitHubClient() as client:
+                return await verify_fleet_async(protocol, fake.repositories, {}, client=client)
+
+        metrics = enable_metrics(trace=True)
+        try:
+            with patch("gitverify.GITHUB_API_URL", fake.url):
+                asyncio.run(run())
+        finally:
+            disable_metrics()
+    endpoint = "/repos/*/branches/*/protection"
+    assert metrics.counters["gitverify_requests_total", (("endpoint", endpoint), ("status", "200"))] == 4
+    assert metrics.counters["gitverify_response_bytes_total", (("endpoint", endpoint),)] > 0
+    assert metrics.histograms["gitverify_request_duration_seconds", (("endpoint", endpoint),)][2] == 4
+    assert sum(span["name"] == "GET /repos/*/environments/*/protection" for span in metrics.spans) == 2
+
+
+def test_metrics_are_off_by_default():
+    with FakeGitHub(repositories=1, branches=1, environments=0) as fake:
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with patch("gitverify.Metrics.count") as count:
+                verify_branch_protection(fake.protocol(), {})
+    count.assert_not_called()
+
+
+def test_watch_daemon_refreshes_stale_resources_only():
+    clock = FakeClock()
+    with FakeGitHub(repositories=2, branches=2, environments=1) as fake:
+        protocol = fake.protocol()
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with GitHubClient() as client:
+                daemon = WatchDaemon(
+                    protocol, fake.repositories, {}, client, max_workers=4, interval=600, hot_interval=60, clock=clock
+                )
+                assert sorted(daemon.refresh()) == ["bench-org/repo-00000", "bench-org/repo-00001"]
+                assert fake.requests == 6
+                assert daemon.refresh() == []
+                assert fake.requests == 6
+                assert daemon.next_due() == clock.now + 600
+
+                original = fake.branch_protection
+
+                def changed(repo, branch):
+                    document = original(repo, branch)
+                    if (repo, branch) == ("repo-00000", "main"):
+                        document["enforce_admins"] = {"enabled": True}
+                    return document
+
+                clock.now += 600
+                with patch.object(fake, "branch_protection", changed):
+                    assert len(daemon.refresh()) == 2
+                assert fake.requests == 12
+                assert daemon.results("bench-org/repo-00000")["results"]["main"]["allow_bypass"] is False
+
+                clock.now += 60
+                assert daemon.refresh() == ["bench-org/repo-00000"]
+                assert fake.requests == 15
+    assert daemon.interval_for("bench-org/repo-00001", clock.now) == 600
+    assert daemon.results("bench-org/repo-00000")["results"]["main"]["allow_bypass"] is True
+
+
+def test_watch_daemon_keeps_results_and_retries_failed_repositories():
+    clock = FakeClock()
+    with FakeGitHub(repositories=1, branches=1, environments=1) as fake:
+        protocol = fake.protocol()
+        protocol["protocol"]["environments"].append(
+            {"name": "missing", "required_reviewers": 1, "required_approvers": []}
+        )
+        with patch("gitverify.GITHUB_API_URL", fake.url):
+            with GitHubClient(max_retries=0) as client:
+                daemon = WatchDaemon(protocol, fake.repositories, {}, client, interval=600, hot_interval=60, clock=clock)
+                daemon.refresh()
+                state = daemon.results("bench-org/repo-00000")
+                assert "results" not in state and "missing" in state["error"]
+                assert daemon.next_due() == clock.now + 60
+                requests_before = fake.requests
+                fake.environment_names.append("missing")
+                clock.now += 60
+                daemon.refresh()
+                # Only the failed lookup is sent again; the others are still in memory.
+                assert fake.requests == requests_before + 1
+    assert daemon.results("bench-org/repo-00000")["error"] is None
+    assert daemon.results("bench-org/repo-00000")["results"]["missing"]["required_approvers"] is True
+
+
+def test_watch_daemon_survives_a_failed_pass():
+    clock = FakeClock()
+    daemon = WatchDaemon({"protocol": {}}, [("o", "a"), ("o", "b")], {}, client=None, hot_interval=60, clock=clock)
+    passes = []
+
+    def failing_fleet(*args, **kwargs):
+        passes.append(args[1])
+        if len(passes) == 2:
+            daemon.stop()
+        raise ValueError("Invalid protocol: o/a.yml")
+
+    with patch("gitverify.verify_fleet", side_effect=failing_fleet):
+        with pytest.raises(ValueError):
+            daemon.refresh()
+        assert daemon.next_due() == clock.now + 60
+        clock.now += 60
+        daemon.run()
+    assert passes == [[("o", "a"), ("o", "b")]] * 2
+    assert daemon.next_due() == clock.now + 60
+
+
+def test_watch_results_are_served_over_http_and_unix_socket(tmp_path):
+    daemon = WatchDaemon({"protocol": {}}, [("o", "a")], {}, client=None, clock=FakeClock())
+    daemon._on_result({}, 0.0, set(), "o/a", {"main": {"required_reviewers": True}}, None)
+    server = serve_watch_results(daemon, "127.0.0.1:0")
+    try:
+        url = "http://%s:%d" % server.server_address
+        assert requests.get(f"{url}/results/o/a").json()["results"] == {"main": {"required_reviewers": True}}
+        assert requests.get(f"{url}/results/o/b").status_code == 404
+        assert requests.get(f"{url}/healthz").json() == {"repositories": 1, "verified": 1, "errors": 0}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    path = str(tmp_path / "watch.sock")
+    server = serve_watch_results(daemon, path)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(path)
+            connection.sendall(b"GET /results HTTP/1.0\r\n\r\n")
+            response = b""
+            while chunk := connection.recv(4096):
+                response += chunk
+        assert json.loads(response.split(b"\r\n\r\n", 1)[1])["o/a"]["verified_at"] == 0.0
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # The stale socket is replaced; a file that is not a socket is kept.
+    server = serve_watch_results(daemon, path)
+    server.shutdown()
+    server.server_close()
+    report = tmp_path / "report.json"
+    report.write_text("{}")
+    with pytest.raises(FileExistsError, match="not a socket"):
+        serve_watch_results(daemon, str(report))
+    assert report.read_text() == "{}"